@@ -0,0 +1,221 @@
+'''
+Batched inference of inputs of mixed resolutions
+    python batching.py --wc_model_path ./eval/models/unetnc_doc3d.pkl --bm_model_path ./eval/models/dnetccnl_doc3d.pkl \
+        --img_path ./eval/inp/ --out_path ./eval/uw/ --batch_size 8
+The networks take 256x256 inputs, so every --net_batch inputs run through them as one batch whatever their size.
+The full resolution unwarp is one F.grid_sample per batch, which needs images of one size: inputs are grouped
+into buckets by aspect ratio (--aspect_edges) and longer side (--size_edges), and a bucket is unwarped once it
+holds --batch_size images, zero padded to the largest of them only. At most (buckets x batch_size) full resolution
+images wait for their bucket to fill. Outputs are the same as infer.py --unwarp torch.
+'''
+import os
+import time
+import bisect
+import argparse
+import itertools
+from collections import OrderedDict
+import numpy as np
+import cv2
+import torch
+import torch.nn.functional as F
+
+from infer import load_models, predict_bm, prepare_input
+from preprocess import SourceImage, network_input, unletterbox_bm
+from unwarping import coarse_bm
+from jobs import scan_inputs
+from utils import to_chw
+from profiling import StageTimer, NULL_TIMER
+
+# width / height: portrait pages, square-ish, landscape
+ASPECT_EDGES = (0.9, 1.1)
+# longer side in pixels
+SIZE_EDGES = (1200, 2400)
+
+
+def bucket_of(shape, aspect_edges=ASPECT_EDGES, size_edges=SIZE_EDGES):
+    """(aspect bin, size bin) of an image of shape (h, w, ...)"""
+    return bisect.bisect(aspect_edges, shape[1] / float(shape[0])), bisect.bisect(size_edges, max(shape[:2]))
+
+
+class BucketScheduler(object):
+    """
+    Groups items by the shape of their image, a bucket is released as a batch once it holds max_batch items
+    :param aspect_edges, size_edges bucket boundaries, both empty for a single bucket
+    The padding of the released batches is counted per bucket in stats().
+    """
+    def __init__(self, max_batch=8, aspect_edges=ASPECT_EDGES, size_edges=SIZE_EDGES):
+        self.max_batch = max_batch
+        self.aspect_edges = tuple(sorted(aspect_edges))
+        self.size_edges = tuple(sorted(size_edges))
+        self.buckets = OrderedDict()
+        self.counts = OrderedDict()
+
+    def add(self, item, shape):
+        """Adds item of image shape, returns the batch of its bucket if that is full now, else None"""
+        key = bucket_of(shape, self.aspect_edges, self.size_edges)
+        bucket = self.buckets.setdefault(key, [])
+        bucket.append((item, shape))
+        if len(bucket) >= self.max_batch:
+            return self._release(key)
+        return None
+
+    def flush(self):
+        """The items still waiting, one batch per bucket"""
+        while self.buckets:
+            yield self._release(next(iter(self.buckets)))
+
+    def _release(self, key):
+        batch = self.buckets.pop(key)
+        height = max(shape[0] for _, shape in batch)
+        width = max(shape[1] for _, shape in batch)
+        counts = self.counts.setdefault(key, OrderedDict([('batches', 0), ('items', 0), ('pixels', 0),
+                                                          ('padded_pixels', 0)]))
+        counts['batches'] += 1
+        counts['items'] += len(batch)
+        counts['pixels'] += sum(shape[0] * shape[1] for _, shape in batch)
+        counts['padded_pixels'] += len(batch) * height * width
+        return [item for item, _ in batch]
+
+    def stats(self):
+        """Batches, items and padding waste (share of the batch pixels that are padding) per bucket and in total"""
+        stats = OrderedDict()
+        total = OrderedDict([('batches', 0), ('items', 0), ('pixels', 0), ('padded_pixels', 0)])
+        for (aspect, size), counts in sorted(self.counts.items()):
+            stats['aspect{}/size{}'.format(aspect, size)] = counts
+            for name in total:
+                total[name] += counts[name]
+        stats['total'] = total
+        for counts in stats.values():
+            counts['padding_waste'] = 1.0 - counts['pixels'] / float(max(counts['padded_pixels'], 1))
+        return stats
+
+
+def pad_batch(images):
+    """(N,C,H,W) float32 tensor in 0-255 of HxWxC uint8 images, zero padded at the bottom and right to the
+       largest height and width
+    """
+    height = max(img.shape[0] for img in images)
+    width = max(img.shape[1] for img in images)
+    batch = np.zeros((len(images), images[0].shape[2], height, width), dtype=np.float32)
+    for i, img in enumerate(images):
+        to_chw(img, scale=1.0, out=batch[i, :, :img.shape[0], :img.shape[1]])
+    return torch.from_numpy(batch)
+
+
+def unwarp_batch(images, bms, timer=NULL_TIMER):
+    """unwarp_torch of images of different sizes with one F.grid_sample on the padded batch
+       :param images HxWxC uint8 images
+       :param bms (N,2,h,w) backward maps of the images
+       :returns HxWxC uint8 outputs at the size of their image
+    """
+    with timer.stage('grid_sample'):
+        inp = pad_batch(images)
+    height, width = inp.shape[2], inp.shape[3]
+    with timer.stage('bm_upsample'):
+        # outside [-1,1], the padding of the output samples zeros
+        grid = np.full((len(images), height, width, 2), -2, dtype=np.float32)
+        for i, img in enumerate(images):
+            h, w = img.shape[:2]
+            bm = cv2.resize(coarse_bm(bms[i:i + 1]), (w, h))
+            # [-1,1] of the image to [-1,1] of the padded batch, with align_corners=True
+            grid[i, :h, :w, 0] = (bm[:, :, 0] + 1) * ((w - 1) / float(max(width - 1, 1))) - 1
+            grid[i, :h, :w, 1] = (bm[:, :, 1] + 1) * ((h - 1) / float(max(height - 1, 1))) - 1
+
+    with timer.stage('grid_sample'):
+        res = F.grid_sample(input=inp, grid=torch.from_numpy(grid), align_corners=True)
+        out = np.empty((len(images), height, width, res.shape[1]), dtype=np.uint8)
+        torch.from_numpy(out).copy_(res.add_(0.5).clamp_(0, 255).permute(0, 2, 3, 1))
+    return [out[i, :img.shape[0], :img.shape[1]] for i, img in enumerate(images)]
+
+
+def _unwarp_items(batch, timer):
+    keys, images, bms = zip(*batch)
+    return zip(keys, unwarp_batch(images, torch.cat(bms), timer))
+
+
+def rectify_bucketed(sources, wc_model, bm_model, scheduler, net_batch=8, letterbox=False, timer=NULL_TIMER):
+    """Generator of (key, rectified BGR uint8 image) of (key, SourceImage) pairs, in the order the buckets fill
+       :param scheduler BucketScheduler of the unwarp batches
+       :param net_batch inputs per network batch
+    """
+    wc_img_size = (256, 256)
+    sources = iter(sources)
+    while True:
+        chunk = list(itertools.islice(sources, net_batch))
+        if not chunk:
+            break
+        with timer.stage('decode'):
+            smalls = [src.small(min(wc_img_size)) for _, src in chunk]
+        with timer.stage('resize'):
+            inputs = [network_input(img, wc_img_size, letterbox) for img in smalls]
+            images = torch.cat([prepare_input(img) for img, _ in inputs])
+        del smalls
+        bms = predict_bm(images, wc_model, bm_model, timer).cpu()
+
+        for i, (key, src) in enumerate(chunk):
+            bm = unletterbox_bm(bms[i:i + 1], inputs[i][1], wc_img_size)
+            with timer.stage('decode'):
+                img = src.full()
+            batch = scheduler.add((key, img, bm), img.shape)
+            if batch is not None:
+                for item in _unwarp_items(batch, timer):
+                    yield item
+    for batch in scheduler.flush():
+        for item in _unwarp_items(batch, timer):
+            yield item
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Params')
+    parser.add_argument('--wc_model_path', nargs='?', type=str, default='',
+                        help='Path to the saved wc model or weights file')
+    parser.add_argument('--bm_model_path', nargs='?', type=str, default='',
+                        help='Path to the saved bm model or weights file')
+    parser.add_argument('--img_path', nargs='?', type=str, default='./eval/inp/',
+                        help='Directory of the input images')
+    parser.add_argument('--out_path', nargs='?', type=str, default='./eval/uw/',
+                        help='Directory of the unwarped images')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='Process the images in the subdirectories of --img_path too, into the same tree under --out_path')
+    parser.add_argument('--batch_size', nargs='?', type=int, default=8,
+                        help='Images per unwarp batch (one bucket)')
+    parser.add_argument('--net_batch', nargs='?', type=int, default=8,
+                        help='Images per network batch')
+    parser.add_argument('--aspect_edges', nargs='*', type=float, default=list(ASPECT_EDGES),
+                        help='Width / height boundaries of the buckets, none for one aspect bucket')
+    parser.add_argument('--size_edges', nargs='*', type=int, default=list(SIZE_EDGES),
+                        help='Longer side boundaries of the buckets, none for one size bucket')
+    parser.add_argument('--letterbox', dest='letterbox', action='store_true',
+                        help='Keep the aspect ratio of the image in the network input, padded with black')
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const='profile.json',
+                        help='Save the per image latency of every stage to this .json or .csv')
+    parser.set_defaults(recursive=False, letterbox=False)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    timer = StageTimer(cuda_sync=True) if args.profile else NULL_TIMER
+    wc_model, bm_model = load_models(args)
+    scheduler = BucketScheduler(args.batch_size, args.aspect_edges, args.size_edges)
+    sources = ((rel_path, SourceImage(os.path.join(args.img_path, rel_path)))
+               for rel_path, _, _ in scan_inputs(args.img_path, recursive=args.recursive))
+    start = time.time()
+    n_images = 0
+    for rel_path, out in rectify_bucketed(sources, wc_model, bm_model, scheduler, args.net_batch, args.letterbox,
+                                          timer):
+        with timer.stage('write'):
+            outp = os.path.join(args.out_path, rel_path)
+            os.makedirs(os.path.dirname(outp) or '.', exist_ok=True)
+            cv2.imwrite(outp, out)
+        timer.end_item(rel_path, height=out.shape[0], width=out.shape[1])
+        n_images += 1
+    elapsed = time.time() - start
+    print("{} images in {:.1f}s ({:.2f} images/s)".format(n_images, elapsed, n_images / max(elapsed, 1e-6)))
+    for name, counts in scheduler.stats().items():
+        print("{:<16s} {} batches, {} images, padding waste {:.1%}".format(name, counts['batches'], counts['items'],
+                                                                       counts['padding_waste']))
+    if args.profile:
+        print(timer.report())
+        timer.save(args.profile)
+        print("Saved profile to {}".format(args.profile))
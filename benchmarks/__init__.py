@@ -0,0 +1,7 @@
+'''
+Benchmark suite on synthetic Doc3D shaped data, see run_benchmarks.py
+'''
+import os
+
+# the synthetic wc maps are written as exr, which newer OpenCV builds only do when asked to
+os.environ.setdefault('OPENCV_IO_ENABLE_OPENEXR', '1')
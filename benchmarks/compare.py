@@ -0,0 +1,61 @@
+# compares two benchmark runs of run_benchmarks.py by median time
+#
+# python -m benchmarks.compare base.json new.json --threshold 0.1
+import sys
+import json
+import argparse
+
+
+def compare(base, new, threshold=0.1):
+    """Rows (name, base median, new median, ratio, status) for the benchmarks of both runs"""
+    rows = []
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            rows.append((name, None, result['median'], None, 'new'))
+            continue
+        base_median = base['results'][name]['median']
+        ratio = result['median'] / base_median if base_median > 0 else float('inf')
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        else:
+            status = ''
+        rows.append((name, base_median, result['median'], ratio, status))
+    for name in base['results']:
+        if name not in new['results']:
+            rows.append((name, base['results'][name]['median'], None, None, 'missing'))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare benchmark runs')
+    parser.add_argument('base', type=str, help='json of the reference run')
+    parser.add_argument('new', type=str, help='json of the run to check')
+    parser.add_argument('--threshold', nargs='?', type=float, default=0.1,
+                        help='Relative change of the median reported as regression/faster')
+    parser.add_argument('--fail', dest='fail', action='store_true',
+                        help='Exit with 1 if there is a regression')
+    parser.set_defaults(fail=False)
+    args = parser.parse_args(argv)
+
+    with open(args.base, 'r') as f:
+        base = json.load(f)
+    with open(args.new, 'r') as f:
+        new = json.load(f)
+    print("base: {} ({})".format(base['env'].get('git'), base['env'].get('time')))
+    print("new:  {} ({})".format(new['env'].get('git'), new['env'].get('time')))
+
+    ms = lambda v: '-' if v is None else '{:.3f}'.format(v * 1e3)
+    rows = compare(base, new, args.threshold)
+    print("{:<45s} {:>12s} {:>12s} {:>8s}".format('benchmark', 'base ms', 'new ms', 'ratio'))
+    for name, base_median, new_median, ratio, status in rows:
+        print("{:<45s} {:>12s} {:>12s} {:>8s} {}".format(name, ms(base_median), ms(new_median),
+                                                         '-' if ratio is None else '{:.2f}'.format(ratio), status))
+    regressions = [row for row in rows if row[4] == 'REGRESSION']
+    print("{} regression(s) above {:.0%}".format(len(regressions), args.threshold))
+    return 1 if args.fail and regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,518 @@
+# benchmark suite: loaders, models, losses and end-to-end inference on cpu
+# with synthetic Doc3D shaped data, results are written to json for benchmarks/compare.py
+#
+# python -m benchmarks.run_benchmarks --out bench.json
+# python -m benchmarks.run_benchmarks --filter model/unetnc --batch_sizes 1 8 --device cuda
+import os
+import gc
+import sys
+import json
+import ctypes
+import tracemalloc
+import time
+import shutil
+import platform
+import argparse
+import itertools
+import resource
+import subprocess
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import cv2
+import torch
+import torch.nn.functional as F
+import scipy.misc as m
+import hdf5storage as h5
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import infer
+import grad_loss
+import recon_lossc
+import pytorch_ssim
+from models import get_model
+from loaders import get_loader
+from weights import save_weights
+from preprocess import SourceImage, network_input
+from unwarping import unwarp_torch, get_unwarper, unwarp_sizes, output_size, estimate_output_size
+from evaluate import EVAL_AREA, eval_size, page_metrics
+from batching import BucketScheduler, unwarp_batch
+from utils import reset_peak_memory, peak_memory_mb
+from benchmarks.synthetic import make_doc3d, synthetic_page
+
+
+def summarize(times):
+    times = np.array(times)
+    return {'n': len(times), 'mean': float(times.mean()), 'median': float(np.median(times)),
+            'min': float(times.min()), 'max': float(times.max()), 'std': float(times.std())}
+
+
+def timeit(fn, repeat=10, warmup=2, device=None):
+    """Wall clock seconds of fn() over repeat calls after warmup calls"""
+    sync = (lambda: torch.cuda.synchronize(device)) if device is not None and device.type == 'cuda' else (lambda: None)
+    for _ in range(warmup):
+        fn()
+    sync()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        sync()
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def _status_kb(key):
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1])
+
+
+def peak_rss_delta_mb(fn):
+    """Growth of the resident set size high-water mark over one call of fn,
+       None where the mark can't be reset (/proc/self/clear_refs is linux only)
+    """
+    gc.collect()
+    try:
+        # hand freed heap memory back, otherwise it hides the allocations of fn
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        base = _status_kb('VmRSS')
+    except (IOError, OSError):
+        return None
+    fn()
+    return (_status_kb('VmHWM') - base) / 1024.0
+
+
+def traced_peak_mb(fn):
+    """Peak of the memory allocated through Python (numpy arrays included) during one call of fn,
+       torch's own tensor allocations are not traced
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / (1024.0 * 1024.0)
+
+
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=root) != 0
+        return rev + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(args):
+    return {'git': git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'device': args.device,
+            'batch_sizes': args.batch_sizes,
+            'repeat': args.repeat}
+
+
+def bench_loaders(root, args, bench):
+    """Per sample cost of decode + transform (getitem) and of the transform alone"""
+    wc_loader = get_loader('doc3dwc')
+    bm_loader = get_loader('doc3dbmnic')
+    for split in ('train', 'val'):
+        loader = wc_loader(root, split=split, is_transform=True, img_size=(256, 256))
+        idx = itertools.cycle(range(len(loader)))
+        bench('loader/doc3dwc/{}/getitem'.format(split), lambda: loader[next(idx)])
+
+    loader = wc_loader(root, split='train', is_transform=True, img_size=(256, 256))
+    im_name = loader.files['train'][0]
+    im = np.array(m.imread(os.path.join(root, 'img', im_name + '.png'), mode='RGB'), dtype=np.uint8)
+    wc = cv2.imread(os.path.join(root, 'wc', im_name + '.exr'), cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH)
+    bench('loader/doc3dwc/transform', lambda: loader.transform(im, np.array(wc, dtype=np.float)), traced=True)
+
+    loader = bm_loader(root, split='train', is_transform=True, img_size=(128, 128), altroot=root)
+    idx = itertools.cycle(range(len(loader)))
+    bench('loader/doc3dbmnic/getitem', lambda: loader[next(idx)])
+    folder, fname = im_name.split('/')
+    bm = h5.loadmat(os.path.join(root, 'bm', im_name + '.mat'))['bm']
+    alb = m.imread(os.path.join(root, 'recon', folder, 'chess48', fname[:-4] + 'chess480001.png'), mode='RGB')
+    bench('loader/doc3dbmnic/transform', lambda: loader.transform(wc, bm, alb), traced=True)
+
+
+# activation checkpointing configurations of the train step sweep: unetnc skip connection levels,
+# dnetccnl dense blocks (0-4 encoder, 5-9 decoder)
+CHECKPOINT_CONFIGS = OrderedDict([('unetnc', OrderedDict([('none', ()), ('outer', (1,)), ('outer3', (1, 2, 3)),
+                                                          ('all', (1, 2, 3, 4, 5, 6))])),
+                                  ('dnetccnl', OrderedDict([('none', ()), ('encoder', (0, 1, 2, 3, 4)),
+                                                            ('all', tuple(range(10)))]))])
+
+
+def step_peak_memory_mb(fn, device):
+    """Peak allocated device memory of one call of fn on gpu, growth of the peak resident set size on cpu"""
+    if device.type == 'cuda':
+        reset_peak_memory()
+        fn()
+        torch.cuda.synchronize(device)
+        return peak_memory_mb()
+    return peak_rss_delta_mb(fn)
+
+
+def bench_models(args, bench, device):
+    """Forward (eval, no grad) and forward + backward (train) per batch size, and the train step per
+       activation checkpointing configuration with its peak memory
+    """
+    for arch, n_classes, size in (('unetnc', 3, 256), ('dnetccnl', 2, 128)):
+        model = get_model(arch, n_classes, in_channels=3).to(device)
+        for bs in args.batch_sizes:
+            x = torch.randn(bs, 3, size, size, device=device)
+
+            def forward():
+                with torch.no_grad():
+                    model(x)
+
+            def forward_backward():
+                model.zero_grad()
+                model(x).mean().backward()
+
+            model.eval()
+            bench('model/{}/forward/bs{}'.format(arch, bs), forward, device)
+            model.train()
+            bench('model/{}/forward_backward/bs{}'.format(arch, bs), forward_backward, device)
+        del model
+
+        for name, levels in CHECKPOINT_CONFIGS[arch].items():
+            model = get_model(arch, n_classes, in_channels=3, checkpoint=levels).to(device).train()
+            for bs in args.batch_sizes:
+                x = torch.randn(bs, 3, size, size, device=device)
+
+                def forward_backward():
+                    model.zero_grad()
+                    model(x).mean().backward()
+
+                result = bench('model/{}/forward_backward/ckpt_{}/bs{}'.format(arch, name, bs), forward_backward,
+                               device)
+                if result is not None:
+                    result['checkpoint'] = list(levels)
+                    result['peak_memory_mb'] = step_peak_memory_mb(forward_backward, device)
+                    print("{:<45s} peak memory {} MB".format('', result['peak_memory_mb']))
+            del model
+
+
+def bench_losses(args, bench, device):
+    gloss = grad_loss.Gradloss(window_size=5, padding=2)
+    ssim = pytorch_ssim.SSIM()
+    reconst_loss = recon_lossc.Unwarploss()
+    for bs in args.batch_sizes:
+        pred = torch.rand(bs, 3, 256, 256, device=device)
+        label = torch.rand(bs, 3, 256, 256, device=device)
+        bench('loss/gradloss/bs{}'.format(bs), lambda: gloss(pred, label), device)
+
+        img1 = torch.rand(bs, 3, 128, 128, device=device)
+        img2 = torch.rand(bs, 3, 128, 128, device=device)
+        bench('loss/ssim/bs{}'.format(bs), lambda: ssim(img1, img2), device)
+
+        inp = torch.rand(bs, 6, 128, 128, device=device)
+        bm_pred = torch.rand(bs, 128, 128, 2, device=device) * 2 - 1
+        bm_label = torch.rand(bs, 128, 128, 2, device=device) * 2 - 1
+        bench('loss/unwarploss/bs{}'.format(bs), lambda: reconst_loss(inp, bm_pred, bm_label), device)
+
+
+def bench_infer(root, tmp_dir, args, bench):
+    """Cold start (model loading) and infer.test per image, on the 448x448 renders
+       and upscaled to a phone photo resolution
+    """
+    model_dir = os.path.join(tmp_dir, 'models')
+    out_dir = os.path.join(tmp_dir, 'uw')
+    os.makedirs(model_dir, exist_ok=True)
+    os.makedirs(out_dir, exist_ok=True)
+    save_weights(get_model('unetnc', 3, in_channels=3).state_dict(), os.path.join(model_dir, 'unetnc_bench.dnw'))
+    save_weights(get_model('dnetccnl', 2, in_channels=3).state_dict(), os.path.join(model_dir, 'dnetccnl_bench.dnw'))
+    infer_args = infer.parse_args(['--wc_model_path', os.path.join(model_dir, 'unetnc_bench.dnw'),
+                                   '--bm_model_path', os.path.join(model_dir, 'dnetccnl_bench.dnw'),
+                                   '--img_path', os.path.join(root, 'img', '1'),
+                                   '--out_path', out_dir])
+    bench('infer/load_models', lambda: infer.load_models(infer_args))
+    wc_model, bm_model = infer.load_models(infer_args)
+
+    src = sorted(os.listdir(infer_args.img_path))[0]
+    img = cv2.imread(os.path.join(infer_args.img_path, src))
+    for name, (w, h) in (('448', (448, 448)), (args.photo_size, tuple(int(v) for v in args.photo_size.split('x')))):
+        img_path = os.path.join(tmp_dir, 'infer_{}.png'.format(name))
+        cv2.imwrite(img_path, cv2.resize(img, (w, h), interpolation=cv2.INTER_CUBIC))
+        bench('infer/test/{}'.format(name),
+              lambda: infer.test(infer_args, img_path, os.path.basename(img_path), wc_model, bm_model))
+
+    # network input of a photo, from the full decode and from the reduced jpeg decode
+    jpg_path = os.path.join(tmp_dir, 'infer_{}.jpg'.format(args.photo_size))
+    cv2.imwrite(jpg_path, cv2.imread(img_path), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    bench('infer/decode/full/{}'.format(args.photo_size),
+          lambda: cv2.resize(cv2.cvtColor(cv2.imread(jpg_path), cv2.COLOR_BGR2RGB), (256, 256)))
+    bench('infer/decode/reduced/{}'.format(args.photo_size),
+          lambda: network_input(SourceImage(jpg_path).small(256)))
+
+
+def synthetic_bm(size=448):
+    """(1,2,128,128) backward map of a synthetic page and the page render"""
+    img, _, _, bm = synthetic_page(size)
+    # pixels of the render to [-1,1], at the resolution of the bm network
+    bm = cv2.resize(bm / (size - 1.0) * 2 - 1, (128, 128))
+    return img, torch.from_numpy(np.ascontiguousarray(bm.transpose(2, 0, 1)[None]))
+
+
+# (max, mean) 0-255 levels the backends may differ from unwarp_torch (align_corners=True): remap samples on the
+# 1/32 pixel grid of its fixed point maps, mesh and the padded batch differ by float rounding. Half a pixel off
+# is tens of levels max and ~0.7 mean on the synthetic page.
+PARITY_TOLERANCE = OrderedDict([('remap', (2, 0.25)), ('mesh', (2, 0.25)), ('batch', (1, 0.25))])
+
+
+def unwarp_parity(backends=('remap', 'mesh'), size=(1000, 750)):
+    """Difference in 0-255 levels of the cv2 backends and the padded batch unwarp to the unwarp_torch reference,
+       with 'ok' whether it is within PARITY_TOLERANCE
+    """
+    img, bm = synthetic_bm()
+    img = cv2.resize(img, size, interpolation=cv2.INTER_CUBIC)
+    ref = unwarp_torch(img, bm).astype(np.float64)
+    parity = OrderedDict()
+    diffs = OrderedDict()
+    for backend in backends:
+        diffs[backend] = np.abs(get_unwarper(backend)(img, bm).astype(np.float64) - ref)
+    # the same image in a batch padded to a larger one
+    small = cv2.resize(img, (size[0] * 3 // 4, size[1] * 2 // 3), interpolation=cv2.INTER_AREA)
+    outs = unwarp_batch([img, small], torch.cat([bm, bm]))
+    diffs['batch'] = np.concatenate([np.abs(outs[0].astype(np.float64) - ref).ravel(),
+                                     np.abs(outs[1].astype(np.float64) - unwarp_torch(small, bm)).ravel()])
+    for name, diff in diffs.items():
+        max_tol, mean_tol = PARITY_TOLERANCE[name]
+        parity[name] = {'max': float(diff.max()), 'mean': float(diff.mean()),
+                        'ok': bool(diff.max() <= max_tol and diff.mean() <= mean_tol)}
+        print("{:<45s} max {:.2f} mean {:.3f} levels off torch{}".format(
+            'unwarp/parity/' + name, diff.max(), diff.mean(), '' if parity[name]['ok'] else ' FAILED'))
+    return parity
+
+
+def bench_unwarp(args, bench):
+    """Unwarp backends on a 12 MP photo"""
+    w, h = (int(v) for v in args.unwarp_size.split('x'))
+    img, bm = synthetic_bm()
+    img = cv2.resize(img, (w, h), interpolation=cv2.INTER_CUBIC)
+    for backend in ('torch', 'remap', 'mesh'):
+        unwarper = get_unwarper(backend)
+        bench('unwarp/{}/{}'.format(backend, args.unwarp_size), lambda: unwarper(img, bm), memory=True)
+    # full resolution, ocr and thumbnail outputs of one backward map
+    sizes = [output_size(img.shape, long_side) for long_side in (0, 2000, 256)]
+    bench('unwarp/sizes/{}'.format(args.unwarp_size), lambda: unwarp_sizes(img, bm, sizes), memory=True)
+    # straight to the page's own size at 300 dpi
+    page = [estimate_output_size(bm, img.shape, target_dpi=300)]
+    bench('unwarp/auto_size/{}'.format(args.unwarp_size), lambda: unwarp_sizes(img, bm, page), memory=True)
+
+
+# bucket configurations of the mixed resolution unwarp: (batch size, aspect edges, size edges)
+BUCKET_CONFIGS = OrderedDict([('per_image', (1, (), ())),
+                              ('one_bucket', (8, (), ())),
+                              ('aspect', (8, (0.9, 1.1), ())),
+                              ('aspect_size', (8, (0.9, 1.1), (1200, 2400)))])
+
+
+def bench_buckets(bench):
+    """Batched unwarp of a mix of phone photos and scans, portrait and landscape, per bucket configuration,
+       with the throughput and the share of the batch pixels that are padding
+    """
+    img, bm = synthetic_bm()
+    sizes = [(1600, 1200), (1200, 1600), (1000, 1414), (2000, 1500), (1414, 1000), (800, 600), (2480, 3508),
+             (1200, 900)] * 3
+    images = [cv2.resize(img, size, interpolation=cv2.INTER_CUBIC) for size in sizes]
+
+    for name, (batch_size, aspect_edges, size_edges) in BUCKET_CONFIGS.items():
+        def run():
+            scheduler = BucketScheduler(batch_size, aspect_edges, size_edges)
+            batches = [batch for batch in (scheduler.add(i, image.shape) for i, image in enumerate(images))
+                       if batch is not None]
+            batches += list(scheduler.flush())
+            for batch in batches:
+                unwarp_batch([images[i] for i in batch], torch.cat([bm] * len(batch)))
+            return scheduler
+        result = bench('buckets/{}'.format(name), run, memory=True)
+        if result is not None:
+            stats = run().stats()
+            result['images_per_s'] = len(images) / result['median']
+            result['padding_waste'] = stats['total']['padding_waste']
+            result['buckets'] = stats
+            print("{:<45s} {:.2f} images/s, padding waste {:.1%}".format('', result['images_per_s'],
+                                                                          result['padding_waste']))
+
+
+def legacy_prepare_input(img):
+    """RGB 256x256 image to the network input as infer.py did before the single float32 conversion"""
+    img = img[:, :, ::-1]
+    img = img.astype(float) / 255.0
+    img = img.transpose(2, 0, 1)
+    img = np.expand_dims(img, 0)
+    return torch.from_numpy(img).float()
+
+
+def legacy_unwarp_torch(img, bm):
+    """unwarping.unwarp_torch before the float32 and uint8 output rework, float64 in [0,1]"""
+    w, h = img.shape[0], img.shape[1]
+    bm = bm.transpose(1, 2).transpose(2, 3).detach().cpu().numpy()[0, :, :, :]
+    bm0 = cv2.resize(cv2.blur(bm[:, :, 0], (3, 3)), (h, w))
+    bm1 = cv2.resize(cv2.blur(bm[:, :, 1], (3, 3)), (h, w))
+    bm = torch.from_numpy(np.expand_dims(np.stack([bm0, bm1], axis=-1), 0)).double()
+    img = torch.from_numpy(np.expand_dims((img.astype(float) / 255.0).transpose((2, 0, 1)), 0)).double()
+    res = F.grid_sample(input=img, grid=bm, align_corners=True)
+    return res[0].numpy().transpose((1, 2, 0))
+
+
+# bytes per pixel the current data path may allocate through numpy: the float32 CHW copy of the image,
+# the float32 grid and the uint8 output (grid_sample's output is a torch allocation, not traced)
+COPY_BYTES_PER_PIXEL = 3 * 4 + 2 * 4 + 3
+
+
+def bench_copies(args, bench):
+    """Memory of the per image data path (network input, torch unwarp, image to write) on a photo,
+       as it was (legacy) and with one float32 conversion and a uint8 output; 'ok' of the current one is
+       whether its traced peak is within COPY_BYTES_PER_PIXEL (10% and 1 MB slack) and below the legacy one
+    """
+    w, h = (int(v) for v in args.photo_size.split('x'))
+    img, bm = synthetic_bm()
+    img = cv2.resize(img, (w, h), interpolation=cv2.INTER_CUBIC)
+
+    def legacy():
+        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        legacy_prepare_input(cv2.resize(rgb, (256, 256)))
+        return legacy_unwarp_torch(rgb, bm)[:, :, ::-1] * 255
+
+    def current():
+        infer.prepare_input(network_input(img)[0])
+        return unwarp_torch(img, bm)
+
+    legacy_result = bench('copies/legacy/{}'.format(args.photo_size), legacy, memory=True, traced=True)
+    result = bench('copies/current/{}'.format(args.photo_size), current, memory=True, traced=True)
+    if result is None:
+        return
+    result['bound_mb'] = (w * h * COPY_BYTES_PER_PIXEL * 1.1) / (1024.0 * 1024.0) + 1
+    result['ok'] = result['traced_peak_mb'] <= result['bound_mb']
+    if legacy_result is not None:
+        result['ok'] = result['ok'] and result['traced_peak_mb'] < legacy_result['traced_peak_mb']
+    print("{:<45s} bound {:.1f} MB{}".format('', result['bound_mb'], '' if result['ok'] else ' FAILED'))
+
+
+def bench_evaluate(bench):
+    """MS-SSIM and Local Distortion of one page pair at the evaluation size, the rectified page being the
+       reference shifted by a few pixels
+    """
+    img, _ = synthetic_bm()
+    ref = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    ref = cv2.resize(ref, eval_size(ref.shape, EVAL_AREA), interpolation=cv2.INTER_CUBIC)
+    rec = cv2.warpAffine(ref, np.float32([[1, 0, 3], [0, 1, 2]]), (ref.shape[1], ref.shape[0]),
+                         borderMode=cv2.BORDER_REFLECT)
+    for flow in ('farneback', 'dis') if hasattr(cv2, 'DISOpticalFlow_create') else ('farneback',):
+        bench('evaluate/page_metrics/{}'.format(flow), lambda: page_metrics(ref, rec, flow))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks')
+    parser.add_argument('--out', nargs='?', type=str, default='bench.json',
+                        help='Path of the json results')
+    parser.add_argument('--filter', nargs='*', type=str, default=[],
+                        help='Only run benchmarks whose name contains one of these; the loader/ and infer/ '
+                             'suites, and the synthetic dataset they read, need a filter that starts with their '
+                             'name or a prefix of it')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 4],
+                        help='Batch sizes of the model and loss benchmarks')
+    parser.add_argument('--repeat', nargs='?', type=int, default=10,
+                        help='Timed calls per benchmark')
+    parser.add_argument('--warmup', nargs='?', type=int, default=2,
+                        help='Untimed calls before the timed ones')
+    parser.add_argument('--device', nargs='?', type=str, default='cpu',
+                        help='Device of the model and loss benchmarks')
+    parser.add_argument('--threads', nargs='?', type=int, default=0,
+                        help='torch threads, 0 keeps the default')
+    parser.add_argument('--n_samples', nargs='?', type=int, default=8,
+                        help='# of synthetic training samples')
+    parser.add_argument('--photo_size', nargs='?', type=str, default='1600x1200',
+                        help='WxH of the large end-to-end inference input')
+    parser.add_argument('--unwarp_size', nargs='?', type=str, default='4000x3000',
+                        help='WxH of the unwarp benchmarks')
+    parser.add_argument('--data_path', nargs='?', type=str, default=None,
+                        help='Synthetic dataset to reuse, generated into a temporary directory if not given')
+    args = parser.parse_args(argv)
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    results = OrderedDict()
+
+    def selected(name):
+        return not args.filter or any(f in name for f in args.filter)
+
+    def suite_selected(prefix):
+        # whether a filter may select a benchmark of the suite named prefix, e.g. 'loader' or 'loader/doc3dwc'
+        return not args.filter or any(prefix.startswith(f) or f.startswith(prefix) for f in args.filter)
+
+    def bench(name, fn, bench_device=None, memory=False, traced=False):
+        if not selected(name):
+            return
+        results[name] = timeit(fn, repeat=args.repeat, warmup=args.warmup, device=bench_device)
+        print("{:<45s} median {:9.3f} ms  (min {:9.3f} ms)".format(name, results[name]['median'] * 1e3,
+                                                                 results[name]['min'] * 1e3))
+        if memory:
+            results[name]['peak_rss_delta_mb'] = peak_rss_delta_mb(fn)
+            print("{:<45s} peak rss +{} MB".format('', results[name]['peak_rss_delta_mb']))
+        if traced:
+            results[name]['traced_peak_mb'] = traced_peak_mb(fn)
+            print("{:<45s} traced peak {:.1f} MB".format('', results[name]['traced_peak_mb']))
+        return results[name]
+
+    tmp_dir = tempfile.mkdtemp(prefix='dewarpnet_bench_')
+    try:
+        # the synthetic dataset only for the suites that read it
+        root = args.data_path
+        if root is None and (suite_selected('loader/') or suite_selected('infer/')):
+            root = os.path.join(tmp_dir, 'doc3d')
+            make_doc3d(root, n_train=args.n_samples, n_val=max(1, args.n_samples // 2))
+        if suite_selected('loader/'):
+            bench_loaders(root, args, bench)
+        bench_models(args, bench, device)
+        bench_losses(args, bench, device)
+        if suite_selected('infer/'):
+            bench_infer(root, tmp_dir, args, bench)
+        bench_unwarp(args, bench)
+        bench_copies(args, bench)
+        bench_evaluate(bench)
+        bench_buckets(bench)
+        parity = unwarp_parity() if selected('unwarp/parity') else None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report = {'env': environment(args),
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+              'unwarp_parity': parity,
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Saved {}".format(args.out))
+    failed = ['unwarp/parity/' + name for name, p in (parity or {}).items() if not p['ok']]
+    failed += [name for name, result in results.items() if result.get('ok') is False]
+    if failed:
+        raise AssertionError('Out of tolerance: {}'.format(', '.join(failed)))
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# synthetic Doc3D shaped dataset for the benchmarks
+# every sample is a smoothly curved page with consistent
+#   img/<folder>/<name>.png                          448x448 RGB render
+#   wc/<folder>/<name>.exr                           448x448x3 float32 world coordinates (z, y, x), 0 on the background
+#   bm/<folder>/<name>.mat                           448x448x2 backward map in pixels of the render
+#   recon/<folder>/chess48/<name[:-4]>chess480001.png   albedo render
+# and train.txt/val.txt split files
+import os
+from os.path import join as pjoin
+import numpy as np
+import cv2
+import hdf5storage as h5
+
+
+def chessboard(size=448, squares=8):
+    """Flat page texture: chessboard with dark text-like lines"""
+    idx = np.arange(size) * squares // size
+    tex = ((idx[:, None] + idx[None, :]) % 2).astype(np.float32)
+    tex = 0.35 + 0.6 * tex
+    tex[(np.arange(size) % 12) < 2, size // 10:-size // 10] *= 0.3
+    return np.stack([tex * 0.95, tex * 0.9, tex * 0.85], axis=-1)
+
+
+def _displacement(u, v, amp, phase):
+    dx = amp[0] * np.sin(np.pi * v + phase[0]) * np.sin(np.pi * u)
+    dy = amp[1] * np.sin(np.pi * u + phase[1]) * np.sin(np.pi * v)
+    return dx, dy
+
+
+def synthetic_page(size=448, rng=None, tex=None):
+    """One curved page
+       :returns img, alb (uint8 RGB), wc (float32 z,y,x), bm (float32 x,y pixels)
+    """
+    rng = np.random.RandomState(0) if rng is None else rng
+    tex = chessboard(size) if tex is None else tex
+    margin = rng.randint(size // 12, size // 6)
+    extent = float(size - 2 * margin)
+    amp = rng.uniform(0.02, 0.06, 2)
+    phase = rng.uniform(0, np.pi, 2)
+
+    # page coordinates (u, v) of every image pixel, inverting the displacement by fixed point iteration
+    ys, xs = np.mgrid[0:size, 0:size].astype(np.float64)
+    s = (xs - margin) / extent
+    t = (ys - margin) / extent
+    u, v = s.copy(), t.copy()
+    for _ in range(10):
+        dx, dy = _displacement(u, v, amp, phase)
+        u, v = s - dx, t - dy
+    msk = (u >= 0) & (u <= 1) & (v >= 0) & (v <= 1)
+
+    bend = 0.1 + 0.3 * np.sin(np.pi * u) * np.sin(np.pi * v + phase[0])
+    wc = np.stack([bend, 2.2 * v - 1.1, 2.2 * u - 1.1], axis=-1).astype(np.float32)
+    wc[wc == 0] = 1e-6
+    wc[~msk] = 0
+
+    map_x = (u * (tex.shape[1] - 1)).astype(np.float32)
+    map_y = (v * (tex.shape[0] - 1)).astype(np.float32)
+    alb = cv2.remap(tex, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    alb[~msk] = 0
+    shading = 0.65 + 0.35 * np.clip(bend / 0.4, 0, 1)[..., None]
+    background = rng.uniform(0.1, 0.5, 3) + rng.normal(0, 0.03, (size, size, 3))
+    img = np.where(msk[..., None], alb * shading, background)
+
+    # backward map: for every pixel of the flat page its position in the render
+    fv, fu = np.mgrid[0:size, 0:size].astype(np.float64) / (size - 1)
+    dx, dy = _displacement(fu, fv, amp, phase)
+    bm = np.stack([margin + extent * (fu + dx), margin + extent * (fv + dy)], axis=-1).astype(np.float32)
+
+    to_uint8 = lambda a: (np.clip(a, 0, 1) * 255).round().astype(np.uint8)
+    return to_uint8(img), to_uint8(alb), wc, bm
+
+
+def make_doc3d(root, n_train=8, n_val=4, size=448, seed=0):
+    """Writes a synthetic dataset to root, returns the sample names"""
+    rng = np.random.RandomState(seed)
+    tex = chessboard(size)
+    names = []
+    for k in range(n_train + n_val):
+        folder, fname = '1', 'bench_{:04d}0001'.format(k)
+        img, alb, wc, bm = synthetic_page(size, rng, tex)
+        for sub in ('img', 'wc', 'bm', pjoin('recon', folder, 'chess48')):
+            os.makedirs(pjoin(root, sub, folder) if sub in ('img', 'wc', 'bm') else pjoin(root, sub), exist_ok=True)
+        cv2.imwrite(pjoin(root, 'img', folder, fname + '.png'), img[:, :, ::-1])
+        cv2.imwrite(pjoin(root, 'wc', folder, fname + '.exr'), wc)
+        h5.savemat(pjoin(root, 'bm', folder, fname + '.mat'), {'bm': bm})
+        cv2.imwrite(pjoin(root, 'recon', folder, 'chess48', fname[:-4] + 'chess480001.png'), alb[:, :, ::-1])
+        names.append(folder + '/' + fname)
+    with open(pjoin(root, 'train.txt'), 'w') as f:
+        f.write('\n'.join(names[:n_train]) + '\n')
+    with open(pjoin(root, 'val.txt'), 'w') as f:
+        f.write('\n'.join(names[n_train:]) + '\n')
+    return names
@@ -0,0 +1,105 @@
+'''
+Content addressed cache of the backward maps predicted by the networks, so a page that is submitted again
+(retries, duplicates, other output sizes) goes straight to the unwarp
+    cache = BMCache('./bm_cache', model_version(wc_model_path, bm_model_path))
+    key = cache.key(img)            # uint8 256x256 network input
+    bm = cache.get(key)             # (1,2,128,128) float32 or None
+    cache.put(key, bm)
+Maps are kept as float16 .npy files (64KB) under <cache_dir>/<key[:2]>/<key>.npy,
+with an in-memory LRU of the most recently used ones in front.
+'''
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def model_version(*paths):
+    """sha1 of the contents of the model files, changes with every retrained or converted model"""
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class BMCache(object):
+    """
+    :param cache_dir directory of the .npy files, None for a memory only cache
+    :param version model version the cached maps belong to, part of every key
+    :param max_items size of the in-memory LRU
+    Thread safe; hits, disk hits and misses are counted in stats().
+    """
+    def __init__(self, cache_dir, version, max_items=256):
+        self.cache_dir = cache_dir
+        self.version = version
+        self.max_items = max_items
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, inp):
+        """Key of a network input (any array), by its bytes, shape and dtype and the model version"""
+        inp = np.ascontiguousarray(inp)
+        h = hashlib.sha1(self.version.encode())
+        h.update('{}{}'.format(inp.shape, inp.dtype).encode())
+        h.update(inp.data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def _remember(self, key, bm):
+        self.lru[key] = bm
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.max_items:
+            self.lru.popitem(last=False)
+
+    def get(self, key):
+        """Cached map of key as float32 numpy array, None if it was never put"""
+        with self.lock:
+            bm = self.lru.get(key)
+            if bm is not None:
+                self.lru.move_to_end(key)
+                self.hits += 1
+                return bm.astype(np.float32)
+        if self.cache_dir is not None:
+            try:
+                bm = np.load(self._path(key))
+            except (IOError, OSError, ValueError):
+                bm = None
+        with self.lock:
+            if bm is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, bm)
+        return bm.astype(np.float32)
+
+    def put(self, key, bm):
+        """Caches a predicted map (numpy array)"""
+        bm = np.asarray(bm, dtype=np.float16)
+        with self.lock:
+            self._remember(key, bm)
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file and renamed, readers never see a partial map
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, bm)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return OrderedDict([('lookups', lookups), ('hits', self.hits), ('disk_hits', self.disk_hits),
+                            ('misses', self.misses),
+                            ('hit_rate', (self.hits + self.disk_hits) / float(lookups) if lookups else 0.0),
+                            ('memory_items', len(self.lru))])
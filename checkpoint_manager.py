@@ -0,0 +1,180 @@
+'''
+Checkpoint manager for the training scripts
+Checkpoints hold the complete training state, are written atomically in a
+background thread and indexed in <logdir>/<prefix>_checkpoints.json, which
+points to the latest checkpoint and keeps the top-K by validation metric.
+'''
+import os
+import json
+import inspect
+import random
+import threading
+import numpy as np
+import torch
+
+
+def rng_state():
+    """States of the python, numpy, torch and cuda random generators, as tensors and plain lists of
+       numbers so checkpoints load with torch.load(weights_only=True)
+    """
+    version, internal, gauss = random.getstate()
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'python': [version, list(internal), gauss],
+             'numpy': [name, [int(k) for k in keys], int(pos), int(has_gauss), float(cached_gaussian)],
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    version, internal, gauss = state['python']
+    random.setstate((version, tuple(internal), gauss))
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def to_cpu(obj):
+    """Copies all tensors of a (nested) state to cpu, so training can go on while it is written;
+       numpy scalars become python numbers, which torch.load(weights_only=True) accepts
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file which is renamed to path once it is on disk,
+       an interrupted save never leaves a truncated checkpoint behind
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """torch.load of a checkpoint restricted to tensors and plain containers (weights_only) where torch
+       supports it, which every checkpoint of the manager and the released models are
+    """
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=True)
+    return torch.load(path, map_location=map_location)
+
+
+def atomic_write_json(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def resolve_checkpoint(path):
+    """Checkpoint file to resume from
+       :param path is a checkpoint file or a logdir containing a *_checkpoints.json index
+       :returns the latest checkpoint of the index, path itself, or None if nothing is found
+    """
+    if os.path.isfile(path):
+        return path
+    if os.path.isdir(path):
+        indices = [f for f in os.listdir(path) if f.endswith('_checkpoints.json')]
+        indices.sort(key=lambda f: os.path.getmtime(os.path.join(path, f)))
+        if indices:
+            with open(os.path.join(path, indices[-1]), 'r') as f:
+                latest = json.load(f)['latest']
+            if latest is not None and os.path.isfile(os.path.join(path, latest)):
+                return os.path.join(path, latest)
+    return None
+
+
+class CheckpointManager(object):
+    """
+    Saves <logdir>/<prefix>_<epoch>.pkl and keeps the latest and the keep_best best ones
+    :param mode 'min' if a lower metric is better, 'max' otherwise
+    :param background writes checkpoints in a thread, only the copy to cpu blocks training
+    """
+    def __init__(self, logdir, prefix, keep_best=3, mode='min', background=True):
+        self.logdir = logdir
+        self.prefix = prefix
+        self.keep_best = keep_best
+        self.mode = mode
+        self.background = background
+        self.index_path = os.path.join(logdir, prefix + '_checkpoints.json')
+        self.index = {'latest': None, 'best': []}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        self._thread = None
+        self._error = None
+
+    def save(self, state, epoch, metric=None, exports=None):
+        """Saves state as the latest checkpoint and ranks it by metric
+           :param state is the checkpoint dict, tensors may live on the gpu
+           :param metric is the validation metric of the epoch, None if there was no validation
+           :param exports maps file names in logdir to further states written with the checkpoint,
+            e.g. weights only models for infer.py
+        """
+        self.wait()
+        state = to_cpu(state)
+        exports = to_cpu(exports or {})
+        if self.background:
+            self._thread = threading.Thread(target=self._run, args=(state, epoch, metric, exports))
+            self._thread.start()
+        else:
+            self._write(state, epoch, metric, exports)
+
+    def _run(self, state, epoch, metric, exports):
+        try:
+            self._write(state, epoch, metric, exports)
+        except Exception as e:
+            self._error = e
+
+    def _write(self, state, epoch, metric, exports):
+        for export_name, export_state in exports.items():
+            atomic_save(export_state, os.path.join(self.logdir, export_name))
+        fname = '{}_{}.pkl'.format(self.prefix, epoch)
+        atomic_save(state, os.path.join(self.logdir, fname))
+
+        previous = self.index['latest']
+        best = [b for b in self.index['best'] if b['file'] != fname]
+        if metric is not None:
+            best.append({'file': fname, 'epoch': epoch, 'metric': float(metric)})
+            best.sort(key=lambda b: b['metric'], reverse=self.mode == 'max')
+        dropped = best[self.keep_best:]
+        best = best[:self.keep_best]
+        self.index = {'latest': fname, 'best': best}
+        atomic_write_json(self.index, self.index_path)
+
+        # delete checkpoints that are neither the latest nor among the best, after the index moved on
+        keep = set([fname] + [b['file'] for b in best])
+        for old in [previous] + [b['file'] for b in dropped]:
+            if old is not None and old not in keep and os.path.isfile(os.path.join(self.logdir, old)):
+                os.remove(os.path.join(self.logdir, old))
+
+    def wait(self):
+        """Blocks until the pending checkpoint is on disk"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def latest_path(self):
+        return None if self.index['latest'] is None else os.path.join(self.logdir, self.index['latest'])
+
+    def best_path(self):
+        return None if not self.index['best'] else os.path.join(self.logdir, self.index['best'][0]['file'])
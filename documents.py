@@ -0,0 +1,199 @@
+'''
+Rectification of multi-page documents, multi-page TIFFs and image-only PDFs
+    python documents.py --wc_model_path ./eval/models/unetnc_doc3d.pkl --bm_model_path ./eval/models/dnetccnl_doc3d.pkl \
+        --in_path scan.pdf --out_path scan_uw.tif
+Pages are streamed: decoded batch_size at a time, run through the networks as one batch, unwarped in a
+thread pool and appended to the output, so memory stays at a few pages whatever the document length.
+PDFs need PyMuPDF (pip install pymupdf).
+'''
+import os
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import torch
+from PIL import Image, ImageSequence, TiffImagePlugin
+
+from infer import load_models, predict_bm, prepare_input
+from unwarping import get_unwarper, output_size
+from profiling import StageTimer, NULL_TIMER
+
+
+def _import_fitz():
+    try:
+        import fitz
+    except ImportError:
+        raise ImportError('Reading and writing PDFs needs PyMuPDF, install it with pip install pymupdf')
+    return fitz
+
+
+def iter_tiff_pages(path):
+    """RGB uint8 pages of a (multi-page) TIFF or any other image PIL reads, one at a time"""
+    with Image.open(path) as im:
+        for page in ImageSequence.Iterator(im):
+            yield np.asarray(page.convert('RGB'))
+
+
+def iter_pdf_pages(path, dpi=200):
+    """RGB uint8 pages of a PDF rendered at dpi, one at a time"""
+    fitz = _import_fitz()
+    doc = fitz.open(path)
+    try:
+        for page in doc:
+            pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72.0, dpi / 72.0), colorspace=fitz.csRGB, alpha=False)
+            yield np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, 3).copy()
+    finally:
+        doc.close()
+
+
+def iter_pages(path, dpi=200):
+    if os.path.splitext(path)[1].lower() == '.pdf':
+        return iter_pdf_pages(path, dpi)
+    return iter_tiff_pages(path)
+
+
+class TiffPageWriter(object):
+    """Appends pages to a multi-page TIFF as they come"""
+    def __init__(self, path, compression='tiff_deflate', dpi=None):
+        self.writer = TiffImagePlugin.AppendingTiffWriter(path, True)
+        self.params = {'compression': compression}
+        if dpi:
+            self.params['dpi'] = (dpi, dpi)
+
+    def write(self, page):
+        Image.fromarray(page).save(self.writer, format='TIFF', **self.params)
+        self.writer.newFrame()
+
+    def close(self):
+        self.writer.close()
+
+
+class PdfPageWriter(object):
+    """Appends pages to a PDF as jpeg images, only the compressed pages are kept until close"""
+    def __init__(self, path, quality=90, dpi=None):
+        self.fitz = _import_fitz()
+        self.path = path
+        self.quality = quality
+        self.dpi = dpi or 200
+        self.doc = self.fitz.open()
+
+    def write(self, page):
+        ok, jpg = cv2.imencode('.jpg', page[:, :, ::-1], [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        width, height = page.shape[1] * 72.0 / self.dpi, page.shape[0] * 72.0 / self.dpi
+        pdf_page = self.doc.new_page(width=width, height=height)
+        pdf_page.insert_image(self.fitz.Rect(0, 0, width, height), stream=jpg.tobytes())
+
+    def close(self):
+        self.doc.save(self.path, deflate=True)
+        self.doc.close()
+
+
+def page_writer(path, quality=90, dpi=None, compression='tiff_deflate'):
+    if os.path.splitext(path)[1].lower() == '.pdf':
+        return PdfPageWriter(path, quality, dpi)
+    return TiffPageWriter(path, compression, dpi)
+
+
+def _batches(pages, batch_size):
+    batch = []
+    for page in pages:
+        batch.append(page)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rectify_pages(pages, wc_model, bm_model, batch_size=4, pool=None, unwarp='remap', max_output_size=0,
+                  timer=NULL_TIMER):
+    """Generator of the rectified pages (uint8 RGB), in order
+       :param pages iterator of RGB uint8 pages
+       :param pool executor of the unwarps, the batch after is decoded and run through the networks meanwhile
+    """
+    unwarper = get_unwarper(unwarp)
+
+    def unwarp_page(page, bm):
+        out_size = output_size(page.shape, max_output_size)
+        return unwarper(page, bm, NULL_TIMER, out_size)
+
+    pending = deque()
+    for batch in _batches(pages, batch_size):
+        with timer.stage('resize'):
+            images = torch.cat([prepare_input(cv2.resize(page, (256, 256), interpolation=cv2.INTER_AREA), swap_rb=True) for page in batch])
+        outputs_bm = predict_bm(images, wc_model, bm_model, timer).cpu()
+        if pool is None:
+            with timer.stage('unwarp'):
+                for i, page in enumerate(batch):
+                    yield unwarp_page(page, outputs_bm[i:i + 1])
+            continue
+        pending.append([pool.submit(unwarp_page, page, outputs_bm[i:i + 1]) for i, page in enumerate(batch)])
+        # at most two batches of pages in memory, the one unwarped and the one run through the networks
+        while len(pending) > 1:
+            with timer.stage('unwarp'):
+                for future in pending.popleft():
+                    yield future.result()
+    while pending:
+        with timer.stage('unwarp'):
+            for future in pending.popleft():
+                yield future.result()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Params')
+    parser.add_argument('--wc_model_path', nargs='?', type=str, default='',
+                        help='Path to the saved wc model or weights file')
+    parser.add_argument('--bm_model_path', nargs='?', type=str, default='',
+                        help='Path to the saved bm model or weights file')
+    parser.add_argument('--in_path', nargs='?', type=str, default='',
+                        help='Multi-page .tif or image-only .pdf to rectify')
+    parser.add_argument('--out_path', nargs='?', type=str, default='',
+                        help='Multi-page .tif or .pdf of the rectified pages')
+    parser.add_argument('--batch_size', nargs='?', type=int, default=4,
+                        help='Pages per network batch')
+    parser.add_argument('--workers', nargs='?', type=int, default=4,
+                        help='Threads unwarping pages in parallel, 0 unwarps in the main thread')
+    parser.add_argument('--unwarp', nargs='?', type=str, default='remap', choices=['torch', 'remap', 'mesh'],
+                        help='Unwarp backend, see unwarping.py')
+    parser.add_argument('--dpi', nargs='?', type=int, default=200,
+                        help='Resolution PDF pages are rendered at and the output is tagged with')
+    parser.add_argument('--max_output_size', nargs='?', type=int, default=0,
+                        help='Longer side of the output pages at most, 0 for the input size')
+    parser.add_argument('--quality', nargs='?', type=int, default=90,
+                        help='jpeg quality of the pages of an output PDF')
+    parser.add_argument('--compression', nargs='?', type=str, default='tiff_deflate',
+                        help='Compression of an output TIFF (PIL name, e.g. tiff_deflate, tiff_lzw, jpeg, raw)')
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const='profile.json',
+                        help='Save the per page latency of every stage to this .json or .csv')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    timer = StageTimer(cuda_sync=True) if args.profile else NULL_TIMER
+    wc_model, bm_model = load_models(args)
+    pages = iter_pages(args.in_path, args.dpi)
+    writer = page_writer(args.out_path, args.quality, args.dpi, args.compression)
+    pool = ThreadPoolExecutor(args.workers) if args.workers > 0 else None
+    start = time.time()
+    n_pages = 0
+    try:
+        for page in rectify_pages(pages, wc_model, bm_model, args.batch_size, pool, args.unwarp,
+                                  args.max_output_size, timer):
+            with timer.stage('write'):
+                writer.write(page)
+            timer.end_item(n_pages)
+            n_pages += 1
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.shutdown()
+    elapsed = time.time() - start
+    print("{} pages in {:.1f}s ({:.2f} pages/s), saved {}".format(n_pages, elapsed, n_pages / max(elapsed, 1e-6),
+                                                                  args.out_path))
+    if args.profile:
+        print(timer.report())
+        timer.save(args.profile)
+        print("Saved profile to {}".format(args.profile))
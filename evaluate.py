@@ -0,0 +1,240 @@
+'''
+Quality of rectified pages against their reference scans, with the DocUNet benchmark metrics
+    python evaluate.py --rec_path ./eval/uw/ --ref_path ./data/docunet/scan/ --out eval.json
+The reference scans are not part of the repo, download them with the DocUNet benchmark (see the README).
+- MS-SSIM (pytorch_ssim.ms_ssim), higher is better
+- Local Distortion (LD), the mean length in pixels of a dense optical flow from the reference to the rectified
+  page (Farneback, or DIS), lower is better; DocUNet uses SIFT flow, so the values are close but not equal
+Both on grayscale pages resized to 598400 pixels at the aspect ratio of the reference. The rectified page
+<stem>.png is compared to the reference <stem>.png, or <prefix>.png for <prefix>_<n>.png (e.g. 1_1 copy.png to 1.png).
+Pairs are streamed to worker processes that read their own images, so memory stays at a few pairs per worker
+whatever the size of the set. Per image results are cached in a .jsonl next to the output and reused while the
+sizes and mtimes of both files and the settings are the same.
+'''
+import os
+import json
+import time
+import argparse
+from collections import OrderedDict
+from multiprocessing import Pool
+import numpy as np
+import cv2
+import torch
+
+import pytorch_ssim
+from jobs import IMG_EXTENSIONS, scan_inputs
+
+EVAL_AREA = 598400
+FLOWS = ('farneback', 'dis')
+
+
+def eval_size(shape, area=EVAL_AREA):
+    """(width, height) of an image of shape scaled to area pixels"""
+    scale = np.sqrt(area / float(shape[0] * shape[1]))
+    return max(1, int(round(shape[1] * scale))), max(1, int(round(shape[0] * scale)))
+
+
+def read_gray(path, size):
+    """Grayscale uint8 image of path resized to size (width, height), INTER_AREA when shrinking"""
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise IOError('Cannot read image {}'.format(path))
+    shrink = size[0] * size[1] < img.shape[0] * img.shape[1]
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA if shrink else cv2.INTER_CUBIC)
+
+
+def dense_flow(ref, rec, method='farneback'):
+    """(h,w,2) flow from ref to rec, both uint8 grayscale of the same size"""
+    if method == 'dis':
+        if not hasattr(cv2, 'DISOpticalFlow_create'):
+            raise ImportError('DIS optical flow needs OpenCV 4 (or a 3.4 build with it), use --flow farneback')
+        return cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM).calc(ref, rec, None)
+    # 6 pyramid levels with a wide window follow the displacements of tens of pixels of a poor rectification
+    return cv2.calcOpticalFlowFarneback(ref, rec, None, 0.5, 6, 25, 5, 7, 1.5, cv2.OPTFLOW_FARNEBACK_GAUSSIAN)
+
+
+def local_distortion(ref, rec, method='farneback'):
+    flow = dense_flow(ref, rec, method)
+    return float(np.sqrt(flow[:, :, 0] ** 2 + flow[:, :, 1] ** 2).mean())
+
+
+def page_metrics(ref, rec, flow='farneback'):
+    """MS-SSIM and Local Distortion of two uint8 grayscale pages of the same size"""
+    ref_t = torch.from_numpy(ref).float().div_(255)[None, None]
+    rec_t = torch.from_numpy(rec).float().div_(255)[None, None]
+    with torch.no_grad():
+        ms_ssim = float(pytorch_ssim.ms_ssim(rec_t, ref_t))
+    return OrderedDict([('ms_ssim', ms_ssim), ('ld', local_distortion(ref, rec, flow))])
+
+
+def pair_metrics(job):
+    """Metrics of one (key, rec_path, ref_path, flow) job, run in a worker process"""
+    key, rec_path, ref_path, flow = job
+    start = time.time()
+    try:
+        ref = cv2.imread(ref_path, cv2.IMREAD_GRAYSCALE)
+        if ref is None:
+            raise IOError('Cannot read image {}'.format(ref_path))
+        size = eval_size(ref.shape)
+        ref = cv2.resize(ref, size, interpolation=cv2.INTER_AREA)
+        result = page_metrics(ref, read_gray(rec_path, size), flow)
+    except Exception as e:
+        return key, OrderedDict([('error', repr(e))])
+    result['seconds'] = time.time() - start
+    return key, result
+
+
+def _init_worker():
+    # one thread each, the parallelism is across pairs
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+
+
+def reference_for(rec_name, refs):
+    """Reference file name of a rectified page among refs (stem to file name), None if there is none"""
+    stem = os.path.splitext(rec_name)[0]
+    if stem in refs:
+        return refs[stem]
+    prefix = stem.split('_')[0]
+    return refs.get(prefix)
+
+
+def pair_inputs(rec_root, ref_root, recursive=True):
+    """(rec path relative to rec_root, ref path relative to ref_root, rec size, rec mtime_ns) of every rectified
+       page with a reference, the reference is looked up in the same subdirectory
+    """
+    refs = {}
+    for rel_path, _, _ in scan_inputs(ref_root, IMG_EXTENSIONS, recursive):
+        directory, name = os.path.split(rel_path)
+        refs.setdefault(directory, {})[os.path.splitext(name)[0]] = rel_path
+    for rel_path, size, mtime_ns in scan_inputs(rec_root, IMG_EXTENSIONS, recursive):
+        directory, name = os.path.split(rel_path)
+        ref_path = reference_for(name, refs.get(directory, {}))
+        if ref_path is None:
+            print("No reference for {}".format(rel_path))
+            continue
+        yield rel_path, ref_path, size, mtime_ns
+
+
+class ResultCache(object):
+    """
+    Per image metrics in a .jsonl file, one record appended per image, keyed by the pair and the settings
+    """
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line, object_pairs_hook=OrderedDict)
+                    except ValueError:
+                        # a record cut short by a crash
+                        continue
+                    self.results[record['key']] = record['result']
+        self.f = open(path, 'a') if path is not None else None
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def put(self, key, result):
+        self.results[key] = result
+        if self.f is not None:
+            self.f.write(json.dumps(OrderedDict([('key', key), ('result', result)])) + '\n')
+            self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+def pair_key(ref_root, rec_path, ref_path, rec_size, rec_mtime_ns, flow):
+    st = os.stat(os.path.join(ref_root, ref_path))
+    return '{}|{}|{}|{}|{}|{}|{}'.format(rec_path, ref_path, rec_size, rec_mtime_ns, st.st_size, st.st_mtime_ns, flow)
+
+
+def evaluate(rec_root, ref_root, cache, flow='farneback', workers=4, recursive=True):
+    """Generator of (rec path, ref path, metrics) of every rectified page with a reference, cached results
+       first, the others in completion order
+    """
+    jobs = []
+    pairs = {}
+    for rec_path, ref_path, size, mtime_ns in pair_inputs(rec_root, ref_root, recursive):
+        key = pair_key(ref_root, rec_path, ref_path, size, mtime_ns, flow)
+        result = cache.get(key)
+        if result is not None and 'error' not in result:
+            yield rec_path, ref_path, result
+            continue
+        jobs.append((key, os.path.join(rec_root, rec_path), os.path.join(ref_root, ref_path), flow))
+        pairs[key] = (rec_path, ref_path)
+
+    if workers <= 0:
+        for job in jobs:
+            key, result = pair_metrics(job)
+            cache.put(key, result)
+            yield pairs[key] + (result,)
+        return
+    pool = Pool(workers, initializer=_init_worker)
+    try:
+        for key, result in pool.imap_unordered(pair_metrics, jobs):
+            cache.put(key, result)
+            yield pairs[key] + (result,)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def summarize(results):
+    """Mean MS-SSIM and LD over the pages without errors, with the count of each"""
+    ok = [r for r in results if 'error' not in r]
+    summary = OrderedDict([('pages', len(ok)), ('errors', len(results) - len(ok))])
+    for metric in ('ms_ssim', 'ld'):
+        values = np.array([r[metric] for r in ok], dtype=np.float64)
+        summary[metric] = float(values.mean()) if len(values) else None
+        summary[metric + '_std'] = float(values.std()) if len(values) else None
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Params')
+    parser.add_argument('--rec_path', nargs='?', type=str, default='./eval/uw/',
+                        help='Directory of the rectified pages')
+    parser.add_argument('--ref_path', type=str, required=True,
+                        help='Directory of the reference scans (the DocUNet benchmark scans, not shipped with the repo)')
+    parser.add_argument('--out', nargs='?', type=str, default='eval.json',
+                        help='Summary and per image metrics (.json)')
+    parser.add_argument('--cache', nargs='?', type=str, default=None,
+                        help='Per image results cache (.jsonl), <out>.cache.jsonl by default, "none" for no cache')
+    parser.add_argument('--flow', nargs='?', type=str, default='farneback', choices=FLOWS,
+                        help='Dense optical flow of the Local Distortion')
+    parser.add_argument('--workers', nargs='?', type=int, default=4,
+                        help='Worker processes computing the metrics, 0 computes them in the main process')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='Pair the pages of the subdirectories too (same subdirectory in both trees)')
+    parser.set_defaults(recursive=False)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cache_path = args.cache or os.path.splitext(args.out)[0] + '.cache.jsonl'
+    cache = ResultCache(None if cache_path == 'none' else cache_path)
+    start = time.time()
+    per_image = OrderedDict()
+    try:
+        for rec_path, ref_path, result in evaluate(args.rec_path, args.ref_path, cache, args.flow, args.workers,
+                                                   args.recursive):
+            per_image[rec_path] = OrderedDict([('ref', ref_path)] + list(result.items()))
+            if 'error' in result:
+                print("Failed {}: {}".format(rec_path, result['error']))
+    finally:
+        cache.close()
+    elapsed = time.time() - start
+    summary = summarize(list(per_image.values()))
+    summary['flow'] = args.flow
+    summary['seconds'] = elapsed
+    print("{} pages in {:.1f}s: MS-SSIM {} LD {}".format(summary['pages'], elapsed, summary['ms_ssim'], summary['ld']))
+    with open(args.out, 'w') as f:
+        json.dump(OrderedDict([('summary', summary),
+                               ('images', OrderedDict(sorted(per_image.items())))]), f, indent=2)
+    print("Saved {}".format(args.out))
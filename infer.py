@@ -2,6 +2,7 @@
 import sys, os
 import torch
 import argparse
+from collections import namedtuple
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
@@ -15,34 +16,50 @@ import matplotlib.pyplot as plt
 
 from models import get_model
 # from loaders import get_loader
-from utils import convert_state_dict
+from weights import load_state, assign_weights
+from utils import to_chw
+from unwarping import get_unwarper, unwarp_mesh, unwarp_sizes, output_size, estimate_output_size
+from bm_cache import BMCache, model_version
+from preprocess import SourceImage, network_input, unletterbox_bm
+from jobs import JobManifest, scan_inputs, run_jobs
+from profiling import StageTimer, NULL_TIMER, torch_trace
 
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# one output file per spec: size is the longer side in pixels (0 the input size), quality is the
+# jpg/webp quality or the png compression level
+OutputSpec = namedtuple('OutputSpec', ['name', 'size', 'ext', 'quality'])
 
-def unwarp(img, bm):
-    w,h=img.shape[0],img.shape[1]
-    bm = bm.transpose(1, 2).transpose(2, 3).detach().cpu().numpy()[0,:,:,:]
-    bm0=cv2.blur(bm[:,:,0],(3,3))
-    bm1=cv2.blur(bm[:,:,1],(3,3))
-    bm0=cv2.resize(bm0,(h,w))
-    bm1=cv2.resize(bm1,(h,w))
-    bm=np.stack([bm0,bm1],axis=-1)
-    bm=np.expand_dims(bm,0)
-    bm=torch.from_numpy(bm).double()
 
-    img = img.astype(float) / 255.0
-    img = img.transpose((2, 0, 1))
-    img = np.expand_dims(img, 0)
-    img = torch.from_numpy(img).double()
+def parse_output_spec(spec):
+    """name:size:format[:quality], e.g. thumb:256:jpg:80"""
+    parts = spec.split(':')
+    if len(parts) not in (3, 4):
+        raise argparse.ArgumentTypeError('expected name:size:format[:quality], got {}'.format(spec))
+    try:
+        return OutputSpec(parts[0], int(parts[1]), parts[2].lower(), int(parts[3]) if len(parts) == 4 else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError('size and quality of {} must be integers'.format(spec))
 
-    res = F.grid_sample(input=img, grid=bm, align_corners=True)
-    res = res[0].numpy().transpose((1, 2, 0))
 
-    return res
+def imwrite_params(spec):
+    if spec.quality is None:
+        return []
+    return {'jpg': [cv2.IMWRITE_JPEG_QUALITY, spec.quality],
+            'jpeg': [cv2.IMWRITE_JPEG_QUALITY, spec.quality],
+            'webp': [cv2.IMWRITE_WEBP_QUALITY, spec.quality],
+            'png': [cv2.IMWRITE_PNG_COMPRESSION, spec.quality]}.get(spec.ext, [])
 
 
-def test(args,img_path,fname):
+def unwarp(img, bm, timer=NULL_TIMER, backend='torch'):
+    """Unwarps img with the predicted backward map, see unwarping.py for the backends"""
+    return get_unwarper(backend)(img, bm, timer)
+
+
+def load_models(args):
+    """Builds the wc and bm models from training checkpoints or slim weights files (see weights.py),
+       the architecture is the file name up to the first '_'
+    """
     wc_model_file_name = os.path.split(args.wc_model_path)[1]
     wc_model_name = wc_model_file_name[:wc_model_file_name.find('_')]
 
@@ -52,81 +69,232 @@ def test(args,img_path,fname):
     wc_n_classes = 3
     bm_n_classes = 2
 
-    wc_img_size=(256,256)
-    bm_img_size=(128,128)
-
-    # Setup image
-    print("Read Input Image from : {}".format(img_path))
-    imgorg = cv2.imread(img_path)
-    imgorg = cv2.cvtColor(imgorg, cv2.COLOR_BGR2RGB)
-    img = cv2.resize(imgorg, wc_img_size)
-    img = img[:, :, ::-1]
-    img = img.astype(float) / 255.0
-    img = img.transpose(2, 0, 1) # NHWC -> NCHW
-    img = np.expand_dims(img, 0)
-    img = torch.from_numpy(img).float()
-
-    # Predict
-    htan = nn.Hardtanh(0,1.0)
+    # the weights are assigned, not copied, memory mapped weights files stay shared between processes
     wc_model = get_model(wc_model_name, wc_n_classes, in_channels=3)
-    if DEVICE.type == 'cpu':
-        wc_state = convert_state_dict(torch.load(args.wc_model_path, map_location='cpu')['model_state'])
-    else:
-        wc_state = convert_state_dict(torch.load(args.wc_model_path)['model_state'])
-    wc_model.load_state_dict(wc_state)
+    assign_weights(wc_model, load_state(args.wc_model_path))
     wc_model.eval()
     bm_model = get_model(bm_model_name, bm_n_classes, in_channels=3)
-    if DEVICE.type == 'cpu':
-        bm_state = convert_state_dict(torch.load(args.bm_model_path, map_location='cpu')['model_state'])
-    else:
-        bm_state = convert_state_dict(torch.load(args.bm_model_path)['model_state'])
-    bm_model.load_state_dict(bm_state)
+    assign_weights(bm_model, load_state(args.bm_model_path))
     bm_model.eval()
 
     if torch.cuda.is_available():
         wc_model.cuda()
         bm_model.cuda()
-        images = Variable(img.cuda())
+    return wc_model, bm_model
+
+
+def prepare_input(img, swap_rb=False):
+    """(1,3,256,256) network input of a 256x256 BGR uint8 image, converted to float32 once
+       :param swap_rb the image is RGB
+    """
+    return torch.from_numpy(to_chw(img, channels=(2, 1, 0) if swap_rb else None)[None])
+
+
+def predict_bm(images, wc_model, bm_model, timer=NULL_TIMER):
+    """Backward maps (N,2,128,128) of a batch of (N,3,256,256) network inputs"""
+    bm_img_size=(128,128)
+    htan = nn.Hardtanh(0,1.0)
+    if torch.cuda.is_available():
+        images = Variable(images.cuda())
     else:
-        images = Variable(img)
+        images = Variable(images)
 
     with torch.no_grad():
-        wc_outputs = wc_model(images)
-        pred_wc = htan(wc_outputs)
-        bm_input=F.interpolate(pred_wc, bm_img_size)
-        outputs_bm = bm_model(bm_input)
+        with timer.stage('wc_net'):
+            wc_outputs = wc_model(images)
+            pred_wc = htan(wc_outputs)
+        with timer.stage('bm_net'):
+            bm_input=F.interpolate(pred_wc, bm_img_size)
+            outputs_bm = bm_model(bm_input)
+    return outputs_bm
+
+
+def output_paths(args, fname):
+    """Files test writes for the input fname, one per --outputs spec or args.out_path/fname"""
+    if args.outputs:
+        stem=os.path.splitext(fname)[0]
+        return [os.path.join(args.out_path,'{}_{}.{}'.format(stem, spec.name, spec.ext)) for spec in args.outputs]
+    return [os.path.join(args.out_path,fname)]
+
+
+def imwrite(path, img, params=()):
+    """cv2.imwrite raising IOError on failure instead of returning False"""
+    if not cv2.imwrite(path, img, list(params)):
+        raise IOError('Cannot write image {}'.format(path))
+
+
+def test(args,img_path,fname,wc_model=None,bm_model=None,timer=NULL_TIMER,bm_cache=None):
+    """Unwarps img_path to args.out_path/fname
+       :param bm_cache BMCache of the models, repeated inputs skip the networks
+    """
+    if wc_model is None or bm_model is None:
+        wc_model, bm_model = load_models(args)
+
+    wc_img_size=(256,256)
+
+    # Setup image
+    print("Read Input Image from : {}".format(img_path))
+    timer.start_item()
+    # BGR throughout, the network input from a reduced decode where possible, the full resolution image
+    # is only decoded for the unwarp
+    src = SourceImage(img_path)
+    with timer.stage('decode'):
+        img = src.small(min(wc_img_size))
+    with timer.stage('resize'):
+        img, box = network_input(img, wc_img_size, args.letterbox)
+
+    outputs_bm = None
+    if bm_cache is not None:
+        with timer.stage('bm_cache'):
+            cache_key = bm_cache.key(img)
+            outputs_bm = bm_cache.get(cache_key)
+        if outputs_bm is not None:
+            outputs_bm = torch.from_numpy(outputs_bm[None])
+
+    if outputs_bm is None:
+        with timer.stage('resize'):
+            img = prepare_input(img)
+
+        # Predict
+        outputs_bm = predict_bm(img, wc_model, bm_model, timer)
+        if bm_cache is not None:
+            with timer.stage('bm_cache'):
+                bm_cache.put(cache_key, outputs_bm[0].cpu().numpy())
+    outputs_bm = unletterbox_bm(outputs_bm, box, wc_img_size)
+
+    with timer.stage('decode'):
+        imgorg = src.full()
+
+    # output size, the input size unless estimated from the page or limited
+    img_size=(imgorg.shape[1], imgorg.shape[0])
+    out_size=img_size
+    if args.auto_size:
+        with timer.stage('bm_upsample'):
+            out_size=estimate_output_size(outputs_bm, imgorg.shape, args.target_dpi, args.page_width)
+    if args.max_output_size > 0:
+        out_size=output_size(out_size[::-1], args.max_output_size)
 
     # call unwarp
-    uwpred=unwarp(imgorg, outputs_bm)
+    if args.outputs:
+        # every output from the same backward map, the largest is shown
+        spec_sizes=[output_size(out_size[::-1], spec.size) for spec in args.outputs]
+        renders=unwarp_sizes(imgorg, outputs_bm, spec_sizes, args.unwarp, timer, args.tile_rows)
+        uwpred=next(iter(renders.values()))
+    elif out_size != img_size:
+        uwpred=unwarp_sizes(imgorg, outputs_bm, [out_size], args.unwarp, timer, args.tile_rows)[out_size]
+    elif args.unwarp == 'mesh':
+        uwpred=unwarp_mesh(imgorg, outputs_bm, timer, tile_rows=args.tile_rows)
+    else:
+        uwpred=unwarp(imgorg, outputs_bm, timer, args.unwarp)
 
     if args.show:
         f1, axarr1 = plt.subplots(1, 2)
-        axarr1[0].imshow(imgorg)
-        axarr1[1].imshow(uwpred)
+        axarr1[0].imshow(imgorg[:,:,::-1])
+        axarr1[1].imshow(uwpred[:,:,::-1])
         plt.show()
 
     # Save the output
-    outp=os.path.join(args.out_path,fname)
-    cv2.imwrite(outp,uwpred[:,:,::-1]*255)
+    with timer.stage('write'):
+        if args.outputs:
+            for spec, size, outp in zip(args.outputs, spec_sizes, output_paths(args, fname)):
+                imwrite(outp,renders[size],imwrite_params(spec))
+        else:
+            imwrite(output_paths(args, fname)[0],uwpred)
+    timer.end_item(fname, height=imgorg.shape[0], width=imgorg.shape[1])
 
-if __name__ == '__main__':
+def run_config(args):
+    """Models and settings the outputs depend on, for the job manifest"""
+    return ('{} out_path={} unwarp={} outputs={} auto_size={} target_dpi={} page_width={} max_output_size={} '
+            'letterbox={}').format(
+        model_version(args.wc_model_path, args.bm_model_path), os.path.abspath(args.out_path), args.unwarp,
+        args.outputs, args.auto_size, args.target_dpi, args.page_width, args.max_output_size, args.letterbox)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Params')
     parser.add_argument('--wc_model_path', nargs='?', type=str, default='',
-                        help='Path to the saved wc model')
+                        help='Path to the saved wc model or weights file')
     parser.add_argument('--bm_model_path', nargs='?', type=str, default='',
-                        help='Path to the saved bm model')
+                        help='Path to the saved bm model or weights file')
     parser.add_argument('--img_path', nargs='?', type=str, default='./eval/inp/',
                         help='Path of the input image')
     parser.add_argument('--out_path', nargs='?', type=str, default='./eval/uw/',
                         help='Path of the output unwarped image')
     parser.add_argument('--show', dest='show', action='store_true',
                         help='Show the input image and output unwarped')
-    parser.set_defaults(show=False)
-    args = parser.parse_args()
-    for fname in os.listdir(args.img_path):
-        if '.jpg' in fname or '.JPG' in fname or '.png' in fname:
-            img_path=os.path.join( args.img_path,fname)
-            test(args,img_path,fname)
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const='profile.json',
+                        help='Save the per image and p50/p95/p99 latency of every stage to this .json or .csv')
+    parser.add_argument('--profile_trace', nargs='?', type=str, default=None,
+                        help='Save a torch profiler chrome trace of the run to this .json')
+    parser.add_argument('--unwarp', nargs='?', type=str, default='torch', choices=['torch', 'remap', 'mesh'],
+                        help='torch: grid_sample on the full resolution backward map, '
+                             'remap: cv2.remap on the uint8 image with fixed point maps, '
+                             'mesh: cv2.remap with the map interpolated per tile of output rows')
+    parser.add_argument('--tile_rows', nargs='?', type=int, default=256,
+                        help='Output rows per tile of the mesh unwarp')
+    parser.add_argument('--cv_threads', nargs='?', type=int, default=0,
+                        help='OpenCV threads of the remap and mesh unwarp, 0 keeps the default')
+    parser.add_argument('--outputs', nargs='*', type=parse_output_spec, default=[],
+                        help='Output specs name:size:format[:quality] (size: longer side, 0 for the input size), '
+                             'e.g. thumb:256:jpg:80 ocr:2000:png full:0:jpg:95, written as <name>_<spec name>.<format>')
+    parser.add_argument('--auto_size', dest='auto_size', action='store_true',
+                        help='Output at the aspect ratio and resolution of the page estimated from the backward map, '
+                             'instead of the input size')
+    parser.add_argument('--target_dpi', nargs='?', type=int, default=0,
+                        help='With --auto_size, at most this resolution for a page of --page_width inches')
+    parser.add_argument('--page_width', nargs='?', type=float, default=8.27,
+                        help='Width of the pages in inches for --target_dpi, A4 by default')
+    parser.add_argument('--max_output_size', nargs='?', type=int, default=0,
+                        help='Longer side of the output at most, 0 for no limit')
+    parser.add_argument('--letterbox', dest='letterbox', action='store_true',
+                        help='Keep the aspect ratio of the image in the network input, padded with black')
+    parser.add_argument('--bm_cache', nargs='?', type=str, default=None,
+                        help='Directory of the backward map cache, inputs seen before skip the networks')
+    parser.add_argument('--bm_cache_items', nargs='?', type=int, default=256,
+                        help='Backward maps kept in memory in front of the cache directory')
+    parser.add_argument('--recursive', dest='recursive', action='store_true',
+                        help='Process the images in the subdirectories of --img_path too, into the same tree under --out_path')
+    parser.add_argument('--manifest', nargs='?', type=str, default=None,
+                        help='sqlite manifest of the run, inputs done with the same models and settings are skipped '
+                             'on the next one')
+    parser.set_defaults(show=False, auto_size=False, recursive=False, letterbox=False)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.cv_threads > 0:
+        cv2.setNumThreads(args.cv_threads)
+    timer = StageTimer(cuda_sync=True) if args.profile else NULL_TIMER
+    wc_model, bm_model = load_models(args)
+    bm_cache = None
+    if args.bm_cache is not None:
+        bm_cache = BMCache(args.bm_cache, model_version(args.wc_model_path, args.bm_model_path), args.bm_cache_items)
+    with torch_trace(args.profile_trace, use_cuda=True):
+        if args.recursive or args.manifest:
+            # outputs mirror the input tree, the manifest skips what is up to date
+            manifest = JobManifest(args.manifest, run_config(args)) if args.manifest else None
+
+            def run(rel_path):
+                os.makedirs(os.path.dirname(os.path.join(args.out_path, rel_path)), exist_ok=True)
+                test(args,os.path.join(args.img_path,rel_path),rel_path,wc_model,bm_model,timer,bm_cache)
+
+            counts = run_jobs(scan_inputs(args.img_path, recursive=args.recursive), manifest, run,
+                              lambda rel_path: output_paths(args, rel_path))
+            print(', '.join('{} {}'.format(k, v) for k, v in counts.items()))
+            if manifest is not None:
+                manifest.close()
+        else:
+            for fname in os.listdir(args.img_path):
+                if '.jpg' in fname or '.JPG' in fname or '.png' in fname:
+                    img_path=os.path.join( args.img_path,fname)
+                    test(args,img_path,fname,wc_model,bm_model,timer,bm_cache)
+    if bm_cache is not None:
+        print("bm cache: " + ', '.join('{} {}'.format(k, v) for k, v in bm_cache.stats().items()))
+    if args.profile:
+        print(timer.report())
+        timer.save(args.profile)
+        print("Saved profile to {}".format(args.profile))
 
 
 # python infer.py --wc_model_path ./eval/models/unetnc_doc3d.pkl --bm_model_path ./eval/models/dnetccnl_doc3d.pkl --show
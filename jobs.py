@@ -0,0 +1,112 @@
+'''
+Resumable inference runs over directory trees
+    manifest = JobManifest('manifest.sqlite', config)
+    run_jobs(scan_inputs('./eval/inp/'), manifest, lambda rel_path: ...)
+The sqlite manifest keeps the size, mtime, status and time of every input. A re-run skips the inputs that were
+done with the same size, mtime and config and whose outputs exist, at a few stats per file; failed or
+interrupted ones run again.
+'''
+import os
+import time
+import sqlite3
+from collections import OrderedDict
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def scan_inputs(root, extensions=IMG_EXTENSIONS, recursive=True):
+    """(path relative to root, size, mtime_ns) of the files under root with one of the extensions, in
+       sorted order, with a single stat per file (os.scandir)
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        # visited in order, the stack pops the last one first
+        for entry in reversed(entries):
+            if recursive and entry.is_dir():
+                stack.append(entry.path)
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                st = entry.stat()
+                yield os.path.relpath(entry.path, root), st.st_size, st.st_mtime_ns
+
+
+class JobManifest(object):
+    """
+    Status of the inputs of a run in a sqlite database
+    :param config identifies what the outputs were made with (models, settings), a job done with another
+     config is not up to date
+    :param commit_every records are committed in batches, at most that many or commit_seconds worth of
+     them run again after a crash
+    """
+    def __init__(self, path, config='', commit_every=100, commit_seconds=5.0):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                          'config TEXT, status TEXT, seconds REAL, error TEXT, updated REAL)')
+        self.conn.commit()
+        self.config = config
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.uncommitted = 0
+        self.last_commit = time.time()
+
+    def is_done(self, path, size, mtime_ns, outputs=()):
+        """The job was done with the same input and config, and its output files are still there"""
+        if not all(os.path.exists(output) for output in outputs):
+            return False
+        row = self.conn.execute('SELECT size, mtime_ns, config, status FROM jobs WHERE path=?', (path,)).fetchone()
+        return row is not None and tuple(row) == (size, mtime_ns, self.config, 'done')
+
+    def record(self, path, size, mtime_ns, status, seconds=None, error=None):
+        self.conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (path, size, mtime_ns, self.config, status, seconds, error, time.time()))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every or time.time() - self.last_commit > self.commit_seconds:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+        self.last_commit = time.time()
+
+    def counts(self):
+        """Number of jobs per status"""
+        return OrderedDict(self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status ORDER BY status'))
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def run_jobs(entries, manifest, fn, outputs=None):
+    """Calls fn(path) for the (path, size, mtime_ns) entries that are not up to date in the manifest
+       (every entry without one), recording the status and time of each; an exception fails only its job
+       :param outputs function of a path to the files its job writes, a job with one of them missing runs again
+       :returns counts of the done, failed and skipped jobs
+    """
+    counts = OrderedDict([('done', 0), ('failed', 0), ('skipped', 0)])
+    try:
+        for path, size, mtime_ns in entries:
+            if manifest is not None and manifest.is_done(path, size, mtime_ns,
+                                                         outputs(path) if outputs is not None else ()):
+                counts['skipped'] += 1
+                continue
+            start = time.time()
+            try:
+                fn(path)
+            except Exception as e:
+                print("Failed {}: {!r}".format(path, e))
+                counts['failed'] += 1
+                if manifest is not None:
+                    manifest.record(path, size, mtime_ns, 'failed', time.time() - start, repr(e))
+                continue
+            counts['done'] += 1
+            if manifest is not None:
+                manifest.record(path, size, mtime_ns, 'done', time.time() - start)
+    finally:
+        if manifest is not None:
+            manifest.commit()
+    return counts
@@ -2,6 +2,7 @@
 # models are saved in checkpoints-wc/
 
 import os
+import time
 import torch
 import argparse
 import torch.nn as nn
@@ -18,7 +19,11 @@ from tqdm import tqdm
 
 from models import get_model
 from loaders import get_loader
-from utils import show_wc_tnsboard, get_lr, show_unwarp_tnsboard
+from utils import get_lr, MetricAccumulator, TensorboardImageLogger, freeze_bn, reset_peak_memory, peak_memory_mb
+from utils import init_distributed, is_main_process, print_main, parallelize, unwrap_model, convert_state_dict, skip_grad_sync
+from utils import subset_evenly, CachedLoader
+from checkpoint_manager import CheckpointManager, resolve_checkpoint, load_checkpoint, rng_state, set_rng_state
+from profiling import StageTimer, write_timing_log
 import grad_loss
 import recon_lossc
 
@@ -36,58 +41,65 @@ def write_log_file(log_file_name, losses, epoch, lrate, phase, state):
             f.write(
                 "\n{} LRate: {} Epoch: {} State: {} Loss: {} MSE: {}".format(phase,
                                                     lrate, epoch, state, losses[0], losses[1]))
+        elif state == 'perf':
+            f.write(
+                "\n{} LRate: {} Epoch: {} State: {} Samples/s: {} PeakMemMB: {} BatchSize: {} AccumSteps: {}".format(
+                    phase, lrate, epoch, state, losses[0], losses[1], losses[2], losses[3]))
 
 
 
 def train(args):
-    # Setup Dataloader
-    wc_data_loader = get_loader('doc3dwc')
-    data_path = args.data_path
-    wc_t_loader = wc_data_loader(data_path, is_transform=True, img_size=(args.wc_img_rows, args.wc_img_cols),
-                                 augmentations=args.augmentation)
-    wc_v_loader = wc_data_loader(data_path, is_transform=True, split='val',
-                                 img_size=(args.wc_img_rows, args.wc_img_cols))
-
-    wc_n_classes = wc_t_loader.n_classes
-    wc_trainloader = data.DataLoader(wc_t_loader, batch_size=args.batch_size, num_workers=8, shuffle=True)
-    wc_valloader = data.DataLoader(wc_v_loader, batch_size=args.batch_size, num_workers=8)
-
-    # Setup Model
-    model_wc = get_model('unetnc', wc_n_classes, in_channels=3)
-    model_wc = torch.nn.DataParallel(model_wc, device_ids=range(torch.cuda.device_count()))
-    model_wc.cuda()
+    # Setup device, one process per gpu (or cpu) with --distributed
+    device = init_distributed(args)
+    # logs, tensorboard and checkpoints are written by rank 0 only
+    args.tboard = args.tboard and is_main_process()
 
     # Setup Dataloader
-    bm_data_loader = get_loader('doc3dbmnic')
-    bm_t_loader = bm_data_loader(data_path, is_transform=True, img_size=(args.bm_img_rows, args.bm_img_cols))
-    bm_v_loader = bm_data_loader(data_path, is_transform=True, split='val',
-                                 img_size=(args.bm_img_rows, args.bm_img_cols))
-
-    bm_n_classes = bm_t_loader.n_classes
-    bm_trainloader = data.DataLoader(bm_t_loader, batch_size=args.batch_size, num_workers=8, shuffle=True)
-    bm_valloader = data.DataLoader(bm_v_loader, batch_size=args.batch_size, num_workers=8)
+    # one dataset reads every document once and returns both the wc and the bm view
+    data_loader = get_loader('doc3djoint')
+    data_path = args.data_path
+    t_loader = data_loader(data_path, is_transform=True, img_size=(args.wc_img_rows, args.wc_img_cols),
+                           bm_img_size=(args.bm_img_rows, args.bm_img_cols), augmentations=args.augmentation)
+    v_loader = data_loader(data_path, is_transform=True, split='val', img_size=(args.wc_img_rows, args.wc_img_cols),
+                           bm_img_size=(args.bm_img_rows, args.bm_img_cols))
+
+    wc_n_classes = t_loader.n_classes
+    bm_n_classes = t_loader.bm_n_classes
+    v_loader = subset_evenly(v_loader, args.val_subset)
+    train_sampler = data.distributed.DistributedSampler(t_loader) if args.distributed else None
+    val_sampler = data.distributed.DistributedSampler(v_loader, shuffle=False) if args.distributed else None
+    trainloader = data.DataLoader(t_loader, batch_size=args.batch_size, num_workers=8, shuffle=train_sampler is None,
+                                  sampler=train_sampler)
+    valloader = data.DataLoader(v_loader, batch_size=args.batch_size, num_workers=8, sampler=val_sampler)
+    if args.val_cache:
+        # val crops are seeded per sample (sample_rng), it is decoded and transformed once
+        valloader = CachedLoader(valloader)
 
     # Setup Model
-    model_bm = get_model('dnetccnl', bm_n_classes, in_channels=3)
-    model_bm = torch.nn.DataParallel(model_bm, device_ids=range(torch.cuda.device_count()))
-    model_bm.cuda()
-
-    if os.path.isfile(args.shape_net_loc):
-        print("Loading model_wc from checkpoint '{}'".format(args.shape_net_loc))
-        checkpoint = torch.load(args.shape_net_loc)
-        model_wc.load_state_dict(checkpoint['model_state'])
-        print("Loaded checkpoint '{}' (epoch {})".format(args.shape_net_loc, checkpoint['epoch']))
-    else:
-        print("No model_wc checkpoint found at '{}'".format(args.shape_net_loc))
-        exit(1)
-    if os.path.isfile(args.texture_mapping_net_loc):
-        print("Loading model_bm from checkpoint '{}'".format(args.texture_mapping_net_loc))
-        checkpoint = torch.load(args.texture_mapping_net_loc)
-        model_bm.load_state_dict(checkpoint['model_state'])
-        print("Loaded checkpoint '{}' (epoch {})".format(args.texture_mapping_net_loc, checkpoint['epoch']))
-    else:
-        print("No model_bm checkpoint found at '{}'".format(args.texture_mapping_net_loc))
-        exit(1)
+    model_wc = get_model('unetnc', wc_n_classes, in_channels=3, checkpoint=args.wc_checkpoint)
+    model_wc = parallelize(model_wc, device, args.distributed, args.sync_bn)
+
+    model_bm = get_model('dnetccnl', bm_n_classes, in_channels=3, checkpoint=args.bm_checkpoint)
+    model_bm = parallelize(model_bm, device, args.distributed, args.sync_bn)
+
+    # start from the separately trained networks, unless resuming a joint training checkpoint
+    if args.resume is None:
+        if os.path.isfile(args.shape_net_loc):
+            print_main("Loading model_wc from checkpoint '{}'".format(args.shape_net_loc))
+            checkpoint = load_checkpoint(args.shape_net_loc, map_location=device)
+            unwrap_model(model_wc).load_state_dict(convert_state_dict(checkpoint['model_state']))
+            print_main("Loaded checkpoint '{}' (epoch {})".format(args.shape_net_loc, checkpoint['epoch']))
+        else:
+            print_main("No model_wc checkpoint found at '{}'".format(args.shape_net_loc))
+            exit(1)
+        if os.path.isfile(args.texture_mapping_net_loc):
+            print_main("Loading model_bm from checkpoint '{}'".format(args.texture_mapping_net_loc))
+            checkpoint = load_checkpoint(args.texture_mapping_net_loc, map_location=device)
+            unwrap_model(model_bm).load_state_dict(convert_state_dict(checkpoint['model_state']))
+            print_main("Loaded checkpoint '{}' (epoch {})".format(args.texture_mapping_net_loc, checkpoint['epoch']))
+        else:
+            print_main("No model_bm checkpoint found at '{}'".format(args.texture_mapping_net_loc))
+            exit(1)
 
     # Activation
     htan = nn.Hardtanh(0, 1.0)
@@ -106,236 +118,303 @@ def train(args):
     reconst_loss = recon_lossc.Unwarploss()
 
     epoch_start = 0
+    best_val_mse = 99999.0
+    global_step = 0
+    LClambda = 0.2
+    if args.resume is not None:
+        resume_path = resolve_checkpoint(args.resume)
+        if resume_path is None:
+            print_main("No checkpoint found at '{}'".format(args.resume))
+            exit(1)
+        print_main("Loading models and optimizer from checkpoint '{}'".format(resume_path))
+        checkpoint = load_checkpoint(resume_path, map_location=device)
+        unwrap_model(model_wc).load_state_dict(convert_state_dict(checkpoint['wc_model_state']))
+        unwrap_model(model_bm).load_state_dict(convert_state_dict(checkpoint['bm_model_state']))
+        optimizer.load_state_dict(checkpoint['optimizer_state'])
+        sched.load_state_dict(checkpoint['sched_state'])
+        best_val_mse = checkpoint['best_val_mse']
+        global_step = checkpoint['global_step']
+        LClambda = checkpoint['LClambda']
+        set_rng_state(checkpoint['rng_state'])
+        epoch_start = checkpoint['epoch']
+        print_main("Loaded checkpoint '{}' (epoch {})".format(resume_path, checkpoint['epoch']))
 
     # Log file:
-    if not os.path.exists(args.logdir):
-        os.makedirs(args.logdir)
     experiment_name = 'joint train'
     log_file_name = os.path.join(args.logdir, experiment_name + '.txt')
-    if os.path.isfile(log_file_name):
-        log_file = open(log_file_name, 'a')
-    else:
-        log_file = open(log_file_name, 'w+')
+    if is_main_process():
+        if not os.path.exists(args.logdir):
+            os.makedirs(args.logdir)
+        if os.path.isfile(log_file_name):
+            log_file = open(log_file_name, 'a')
+        else:
+            log_file = open(log_file_name, 'w+')
 
-    log_file.write('\n---------------  ' + experiment_name + '  ---------------\n')
-    log_file.close()
+        log_file.write('\n---------------  ' + experiment_name + '  ---------------\n')
+        log_file.close()
+
+        # latest and top-k checkpoints by val mse, written in the background
+        ckpt_manager = CheckpointManager(args.logdir, 'joint_' + experiment_name.replace(' ', '_'),
+                                         keep_best=args.keep_best)
 
     # Setup tensorboard for visualization
     if args.tboard:
         # save logs in runs/<experiment_name> 
         writer = SummaryWriter(comment=experiment_name)
+        # image grids are built off the training thread, within a byte budget per interval
+        image_logger = TensorboardImageLogger(writer, max_bytes=int(args.tboard_img_mb * 1024 * 1024),
+                                              interval=args.tboard_img_interval)
 
-    best_val_mse = 99999.0
-    global_step = 0
-    LClambda = 0.2
     bm_img_size = (128, 128)
 
     alpha = 0.5
     beta = 0.5
+    # gradients of accum_steps batches are summed before every optimizer step
+    n_batches = len(trainloader)
+    print_main("Effective batch size: {} ({} x {} accumulation steps)".format(args.batch_size * args.accum_steps,
+                                                                         args.batch_size, args.accum_steps))
+    # losses are summed on the device, they are only read back at log intervals
+    train_metrics = MetricAccumulator('loss', 'wc_l1loss', 'wc_gloss', 'wc_mse', 'bm_l1loss', 'bm_rloss',
+                                      'bm_ssimloss', 'bm_mse')
+    running_metrics = MetricAccumulator('loss')
+    val_metrics = MetricAccumulator('loss', 'mse', 'wc_l1loss', 'wc_gloss', 'wc_mse', 'bm_l1loss', 'bm_rloss',
+                                    'bm_ssimloss', 'bm_mse')
     for epoch in range(epoch_start, args.n_epoch):
-        avg_loss = 0.0
-
-        wc_avg_l1loss = 0.0
-        wc_avg_gloss = 0.0
-        wc_train_mse = 0.0
-
-        bm_avgl1loss = 0.0
-        bm_avgrloss = 0.0
-        bm_avgssimloss = 0.0
-        bm_train_mse = 0.0
+        train_metrics.reset()
+        running_metrics.reset()
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
 
         model_wc.train()
         model_bm.train()
+        if args.freeze_bn:
+            # batch statistics of small accumulated batches are too noisy, keep the running ones
+            freeze_bn(model_wc)
+            freeze_bn(model_bm)
         if epoch == 50 and LClambda < 1.0:
             LClambda += 0.2
-        for (i, (wc_images, wc_labels)), (i, (bm_images, bm_labels)) in zip(enumerate(wc_trainloader),
-                                                                            enumerate(bm_trainloader)):
-            wc_images = Variable(wc_images.cuda())
-            wc_labels = Variable(wc_labels.cuda())
-
-            optimizer.zero_grad()
-            wc_outputs = model_wc(wc_images)
-            pred_wc = htan(wc_outputs)
-            g_loss = gloss(pred_wc, wc_labels)
-            wc_l1loss = loss_fn(pred_wc, wc_labels)
-            loss = alpha * (wc_l1loss + LClambda * g_loss)
-
-            bm_images = Variable(bm_images.cuda())
-            bm_labels = Variable(bm_labels.cuda())
-            bm_input = F.interpolate(pred_wc, bm_img_size)
-
-            target = model_bm(bm_input)
-            target_nhwc = target.transpose(1, 2).transpose(2, 3)
-            bm_val_l1loss = loss_fn(target_nhwc, bm_labels)
-            rloss, ssim, uworg, uwpred = reconst_loss(bm_images[:, :-1, :, :], target_nhwc, bm_labels)
-            loss += beta * ((10.0 * bm_val_l1loss) + (0.5 * rloss))
-
-            avg_loss += float(loss)
-
-            wc_avg_l1loss += float(wc_l1loss)
-            wc_avg_gloss += float(g_loss)
-            wc_train_mse += float(MSE(pred_wc, wc_labels).item())
-
-            bm_avgl1loss += float(bm_val_l1loss)
-            bm_avgrloss += float(rloss)
-            bm_avgssimloss += float(ssim)
-
-            bm_train_mse += float(MSE(target_nhwc, bm_labels).item())
-
-            loss.backward()
-            optimizer.step()
-            global_step += 1
-
-            if (i + 1) % 50 == 0:
-                print("Epoch[%d/%d] Batch [%d/%d] Loss: %.4f" % (
-                    epoch + 1, args.n_epoch, i + 1, len(wc_trainloader), avg_loss / 50.0))
-                avg_loss = 0.0
-
-            if args.tboard and (i + 1) % 20 == 0:
-                show_wc_tnsboard(global_step, writer, wc_images, wc_labels, pred_wc, 8, 'Train Inputs', 'Train WCs',
-                                 'Train pred_wc. WCs')
-                writer.add_scalar('WC: L1 Loss/train', wc_avg_l1loss / (i + 1), global_step)
-                writer.add_scalar('WC: Grad Loss/train', wc_avg_gloss / (i + 1), global_step)
-                show_unwarp_tnsboard(bm_images, global_step, writer, uwpred, uworg, 8, 'Train GT unwarp',
-                                     'Train Pred Unwarp')
-                writer.add_scalar('BM: L1 Loss/train', bm_avgl1loss / (i + 1), global_step)
-                writer.add_scalar('CB: Recon Loss/train', bm_avgrloss / (i + 1), global_step)
-                writer.add_scalar('CB: SSIM Loss/train', bm_avgssimloss / (i + 1), global_step)
-
-        wc_train_mse = wc_train_mse / len(wc_trainloader)
-        wc_avg_l1loss = wc_avg_l1loss / len(wc_trainloader)
-        wc_avg_gloss = wc_avg_gloss / len(wc_trainloader)
-        print("wc Training L1:%4f" % (wc_avg_l1loss))
-        print("wc Training MSE:'{}'".format(wc_train_mse))
+        reset_peak_memory()
+        # time per step waiting for data, in h2d copies, forward, loss, backward, optimizer and logging
+        timer = StageTimer(cuda_sync=args.sync_timing, reset_peak=False)
+        n_samples = 0
+        epoch_start_time = time.time()
+        interval_start = time.time()
+        optimizer.zero_grad()
+        # the item starts before the batch is fetched, its total includes the data wait
+        timer.start_item()
+        data_start = time.perf_counter()
+        for i, (wc_images, wc_labels, bm_images, bm_labels) in enumerate(trainloader):
+            timer.add('data', time.perf_counter() - data_start)
+            with timer.stage('h2d'):
+                wc_images = Variable(wc_images.to(device))
+                wc_labels = Variable(wc_labels.to(device))
+                bm_images = Variable(bm_images.to(device))
+                bm_labels = Variable(bm_labels.to(device))
+            n_samples += wc_images.size(0)
+            # the last group of an epoch may have fewer batches
+            accum_size = min(args.accum_steps, n_batches - (i // args.accum_steps) * args.accum_steps)
+
+            # gradients are only all-reduced across processes on the batch before an optimizer step
+            sync_step = (i + 1) % args.accum_steps == 0 or (i + 1) == n_batches
+            with skip_grad_sync([model_wc, model_bm], skip=not sync_step):
+                with timer.stage('forward'):
+                    wc_outputs = model_wc(wc_images)
+                    pred_wc = htan(wc_outputs)
+                with timer.stage('loss'):
+                    g_loss = gloss(pred_wc, wc_labels)
+                    wc_l1loss = loss_fn(pred_wc, wc_labels)
+                    loss = alpha * (wc_l1loss + LClambda * g_loss)
+
+                with timer.stage('forward'):
+                    bm_input = F.interpolate(pred_wc, bm_img_size)
+                    target = model_bm(bm_input)
+                    target_nhwc = target.transpose(1, 2).transpose(2, 3)
+                with timer.stage('loss'):
+                    bm_l1loss = loss_fn(target_nhwc, bm_labels)
+                    rloss, ssim, uworg, uwpred = reconst_loss(bm_images[:, :-1, :, :], target_nhwc, bm_labels)
+                    loss += beta * ((10.0 * bm_l1loss) + (0.5 * rloss))
+
+                with timer.stage('backward'):
+                    (loss / accum_size).backward()
+            if sync_step:
+                with timer.stage('optimizer'):
+                    optimizer.step()
+                    optimizer.zero_grad()
+                global_step += 1
+
+            with timer.stage('logging'):
+                with torch.no_grad():
+                    train_metrics.update(loss=loss, wc_l1loss=wc_l1loss, wc_gloss=g_loss, wc_mse=MSE(pred_wc, wc_labels),
+                                         bm_l1loss=bm_l1loss, bm_rloss=rloss, bm_ssimloss=ssim,
+                                         bm_mse=MSE(target_nhwc, bm_labels))
+                    running_metrics.update(loss=loss)
+
+                if (i + 1) % 50 == 0:
+                    data_wait = sum(r['stages'].get('data', 0.0) for r in timer.items[-49:]) + timer.current['data']
+                    interval = time.time() - interval_start
+                    print_main("Epoch[%d/%d] Batch [%d/%d] Loss: %.4f (%.3fs/step, %.0f%% data wait)" % (
+                        epoch + 1, args.n_epoch, i + 1, len(trainloader), running_metrics.sum('loss') / 50.0,
+                        interval / 50.0, 100.0 * data_wait / interval))
+                    running_metrics.reset()
+                    interval_start = time.time()
+
+                if args.tboard and (i + 1) % 20 == 0:
+                    image_logger.log_wc(global_step, wc_images, wc_labels, pred_wc, 8, 'Train Inputs', 'Train WCs',
+                                        'Train pred_wc. WCs')
+                    writer.add_scalar('WC: L1 Loss/train', train_metrics.mean('wc_l1loss'), global_step)
+                    writer.add_scalar('WC: Grad Loss/train', train_metrics.mean('wc_gloss'), global_step)
+                    image_logger.log_unwarp(global_step, uwpred, uworg, 8, 'Train GT unwarp', 'Train Pred Unwarp')
+                    writer.add_scalar('BM: L1 Loss/train', train_metrics.mean('bm_l1loss'), global_step)
+                    writer.add_scalar('CB: Recon Loss/train', train_metrics.mean('bm_rloss'), global_step)
+                    writer.add_scalar('CB: SSIM Loss/train', train_metrics.mean('bm_ssimloss'), global_step)
+            timer.end_item(i)
+            timer.start_item()
+            data_start = time.perf_counter()
+
+        # averages over all processes
+        train_metrics.all_reduce(device)
+        wc_train_mse = train_metrics.mean('wc_mse')
+        wc_avg_l1loss = train_metrics.mean('wc_l1loss')
+        wc_avg_gloss = train_metrics.mean('wc_gloss')
+        print_main("wc Training L1:%4f" % (wc_avg_l1loss))
+        print_main("wc Training MSE:'{}'".format(wc_train_mse))
         wc_train_losses = [wc_avg_l1loss, wc_train_mse, wc_avg_gloss]
 
         lrate = get_lr(optimizer)
 
-        write_log_file(log_file_name, wc_train_losses, epoch + 1, lrate, 'Train', 'wc')
+        if is_main_process():
+            write_log_file(log_file_name, wc_train_losses, epoch + 1, lrate, 'Train', 'wc')
 
-        bm_avgssimloss = bm_avgssimloss / len(bm_trainloader)
-        bm_avgrloss = bm_avgrloss / len(bm_trainloader)
-        bm_avgl1loss = bm_avgl1loss / len(bm_trainloader)
-        bm_train_mse = bm_train_mse / len(bm_trainloader)
-        print("bm Training L1:%4f" % (bm_avgl1loss))
-        print("bm Training MSE:'{}'".format(bm_train_mse))
+        bm_avgssimloss = train_metrics.mean('bm_ssimloss')
+        bm_avgrloss = train_metrics.mean('bm_rloss')
+        bm_avgl1loss = train_metrics.mean('bm_l1loss')
+        bm_train_mse = train_metrics.mean('bm_mse')
+        print_main("bm Training L1:%4f" % (bm_avgl1loss))
+        print_main("bm Training MSE:'{}'".format(bm_train_mse))
         bm_train_losses = [bm_avgl1loss, bm_train_mse, bm_avgrloss, bm_avgssimloss]
 
-        write_log_file(log_file_name, bm_train_losses, epoch + 1, lrate, 'Train', 'bm')
-
-        model_wc.eval()
-        model_bm.eval()
-
-        val_mse = 0.0
-        val_loss = 0.0
-
-        wc_val_loss = 0.0
-        wc_val_gloss = 0.0
-        wc_val_mse = 0.0
-
-        bm_val_l1loss = 0.0
-        val_rloss = 0.0
-        val_ssimloss = 0.0
-        bm_val_mse = 0.0
-
-        for (i_val, (wc_images_val, wc_labels_val)), (i_val, (bm_images_val, bm_labels_val)) in tqdm(
-                zip(enumerate(wc_valloader), enumerate(bm_valloader))):
-            with torch.no_grad():
-                wc_images_val = Variable(wc_images_val.cuda())
-                wc_labels_val = Variable(wc_labels_val.cuda())
-
-                wc_outputs = model_wc(wc_images_val)
-                pred_val = htan(wc_outputs)
-                wc_g_loss = gloss(pred_val, wc_labels_val).cpu()
-                pred_val = pred_val.cpu()
-                wc_labels_val = wc_labels_val.cpu()
-                wc_val_loss += loss_fn(pred_val, wc_labels_val)
-                wc_val_mse += float(MSE(pred_val, wc_labels_val))
-                wc_val_gloss += float(wc_g_loss)
-
-                bm_images_val = Variable(bm_images_val.cuda())
-                bm_labels_val = Variable(bm_labels_val.cuda())
-                bm_input = F.interpolate(pred_val, bm_img_size)
-                target = model_bm(bm_input)
-                target_nhwc = target.transpose(1, 2).transpose(2, 3)
-                pred = target_nhwc.data.cpu()
-                gt = bm_labels_val.cpu()
-                bm_val_l1loss += loss_fn(target_nhwc, bm_labels_val)
-                rloss, ssim, uworg, uwpred = reconst_loss(bm_images_val[:, :-1, :, :], target_nhwc, bm_labels_val)
-                val_rloss += float(rloss.cpu())
-                val_ssimloss += float(ssim.cpu())
-                bm_val_mse += float(MSE(pred, gt))
-                val_loss += (alpha * wc_val_loss + beta * bm_val_l1loss)
-                val_mse += (wc_val_mse + bm_val_mse)
-            if args.tboard:
-                show_unwarp_tnsboard(bm_images_val, epoch + 1, writer, uwpred, uworg, 8, 'Val GT unwarp',
-                                     'Val Pred Unwarp')
-
+        if is_main_process():
+            write_log_file(log_file_name, bm_train_losses, epoch + 1, lrate, 'Train', 'bm')
+
+        if args.distributed:
+            n_samples *= torch.distributed.get_world_size()
+        samples_per_sec = n_samples / (time.time() - epoch_start_time)
+        peak_mem = peak_memory_mb()
+        print_main("Training throughput: {:.2f} samples/s, step time: {:.3f}s, peak memory: {:.0f} MB".format(
+            samples_per_sec, (time.time() - epoch_start_time) / n_batches, peak_mem))
+        print_main(timer.report())
+        if is_main_process():
+            write_log_file(log_file_name, [samples_per_sec, peak_mem, args.batch_size, args.accum_steps], epoch + 1,
+                           lrate, 'Train', 'perf')
+            write_timing_log(log_file_name, epoch + 1, samples_per_sec, timer)
         if args.tboard:
-            show_wc_tnsboard(epoch + 1, writer, wc_images_val, wc_labels_val, pred_val, 8, 'Val Inputs', 'Val WCs',
-                             'Val Pred. WCs')
-            writer.add_scalar('WC: L1 Loss/val', wc_val_loss, epoch + 1)
-            writer.add_scalar('WC: Grad Loss/val', wc_val_gloss, epoch + 1)
-
-            writer.add_scalar('BM: L1 Loss/val', bm_val_l1loss, epoch + 1)
-            writer.add_scalar('CB: Recon Loss/val', val_rloss, epoch + 1)
-            writer.add_scalar('CB: SSIM Loss/val', val_ssimloss, epoch + 1)
-            writer.add_scalar('total val loss', val_loss, epoch + 1)
-
-        wc_val_loss = wc_val_loss / len(wc_valloader)
-        wc_val_mse = wc_val_mse / len(wc_valloader)
-        wc_val_gloss = wc_val_gloss / len(wc_valloader)
-        print("wc val loss at epoch {}:: {}".format(epoch + 1, wc_val_loss))
-        print("wc val MSE: {}".format(wc_val_mse))
-
-        bm_val_l1loss = bm_val_l1loss / len(bm_valloader)
-        bm_val_mse = bm_val_mse / len(bm_valloader)
-        val_ssimloss = val_ssimloss / len(bm_valloader)
-        val_rloss = val_rloss / len(bm_valloader)
-        print("bm val loss at epoch {}:: {}".format(epoch + 1, bm_val_l1loss))
-        print("bm val mse: {}".format(bm_val_mse))
-
-        val_loss /= len(wc_valloader)
-        val_mse /= len(wc_valloader)
-        print("val loss at epoch {}:: {}".format(epoch + 1, val_loss))
-        print("val mse: {}".format(val_mse))
-
-        bm_val_losses = [bm_val_l1loss, bm_val_mse, val_rloss, val_ssimloss]
-        wc_val_losses = [wc_val_loss, wc_val_mse, wc_val_gloss]
-        total_val_losses = [val_loss, val_mse]
-        write_log_file(log_file_name, wc_val_losses, epoch + 1, lrate, 'Val', 'wc')
-        write_log_file(log_file_name, bm_val_losses, epoch + 1, lrate, 'Val', 'bm')
-        write_log_file(log_file_name, total_val_losses, epoch + 1, lrate, 'Val', 'total')
-
-        # reduce learning rate
-        sched.step(val_mse)
-
-        if val_mse < best_val_mse:
-            best_val_mse = val_mse
-            state_wc = {'epoch': epoch + 1,
-                     'model_state': model_wc.state_dict(),
-                     'optimizer_state': optimizer.state_dict(), }
-            torch.save(state_wc,
-                       args.logdir + "{}_{}_{}_{}_{}_best_wc_model.pkl".format('unetnc', epoch + 1, wc_val_mse, wc_train_mse,
-                                                                            experiment_name))
-            state_bm = {'epoch': epoch + 1,
-                     'model_state': model_bm.state_dict(),
-                     'optimizer_state': optimizer.state_dict(), }
-            torch.save(state_bm,
-                       args.logdir + "{}_{}_{}_{}_{}_best_bm_model.pkl".format('dnetccnl', epoch + 1, bm_val_mse, bm_train_mse,
-                                                                            experiment_name))
-
-        if (epoch + 1) % 10 == 0 and epoch > 70:
-            state_wc = {'epoch': epoch + 1,
-                     'model_state': model_wc.state_dict(),
-                     'optimizer_state': optimizer.state_dict(), }
-            torch.save(state_wc, args.logdir + "{}_{}_{}_{}_{}_wc_model.pkl".format('unetnc', epoch + 1, wc_val_mse, wc_train_mse,
-                                                                              experiment_name))
-            state_bm = {'epoch': epoch + 1,
-                     'model_state': model_bm.state_dict(),
-                     'optimizer_state': optimizer.state_dict(), }
-            torch.save(state_bm, args.logdir + "{}_{}_{}_{}_{}_bm_model.pkl".format('dnetccnl', epoch + 1, bm_val_mse, bm_train_mse,
-                                                                              experiment_name))
+            writer.add_scalar('Perf: Samples per sec/train', samples_per_sec, epoch + 1)
+            writer.add_scalar('Perf: Peak memory MB/train', peak_mem, epoch + 1)
+            for stage, seconds in timer.means().items():
+                writer.add_scalar('Time: {}/train'.format(stage), seconds, epoch + 1)
+
+        # validation every val_every epochs and after the last one, the scheduler and
+        # the best model selection only see validated epochs
+        val_mse = None
+        exports = {}
+        if (epoch + 1) % args.val_every == 0 or (epoch + 1) == args.n_epoch:
+            model_wc.eval()
+            model_bm.eval()
+            val_metrics.reset()
+
+            for i_val, (wc_images_val, wc_labels_val, bm_images_val, bm_labels_val) in tqdm(enumerate(valloader),
+                                                                                          disable=not is_main_process()):
+                with torch.no_grad():
+                    wc_images_val = Variable(wc_images_val.to(device))
+                    wc_labels_val = Variable(wc_labels_val.to(device))
+
+                    wc_outputs = model_wc(wc_images_val)
+                    pred_val = htan(wc_outputs)
+                    wc_g_loss = gloss(pred_val, wc_labels_val)
+                    wc_l1loss = loss_fn(pred_val, wc_labels_val)
+                    wc_mse = MSE(pred_val, wc_labels_val)
+
+                    bm_images_val = Variable(bm_images_val.to(device))
+                    bm_labels_val = Variable(bm_labels_val.to(device))
+                    bm_input = F.interpolate(pred_val, bm_img_size)
+                    target = model_bm(bm_input)
+                    target_nhwc = target.transpose(1, 2).transpose(2, 3)
+                    bm_l1loss = loss_fn(target_nhwc, bm_labels_val)
+                    bm_mse = MSE(target_nhwc, bm_labels_val)
+                    rloss, ssim, uworg, uwpred = reconst_loss(bm_images_val[:, :-1, :, :], target_nhwc, bm_labels_val)
+                    val_metrics.update(loss=alpha * wc_l1loss + beta * bm_l1loss, mse=wc_mse + bm_mse,
+                                       wc_l1loss=wc_l1loss, wc_gloss=wc_g_loss, wc_mse=wc_mse,
+                                       bm_l1loss=bm_l1loss, bm_rloss=rloss, bm_ssimloss=ssim, bm_mse=bm_mse)
+            # every process steps the scheduler with the same val mse
+            val_metrics.all_reduce(device)
+
+            if args.tboard:
+                # images of the last val batch only
+                image_logger.log_unwarp(epoch + 1, uwpred, uworg, 8, 'Val GT unwarp', 'Val Pred Unwarp')
+                image_logger.log_wc(epoch + 1, wc_images_val, wc_labels_val, pred_val, 8, 'Val Inputs', 'Val WCs',
+                                    'Val Pred. WCs')
+                writer.add_scalar('WC: L1 Loss/val', val_metrics.sum('wc_l1loss'), epoch + 1)
+                writer.add_scalar('WC: Grad Loss/val', val_metrics.sum('wc_gloss'), epoch + 1)
+
+                writer.add_scalar('BM: L1 Loss/val', val_metrics.sum('bm_l1loss'), epoch + 1)
+                writer.add_scalar('CB: Recon Loss/val', val_metrics.sum('bm_rloss'), epoch + 1)
+                writer.add_scalar('CB: SSIM Loss/val', val_metrics.sum('bm_ssimloss'), epoch + 1)
+                writer.add_scalar('total val loss', val_metrics.sum('loss'), epoch + 1)
+
+            wc_val_loss = val_metrics.mean('wc_l1loss')
+            wc_val_mse = val_metrics.mean('wc_mse')
+            wc_val_gloss = val_metrics.mean('wc_gloss')
+            print_main("wc val loss at epoch {}:: {}".format(epoch + 1, wc_val_loss))
+            print_main("wc val MSE: {}".format(wc_val_mse))
+
+            bm_val_l1loss = val_metrics.mean('bm_l1loss')
+            bm_val_mse = val_metrics.mean('bm_mse')
+            val_ssimloss = val_metrics.mean('bm_ssimloss')
+            val_rloss = val_metrics.mean('bm_rloss')
+            print_main("bm val loss at epoch {}:: {}".format(epoch + 1, bm_val_l1loss))
+            print_main("bm val mse: {}".format(bm_val_mse))
+
+            val_loss = val_metrics.mean('loss')
+            val_mse = val_metrics.mean('mse')
+            print_main("val loss at epoch {}:: {}".format(epoch + 1, val_loss))
+            print_main("val mse: {}".format(val_mse))
+
+            bm_val_losses = [bm_val_l1loss, bm_val_mse, val_rloss, val_ssimloss]
+            wc_val_losses = [wc_val_loss, wc_val_mse, wc_val_gloss]
+            total_val_losses = [val_loss, val_mse]
+            if is_main_process():
+                write_log_file(log_file_name, wc_val_losses, epoch + 1, lrate, 'Val', 'wc')
+                write_log_file(log_file_name, bm_val_losses, epoch + 1, lrate, 'Val', 'bm')
+                write_log_file(log_file_name, total_val_losses, epoch + 1, lrate, 'Val', 'total')
+
+            # reduce learning rate
+            sched.step(val_mse)
+
+            # weights only copies of the best networks, loadable by infer.py
+            if val_mse < best_val_mse:
+                best_val_mse = val_mse
+                exports["{}_{}_best_wc_model.pkl".format('unetnc', experiment_name)] = {
+                    'epoch': epoch + 1, 'model_state': unwrap_model(model_wc).state_dict(), 'val_mse': wc_val_mse}
+                exports["{}_{}_best_bm_model.pkl".format('dnetccnl', experiment_name)] = {
+                    'epoch': epoch + 1, 'model_state': unwrap_model(model_bm).state_dict(), 'val_mse': bm_val_mse}
+
+        if is_main_process():
+            state = {'epoch': epoch + 1,
+                     'wc_model_state': unwrap_model(model_wc).state_dict(),
+                     'bm_model_state': unwrap_model(model_bm).state_dict(),
+                     'optimizer_state': optimizer.state_dict(),
+                     'sched_state': sched.state_dict(),
+                     'best_val_mse': best_val_mse,
+                     'global_step': global_step,
+                     'LClambda': LClambda,
+                     'rng_state': rng_state(),
+                     'val_mse': val_mse, }
+            ckpt_manager.save(state, epoch + 1, val_mse, exports=exports)
+
+    if is_main_process():
+        ckpt_manager.wait()
+    if args.tboard:
+        image_logger.close()
 
 
 if __name__ == '__main__':
@@ -354,19 +433,52 @@ if __name__ == '__main__':
                         help='# of the epochs')
     parser.add_argument('--batch_size', nargs='?', type=int, default=1,
                         help='Batch Size')
+    parser.add_argument('--accum_steps', nargs='?', type=int, default=1,
+                        help='# of batches whose gradients are accumulated per optimizer step')
+    parser.add_argument('--freeze_bn', dest='freeze_bn', action='store_true',
+                        help='Keep batch norm running statistics fixed during training | False by default')
+    parser.add_argument('--wc_checkpoint', nargs='*', type=int, default=[],
+                        help='Activation checkpointing: unetnc skip connection levels [1-6] to recompute in backward')
+    parser.add_argument('--bm_checkpoint', nargs='*', type=int, default=[],
+                        help='Activation checkpointing: dnetccnl dense blocks [0-9] to recompute in backward')
     parser.add_argument('--l_rate', nargs='?', type=float, default=1e-5,
                         help='Learning Rate')
     parser.add_argument('--shape_net_loc', nargs='?', type=str, default=None,
                         help='Path to previous saved shape network model to restart from')
     parser.add_argument('--texture_mapping_net_loc', nargs='?', type=str, default=None,
                         help='Path to previous saved texture mapping network model to restart from')
+    parser.add_argument('--resume', nargs='?', type=str, default=None,
+                        help='Path to a joint training checkpoint, or its logdir, to restart from')
+    parser.add_argument('--keep_best', nargs='?', type=int, default=3,
+                        help='# of best checkpoints by val mse to keep besides the latest one')
     parser.add_argument('--logdir', nargs='?', type=str, default='./logdir/',
                         help='Path to store the loss logs')
     parser.add_argument('--tboard', dest='tboard', action='store_true',
                         help='Enable visualization(s) on tensorboard | False by default')
+    parser.add_argument('--tboard_img_mb', nargs='?', type=float, default=16.0,
+                        help='Tensorboard image budget in MB per interval')
+    parser.add_argument('--tboard_img_interval', nargs='?', type=float, default=60.0,
+                        help='Length of the tensorboard image budget interval in seconds')
     parser.add_argument('--augmentation', nargs='?', type=bool, default=False,
                         help='whether to augment training data')
-    parser.set_defaults(tboard=False)
+    parser.add_argument('--distributed', dest='distributed', action='store_true',
+                        help='DistributedDataParallel, one process per gpu or cpu, launch with torch.distributed.launch')
+    parser.add_argument('--local_rank', nargs='?', type=int, default=int(os.environ.get('LOCAL_RANK', 0)),
+                        help='Set by torch.distributed.launch')
+    parser.add_argument('--dist_backend', nargs='?', type=str, default=None,
+                        help='Process group backend, nccl on gpu and gloo on cpu by default')
+    parser.add_argument('--sync_bn', dest='sync_bn', action='store_true',
+                        help='Synchronize BatchNorm statistics over processes (gpu only) with --distributed')
+    parser.add_argument('--val_every', nargs='?', type=int, default=1,
+                        help='Validate every # epochs')
+    parser.add_argument('--val_subset', nargs='?', type=int, default=0,
+                        help='Validate on # evenly spaced val samples, 0 for all')
+    parser.add_argument('--val_cache', dest='val_cache', action='store_true',
+                        help='Keep the preprocessed val batches in memory between epochs')
+    parser.add_argument('--sync_timing', dest='sync_timing', action='store_true',
+                        help='Synchronize cuda around every timed training stage, exact breakdown at some speed cost')
+    parser.set_defaults(tboard=False, freeze_bn=False, distributed=False, sync_bn=False, val_cache=False,
+                        sync_timing=False)
 
     args = parser.parse_args()
     train(args)
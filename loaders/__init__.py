@@ -1,6 +1,7 @@
 import json
 from loaders.doc3dwc_loader import doc3dwcLoader
 from loaders.doc3dbmnoimgc_loader import doc3dbmnoimgcLoader
+from loaders.doc3djoint_loader import doc3djointLoader
 
 
 def get_loader(name):
@@ -11,4 +12,5 @@ def get_loader(name):
     return {
         'doc3dwc':doc3dwcLoader,
         'doc3dbmnic':doc3dbmnoimgcLoader,
+        'doc3djoint':doc3djointLoader,
     }[name]
@@ -11,8 +11,18 @@ import random
 #            '7/1_996_5-ns_Page_402-icm0001','7/2_85_5-ns_Page_523-rgf0001']
 
 
-def tight_crop(im, fm):
+def sample_rng(split, index):
+    """Random source of the crop of a sample: the module one in training, seeded by the index otherwise,
+       so every val pass (and the val cache) sees the same crops
+    """
+    if 'train' in split:
+        return random
+    return random.Random(index)
+
+
+def tight_crop(im, fm, rng=random):
     # different tight crop
+    # rng: source of the random margins, e.g. a random.Random seeded per sample for a fixed val crop
     msk=((fm[:,:,0]!=0)&(fm[:,:,1]!=0)&(fm[:,:,2]!=0)).astype(np.uint8)
     [y, x] = (msk).nonzero()
     minx = min(x)
@@ -36,10 +46,10 @@ def tight_crop(im, fm):
     s = 20
     im = np.pad(im, ((s, s), (s, s), (0, 0)), 'constant')
     fm = np.pad(fm, ((s, s), (s, s), (0, 0)), 'constant')
-    cx1 = random.randint(0, s - 5)
-    cx2 = random.randint(0, s - 5) + 1
-    cy1 = random.randint(0, s - 5)
-    cy2 = random.randint(0, s - 5) + 1
+    cx1 = rng.randint(0, s - 5)
+    cx2 = rng.randint(0, s - 5) + 1
+    cy1 = rng.randint(0, s - 5)
+    cy2 = rng.randint(0, s - 5) + 1
 
     im = im[cy1 : -cy2, cx1 : -cx2, :]
     fm = fm[cy1 : -cy2, cx1 : -cx2, :]
@@ -0,0 +1,93 @@
+# world coordinate statistics of a doc3d style dataset
+# the min/max of every wc channel is computed once from the exr labels
+# and stored next to the split files as <root>/wcstats.json
+#
+# python -m loaders.doc3d_stats --data_path ./data/DewarpNet/doc3d/
+import os
+from os.path import join as pjoin
+import json
+import argparse
+import numpy as np
+import cv2
+
+from tqdm import tqdm
+
+
+WC_STATS_FILE = 'wcstats.json'
+
+# constants the loaders used before wcstats.json existed (calculated from all the wcs)
+# channels are in the order cv2 reads the exr: z, y, x
+DEFAULT_WC_MIN = [-0.67492497, -1.2289206, -1.2442188]
+DEFAULT_WC_MAX = [0.6436657, 1.2396319, 1.2539363]
+
+
+def compute_wc_stats(root, splits=('train', 'val')):
+    """Per channel min/max over the foreground of all wc labels of the given splits
+        :param root is the dataset root containing <split>.txt and wc/
+        :param splits are the splits to scan
+    """
+    wc_min = np.full(3, np.inf)
+    wc_max = np.full(3, -np.inf)
+    n_files = 0
+    for split in splits:
+        with open(pjoin(root, split + '.txt'), 'r') as f:
+            file_list = [id_.rstrip() for id_ in f if id_.strip()]
+        for im_name in tqdm(file_list, desc=split):
+            wc = cv2.imread(pjoin(root, 'wc', im_name + '.exr'), cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH)
+            msk = np.all(wc != 0, axis=2)
+            if not msk.any():
+                continue
+            fg = wc[msk]
+            wc_min = np.minimum(wc_min, fg.min(axis=0))
+            wc_max = np.maximum(wc_max, fg.max(axis=0))
+            n_files += 1
+    return {'min': wc_min.tolist(), 'max': wc_max.tolist(), 'splits': list(splits), 'n_files': n_files}
+
+
+def save_wc_stats(root, stats):
+    path = pjoin(root, WC_STATS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(stats, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def load_wc_stats(root):
+    """Loads <root>/wcstats.json, falls back to the DEFAULT_WC_* constants
+       :returns (offset, scale) float32 arrays of shape (3,), normalized wc = (wc - offset) * scale
+    """
+    path = pjoin(root, WC_STATS_FILE)
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            stats = json.load(f)
+        wc_min, wc_max = stats['min'], stats['max']
+    else:
+        wc_min, wc_max = DEFAULT_WC_MIN, DEFAULT_WC_MAX
+    wc_min = np.array(wc_min, dtype=np.float32)
+    wc_max = np.array(wc_max, dtype=np.float32)
+    return wc_min, (1.0 / (wc_max - wc_min)).astype(np.float32)
+
+
+def normalize_wc(wc, stats):
+    """Min/max normalizes all channels of a HxWx3 wc map and zeroes the background
+       in one pass, in float32
+       :param stats is the (offset, scale) pair returned by load_wc_stats
+    """
+    offset, scale = stats
+    msk = np.all(wc != 0, axis=2)
+    out = np.subtract(wc, offset, dtype=np.float32)
+    out *= scale
+    out[~msk] = 0
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute world coordinate statistics of a dataset')
+    parser.add_argument('--data_path', nargs='?', type=str, default='',
+                        help='Data path containing train.txt, val.txt and wc/')
+    parser.add_argument('--splits', nargs='+', type=str, default=['train', 'val'],
+                        help='Splits to scan')
+    args = parser.parse_args()
+    stats = compute_wc_stats(os.path.expanduser(args.data_path), args.splits)
+    print(json.dumps(stats, indent=2))
+    print("Saved to {}".format(save_wc_stats(os.path.expanduser(args.data_path), stats)))
@@ -16,15 +16,20 @@ import random
 from tqdm import tqdm
 from torch.utils.data import Dataset
 
+from loaders.augmentationsk import sample_rng
+from loaders.doc3d_stats import load_wc_stats, normalize_wc
+from utils import to_chw
+
 class doc3dbmnoimgcLoader(Dataset):
     """
     Data loader for the  semantic segmentation dataset.
     """
     def __init__(self, root, split='train', is_transform=False,
-                 img_size=512):
+                 img_size=512, altroot=None):
         self.root = os.path.expanduser(root)
         # self.altroot='/home/sagnik/DewarpNet/swat3d/'
-        self.altroot='./data/DewarpNet/swat3d/'
+        # img, wc and bm are read from altroot, the albedos from root
+        self.altroot=os.path.expanduser(altroot) if altroot is not None else './data/DewarpNet/swat3d/'
         self.split = split
         self.is_transform = is_transform
         self.n_classes = 2
@@ -36,6 +41,7 @@ class doc3dbmnoimgcLoader(Dataset):
             file_list = [id_.rstrip() for id_ in file_list]
             self.files[split] = file_list
         #self.setup_annotations()
+        self.wc_stats = load_wc_stats(self.altroot)
 
 
     def __len__(self):
@@ -54,11 +60,11 @@ class doc3dbmnoimgcLoader(Dataset):
         bm = h5.loadmat(bm_path)['bm']
         alb = m.imread(alb_path,mode='RGB')
         if self.is_transform:
-            im, lbl = self.transform(wc,bm,alb)
+            im, lbl = self.transform(wc,bm,alb,rng=sample_rng(self.split, index))
         return im, lbl
 
 
-    def tight_crop(self, wc, alb):
+    def tight_crop(self, wc, alb, rng=random):
         msk=((wc[:,:,0]!=0)&(wc[:,:,1]!=0)&(wc[:,:,2]!=0)).astype(np.uint8)
         size=msk.shape
         [y, x] = (msk).nonzero()
@@ -72,10 +78,10 @@ class doc3dbmnoimgcLoader(Dataset):
         s = 20
         wc = np.pad(wc, ((s, s), (s, s), (0, 0)), 'constant')
         alb = np.pad(alb, ((s, s), (s, s), (0, 0)), 'constant')
-        cx1 = random.randint(0, s - 5)
-        cx2 = random.randint(0, s - 5) + 1
-        cy1 = random.randint(0, s - 5)
-        cy2 = random.randint(0, s - 5) + 1
+        cx1 = rng.randint(0, s - 5)
+        cx2 = rng.randint(0, s - 5) + 1
+        cy1 = rng.randint(0, s - 5)
+        cy2 = rng.randint(0, s - 5) + 1
 
         wc = wc[cy1 : -cy2, cx1 : -cx2, :]
         alb = alb[cy1 : -cy2, cx1 : -cx2, :]
@@ -87,43 +93,29 @@ class doc3dbmnoimgcLoader(Dataset):
         return wc,alb,t,b,l,r
 
 
-    def transform(self, wc, bm, alb):
-        wc,alb,t,b,l,r=self.tight_crop(wc,alb)               #t,b,l,r = is pixels cropped on top, bottom, left, right
-        alb = m.imresize(alb, self.img_size) 
-        alb = alb[:, :, ::-1] # RGB -> BGR
-        alb = alb.astype(np.float64)
-        if alb.shape[2] == 4:
-            alb=alb[:,:,:3]
-        alb = alb.astype(float) / 255.0
-        alb = alb.transpose(2, 0, 1) # NHWC -> NCHW
-       
-        msk=((wc[:,:,0]!=0)&(wc[:,:,1]!=0)&(wc[:,:,2]!=0)).astype(np.uint8)*255
-        #normalize label
-        xmx, xmn, ymx, ymn,zmx, zmn= 1.2539363, -1.2442188, 1.2396319, -1.2289206, 0.6436657, -0.67492497
-        wc[:,:,0]= (wc[:,:,0]-zmn)/(zmx-zmn)
-        wc[:,:,1]= (wc[:,:,1]-ymn)/(ymx-ymn)
-        wc[:,:,2]= (wc[:,:,2]-xmn)/(xmx-xmn)
-        wc=cv2.bitwise_and(wc,wc,mask=msk)
+    def transform(self, wc, bm, alb, img_size=None, rng=random):
+        img_size = self.img_size if img_size is None else img_size
+        wc,alb,t,b,l,r=self.tight_crop(wc,alb,rng)               #t,b,l,r = is pixels cropped on top, bottom, left, right
+        alb = m.imresize(alb, img_size) 
+
+        #normalize label and mask the background (float32, single pass)
+        wc = normalize_wc(wc, self.wc_stats)
         
-        wc = m.imresize(wc, self.img_size) 
-        wc = wc.astype(float) / 255.0
-        wc = wc.transpose(2, 0, 1) # NHWC -> NCHW
+        wc = m.imresize(wc, img_size) 
 
-        bm = bm.astype(float)
-        #normalize label [-1,1]
-        bm[:,:,1]=bm[:,:,1]-t
-        bm[:,:,0]=bm[:,:,0]-l
-        bm=bm/np.array([448.0-l-r, 448.0-t-b])
-        bm=(bm-0.5)*2
+        # alb and wc NHWC -> NCHW float32 straight into one array, RGB -> BGR by the channel order
+        img = np.empty((6,) + alb.shape[:2], dtype=np.float32)
+        to_chw(alb, channels=(2, 1, 0), out=img[:3])
+        to_chw(wc, out=img[3:])
 
-        bm0=cv2.resize(bm[:,:,0],(self.img_size[0],self.img_size[1]))
-        bm1=cv2.resize(bm[:,:,1],(self.img_size[0],self.img_size[1]))
-        
-        img=np.concatenate([alb,wc],axis=0)
-        lbl=np.stack([bm0,bm1],axis=-1)
+        #normalize label [-1,1]
+        bm = np.asarray(bm, dtype=np.float32)
+        bm = (bm - np.array([l, t], dtype=np.float32)) * np.array([2.0 / (448.0-l-r), 2.0 / (448.0-t-b)],
+                                                                 dtype=np.float32) - 1
+        lbl = cv2.resize(bm, (img_size[0], img_size[1]))
 
-        img = torch.from_numpy(img).float()
-        lbl = torch.from_numpy(lbl).float()
+        img = torch.from_numpy(img)
+        lbl = torch.from_numpy(lbl)
         return img, lbl
 
 
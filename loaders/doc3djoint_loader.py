@@ -0,0 +1,64 @@
+# loader for joint training of the shape and texture mapping networks
+# decodes image, wc, bm and albedo of a document once and returns
+# both the shape view (img_size) and the texture mapping view (bm_img_size)
+import os
+from os.path import join as pjoin
+import numpy as np
+import scipy.misc as m
+import cv2
+import hdf5storage as h5
+import random
+
+from loaders.augmentationsk import data_aug, tight_crop, sample_rng
+from loaders.doc3dwc_loader import doc3dwcLoader
+from loaders.doc3dbmnoimgc_loader import doc3dbmnoimgcLoader
+
+
+class doc3djointLoader(doc3dwcLoader):
+    """
+    Loader for joint world coordinate and backward mapping regression
+    """
+    def __init__(self, root, split='train', is_transform=False,
+                 img_size=256, bm_img_size=128, augmentations=None):
+        super(doc3djointLoader, self).__init__(root, split=split, is_transform=is_transform,
+                                               img_size=img_size, augmentations=augmentations)
+        self.bm_n_classes = 2
+        self.bm_img_size = bm_img_size if isinstance(bm_img_size, tuple) else (bm_img_size, bm_img_size)
+
+    # crop and transform of the texture mapping view are shared with the bm loader
+    tight_crop = doc3dbmnoimgcLoader.tight_crop
+    bm_transform = doc3dbmnoimgcLoader.transform
+
+    def __getitem__(self, index):
+        im_name = self.files[self.split][index]                # 1/824_8-cp_Page_0503-7Nw0001
+        img_foldr,fname=im_name.split('/')
+        recon_foldr='chess48'
+        im_path = pjoin(self.root, 'img',  im_name + '.png')
+        wc_path = pjoin(self.root, 'wc', im_name + '.exr')
+        bm_path = pjoin(self.root, 'bm', im_name + '.mat')
+        alb_path = pjoin(self.root,'recon',img_foldr,recon_foldr, fname[:-4]+recon_foldr+'0001.png')
+
+        im = m.imread(im_path,mode='RGB')
+        im = np.array(im, dtype=np.uint8)
+        wc = cv2.imread(wc_path, cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH)
+        bm = h5.loadmat(bm_path)['bm']
+        alb = m.imread(alb_path,mode='RGB')
+
+        # shape view, same as doc3dwcLoader
+        lbl = np.array(wc, dtype=np.float)
+        rng = sample_rng(self.split, index)
+        if 'val' in self.split:
+            im, lbl=tight_crop(im/255.0,lbl,rng)
+        if self.augmentations:          #this is for training, default false for validation
+            tex_id=random.randint(0,len(self.txpths)-1)
+            txpth=self.txpths[tex_id]
+            tex=cv2.imread(os.path.join(self.root[:-7],txpth)).astype(np.uint8)
+            bg=cv2.resize(tex,self.img_size,interpolation=cv2.INTER_NEAREST)
+            im,lbl=data_aug(im,lbl,bg)
+
+        # texture mapping view, same as doc3dbmnoimgcLoader
+        if self.is_transform:
+            im, lbl = self.transform(im, lbl)
+            bm_im, bm_lbl = self.bm_transform(wc, bm, alb, img_size=self.bm_img_size, rng=rng)
+            return im, lbl, bm_im, bm_lbl
+        return im, lbl, alb, bm
@@ -12,7 +12,9 @@ import random
 from tqdm import tqdm
 from torch.utils import data
 
-from loaders.augmentationsk import data_aug, tight_crop
+from loaders.augmentationsk import data_aug, tight_crop, sample_rng
+from loaders.doc3d_stats import load_wc_stats, normalize_wc
+from utils import to_chw
 
 
 class doc3dwcLoader(data.Dataset):
@@ -35,6 +37,7 @@ class doc3dwcLoader(data.Dataset):
             file_list = [id_.rstrip() for id_ in file_list]
             self.files[split] = file_list
         #self.setup_annotations()
+        self.wc_stats = load_wc_stats(self.root)
         if self.augmentations:
             self.txpths=[]
             with open(os.path.join(self.root[:-7],'augtexnames.txt'),'r') as f:
@@ -55,7 +58,7 @@ class doc3dwcLoader(data.Dataset):
         lbl = cv2.imread(lbl_path, cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH)
         lbl = np.array(lbl, dtype=np.float)
         if 'val' in self.split:
-            im, lbl=tight_crop(im/255.0,lbl)
+            im, lbl=tight_crop(im/255.0,lbl,sample_rng(self.split, index))
         if self.augmentations:          #this is for training, default false for validation\
             tex_id=random.randint(0,len(self.txpths)-1)
             txpth=self.txpths[tex_id] 
@@ -69,29 +72,19 @@ class doc3dwcLoader(data.Dataset):
 
     def transform(self, img, lbl):
         img = m.imresize(img, self.img_size) # uint8 with RGB mode
-        if img.shape[-1] == 4:
-            img=img[:,:,:3]   # Discard the alpha channel  
-        img = img[:, :, ::-1] # RGB -> BGR
         # plt.imshow(img)
         # plt.show()
-        img = img.astype(float) / 255.0
-        img = img.transpose(2, 0, 1) # NHWC -> NCHW
-        lbl = lbl.astype(float)
-
-        #normalize label
-        msk=((lbl[:,:,0]!=0)&(lbl[:,:,1]!=0)&(lbl[:,:,2]!=0)).astype(np.uint8)*255
-        xmx, xmn, ymx, ymn,zmx, zmn= 1.2539363, -1.2442188, 1.2396319, -1.2289206, 0.6436657, -0.67492497   # calculate from all the wcs
-        lbl[:,:,0]= (lbl[:,:,0]-zmn)/(zmx-zmn)
-        lbl[:,:,1]= (lbl[:,:,1]-ymn)/(ymx-ymn)
-        lbl[:,:,2]= (lbl[:,:,2]-xmn)/(xmx-xmn)
-        lbl=cv2.bitwise_and(lbl,lbl,mask=msk)
+        # NHWC -> NCHW float32 in one pass, RGB -> BGR by the channel order, the alpha channel is discarded
+        img = to_chw(img, channels=(2, 1, 0))
+
+        #normalize label and mask the background (float32, single pass)
+        lbl = normalize_wc(lbl, self.wc_stats)
         lbl = cv2.resize(lbl, self.img_size, interpolation=cv2.INTER_NEAREST)
-        lbl = lbl.transpose(2, 0, 1)   # NHWC -> NCHW
-        lbl = np.array(lbl, dtype=np.float)
+        lbl = to_chw(lbl, scale=1.0)   # NHWC -> NCHW
 
-        # to torch
-        img = torch.from_numpy(img).float()
-        lbl = torch.from_numpy(lbl).float()
+        # to torch, no copy
+        img = torch.from_numpy(img)
+        lbl = torch.from_numpy(lbl)
 
         return img, lbl
 
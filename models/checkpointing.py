@@ -0,0 +1,32 @@
+# Activation checkpointing of blocks with batch norm layers
+import inspect
+import torch
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+# non-reentrant checkpointing where torch has it (1.11+), newer versions warn without an explicit choice
+CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def checkpoint_bn(module, function, *inputs):
+    """checkpoint(function, *inputs) for the layers of module, with the running statistics of its batch norm
+       layers updated once per step: the recomputation in backward restores them afterwards
+    """
+    norms = [m for m in module.modules() if isinstance(m, _BatchNorm) and m.track_running_stats]
+    calls = [0]
+
+    def run(*args):
+        calls[0] += 1
+        if calls[0] == 1 or not norms:
+            return function(*args)
+        saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in norms]
+        try:
+            return function(*args)
+        finally:
+            with torch.no_grad():
+                for m, (mean, var, tracked) in zip(norms, saved):
+                    m.running_mean.copy_(mean)
+                    m.running_var.copy_(var)
+                    m.num_batches_tracked.copy_(tracked)
+
+    return checkpoint(run, *inputs, **CHECKPOINT_KWARGS)
@@ -10,6 +10,7 @@ from torch.autograd import Function
 from torch.autograd import Variable
 from torch.autograd import gradcheck
 from torch.autograd import Function
+from models.checkpointing import checkpoint_bn
 import numpy as np
 
 
@@ -41,6 +42,15 @@ def add_coordConv_channels(t):
 
 
 
+def set_checkpoint_blocks(main, block_type, checkpoint_blocks):
+    # enables checkpointing of the dense blocks of a sequential stack by index
+    blocks = [m for m in main if isinstance(m, block_type)]
+    for b in checkpoint_blocks:
+        if not 0 <= b < len(blocks):
+            raise ValueError('no dense block {} in {} blocks'.format(b, len(blocks)))
+        blocks[b].use_checkpoint = True
+
+
 class DenseBlockEncoder(nn.Module):
     def __init__(self, n_channels, n_convs, activation=nn.ReLU, args=[False]):
         super(DenseBlockEncoder, self).__init__()
@@ -48,6 +58,7 @@ class DenseBlockEncoder(nn.Module):
 
         self.n_channels = n_channels
         self.n_convs    = n_convs
+        self.use_checkpoint = False
         self.layers     = nn.ModuleList()
         for i in range(n_convs):
             self.layers.append(nn.Sequential(
@@ -56,6 +67,12 @@ class DenseBlockEncoder(nn.Module):
                     nn.Conv2d(n_channels, n_channels, 3, stride=1, padding=1, bias=False),))
 
     def forward(self, inputs):
+        # recompute the activations of the block in backward instead of storing them
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_bn(self, self._forward, inputs)
+        return self._forward(inputs)
+
+    def _forward(self, inputs):
         outputs = []
 
         for i, layer in enumerate(self.layers):
@@ -76,6 +93,7 @@ class DenseBlockDecoder(nn.Module):
 
         self.n_channels = n_channels
         self.n_convs    = n_convs
+        self.use_checkpoint = False
         self.layers = nn.ModuleList()
         for i in range(n_convs):
             self.layers.append(nn.Sequential(
@@ -84,6 +102,12 @@ class DenseBlockDecoder(nn.Module):
                     nn.ConvTranspose2d(n_channels, n_channels, 3, stride=1, padding=1, bias=False),))
 
     def forward(self, inputs):
+        # recompute the activations of the block in backward instead of storing them
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_bn(self, self._forward, inputs)
+        return self._forward(inputs)
+
+    def _forward(self, inputs):
         outputs = []
 
         for i, layer in enumerate(self.layers):
@@ -127,7 +151,8 @@ class DenseTransitionBlockDecoder(nn.Module):
 
 ## Dense encoders and decoders for image of size 128 128
 class waspDenseEncoder128(nn.Module):
-    def __init__(self, nc=1, ndf = 32, ndim = 128, activation=nn.LeakyReLU, args=[0.2, False], f_activation=nn.Tanh, f_args=[]):
+    def __init__(self, nc=1, ndf = 32, ndim = 128, activation=nn.LeakyReLU, args=[0.2, False], f_activation=nn.Tanh, f_args=[],
+                 checkpoint_blocks=()):
         super(waspDenseEncoder128, self).__init__()
         self.ndim = ndim
 
@@ -158,6 +183,7 @@ class waspDenseEncoder128(nn.Module):
                 DenseTransitionBlockEncoder(ndf*8, ndim, 4, activation=activation, args=args),
                 f_activation(*f_args),
         )
+        set_checkpoint_blocks(self.main, DenseBlockEncoder, checkpoint_blocks)
 
     def forward(self, input):
         input=add_coordConv_channels(input)
@@ -166,7 +192,8 @@ class waspDenseEncoder128(nn.Module):
         return output
 
 class waspDenseDecoder128(nn.Module):
-    def __init__(self, nz=128, nc=1, ngf=32, lb=0, ub=1, activation=nn.ReLU, args=[False], f_activation=nn.Hardtanh, f_args=[]):
+    def __init__(self, nz=128, nc=1, ngf=32, lb=0, ub=1, activation=nn.ReLU, args=[False], f_activation=nn.Hardtanh, f_args=[],
+                 checkpoint_blocks=()):
         super(waspDenseDecoder128, self).__init__()
         self.main   = nn.Sequential(
             # input is Z, going into convolution
@@ -200,6 +227,7 @@ class waspDenseDecoder128(nn.Module):
             nn.ConvTranspose2d(ngf, nc, 3, stride=1, padding=1, bias=False),
             f_activation(*f_args),
         )
+        set_checkpoint_blocks(self.main, DenseBlockDecoder, checkpoint_blocks)
         # self.smooth=nn.Sequential(
         #     nn.Conv2d(nc, nc, 1, stride=1, padding=0, bias=False),
         #     f_activation(*f_args),
@@ -214,8 +242,9 @@ class dnetccnl(nn.Module):
     #filters -> ndf    | encoder first layer
     #img_size(h,w) -> ndim
     #out_channels  -> optical flow (x,y)
+    #checkpoint_blocks -> dense blocks recomputed in backward, 0-4 encoder, 5-9 decoder
 
-    def __init__(self, img_size=128, in_channels=1, out_channels=2, filters=32,fc_units=100):
+    def __init__(self, img_size=128, in_channels=1, out_channels=2, filters=32,fc_units=100, checkpoint_blocks=()):
         super(dnetccnl, self).__init__()
         self.nc=in_channels
         self.nf=filters
@@ -223,8 +252,10 @@ class dnetccnl(nn.Module):
         self.oc=out_channels
         self.fcu=fc_units
 
-        self.encoder=waspDenseEncoder128(nc=self.nc+2,ndf=self.nf,ndim=self.ndim)
-        self.decoder=waspDenseDecoder128(nz=self.ndim,nc=self.oc,ngf=self.nf)
+        self.encoder=waspDenseEncoder128(nc=self.nc+2,ndf=self.nf,ndim=self.ndim,
+                                         checkpoint_blocks=[b for b in checkpoint_blocks if b < 5])
+        self.decoder=waspDenseDecoder128(nz=self.ndim,nc=self.oc,ngf=self.nf,
+                                         checkpoint_blocks=[b - 5 for b in checkpoint_blocks if b >= 5])
         # self.fc_layers= nn.Sequential(nn.Linear(self.ndim, self.fcu),
         #                               nn.ReLU(True),
         #                               nn.Dropout(0.25),
@@ -1,24 +1,39 @@
 import torch
 import torch.nn as nn
 from torch.nn import init
+from models.checkpointing import checkpoint_bn
 import functools
 
 # Defines the Unet generator.
 # |num_downs|: number of downsamplings in UNet. For example,
 # if |num_downs| == 7, image of size 128x128 will become of size 1x1
 # at the bottleneck
+# |checkpoint_levels|: levels of UnetSkipConnectionBlock whose activations are
+# recomputed in backward instead of stored, 1 is the block below the outermost
+# one and num_downs-1 the innermost. A checkpointed level covers all the levels
+# inside it.
 class UnetGenerator(nn.Module):
     def __init__(self, input_nc, output_nc, num_downs, ngf=64,
-                 norm_layer=nn.BatchNorm2d, use_dropout=False):
+                 norm_layer=nn.BatchNorm2d, use_dropout=False, checkpoint_levels=()):
         super(UnetGenerator, self).__init__()
+        for level in checkpoint_levels:
+            if not 0 < level < num_downs:
+                raise ValueError('checkpoint level {} not in [1, {}]'.format(level, num_downs - 1))
 
         # construct unet structure
-        unet_block = UnetSkipConnectionBlock(ngf * 8, ngf * 8, input_nc=None, submodule=None, norm_layer=norm_layer, innermost=True)
+        level = num_downs - 1
+        unet_block = UnetSkipConnectionBlock(ngf * 8, ngf * 8, input_nc=None, submodule=None, norm_layer=norm_layer, innermost=True,
+                                             use_checkpoint=level in checkpoint_levels)
         for i in range(num_downs - 5):
-            unet_block = UnetSkipConnectionBlock(ngf * 8, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer, use_dropout=use_dropout)
-        unet_block = UnetSkipConnectionBlock(ngf * 4, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
-        unet_block = UnetSkipConnectionBlock(ngf * 2, ngf * 4, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
-        unet_block = UnetSkipConnectionBlock(ngf, ngf * 2, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
+            level -= 1
+            unet_block = UnetSkipConnectionBlock(ngf * 8, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer, use_dropout=use_dropout,
+                                                 use_checkpoint=level in checkpoint_levels)
+        unet_block = UnetSkipConnectionBlock(ngf * 4, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer,
+                                             use_checkpoint=3 in checkpoint_levels)
+        unet_block = UnetSkipConnectionBlock(ngf * 2, ngf * 4, input_nc=None, submodule=unet_block, norm_layer=norm_layer,
+                                             use_checkpoint=2 in checkpoint_levels)
+        unet_block = UnetSkipConnectionBlock(ngf, ngf * 2, input_nc=None, submodule=unet_block, norm_layer=norm_layer,
+                                             use_checkpoint=1 in checkpoint_levels)
         unet_block = UnetSkipConnectionBlock(output_nc, ngf, input_nc=input_nc, submodule=unet_block, outermost=True, norm_layer=norm_layer)
 
         self.model = unet_block
@@ -32,9 +47,11 @@ class UnetGenerator(nn.Module):
 #   |-- downsampling -- |submodule| -- upsampling --|
 class UnetSkipConnectionBlock(nn.Module):
     def __init__(self, outer_nc, inner_nc, input_nc=None,
-                 submodule=None, outermost=False, innermost=False, norm_layer=nn.BatchNorm2d, use_dropout=False):
+                 submodule=None, outermost=False, innermost=False, norm_layer=nn.BatchNorm2d, use_dropout=False,
+                 use_checkpoint=False):
         super(UnetSkipConnectionBlock, self).__init__()
         self.outermost = outermost
+        self.use_checkpoint = use_checkpoint
         if type(norm_layer) == functools.partial:
             use_bias = norm_layer.func == nn.InstanceNorm2d
         else:
@@ -79,5 +96,11 @@ class UnetSkipConnectionBlock(nn.Module):
     def forward(self, x):
         if self.outermost:
             return self.model(x)
+        elif self.use_checkpoint and self.training and torch.is_grad_enabled():
+            # the first layer is an inplace LeakyReLU on x, which the skip connection
+            # shares. Run it outside the checkpoint so the recomputation sees the same input.
+            x = self.model[0](x)
+            layers = self.model[1:]
+            return torch.cat([x, checkpoint_bn(layers, layers, x)], 1)
         else:
-            return torch.cat([x, self.model(x)], 1)
\ No newline at end of file
+            return torch.cat([x, self.model(x)], 1)
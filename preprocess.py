@@ -0,0 +1,96 @@
+'''
+Input images for inference: the network input is made from a reduced resolution decode where the codec
+supports it (JPEG DCT scaling), the full resolution pixels are only decoded for the unwarp.
+Everything stays BGR as decoded, the networks take BGR.
+'''
+import os
+import cv2
+from PIL import Image
+
+# JPEG decodes at 1/2, 1/4 and 1/8 resolution for a fraction of the cost
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def reduced_flag(size, min_size):
+    """Largest imread reduction of an image of size (width, height) that keeps both sides at least min_size,
+       (1, cv2.IMREAD_COLOR) if none does
+    """
+    for factor, flag in REDUCED_FLAGS:
+        if min(size) // factor >= min_size:
+            return factor, flag
+    return 1, cv2.IMREAD_COLOR
+
+
+class SourceImage(object):
+    """
+    An input image, decoded lazily: size from the file header, small() for the network input and
+    full() for the unwarp, JPEG files are decoded twice (reduced and full), others once
+    """
+    def __init__(self, path):
+        self.path = path
+        self.jpeg = os.path.splitext(path)[1].lower() in JPEG_EXTENSIONS
+        self._size = None
+        self._full = None
+
+    @property
+    def size(self):
+        """(width, height) as stored, before the EXIF rotation cv2.imread applies"""
+        if self._size is None:
+            if self._full is not None:
+                self._size = (self._full.shape[1], self._full.shape[0])
+            else:
+                with Image.open(self.path) as im:
+                    self._size = im.size
+        return self._size
+
+    def full(self):
+        """Full resolution BGR uint8 pixels, decoded on first use"""
+        if self._full is None:
+            self._full = cv2.imread(self.path)
+            if self._full is None:
+                raise IOError('Cannot read image {}'.format(self.path))
+        return self._full
+
+    def small(self, min_size):
+        """BGR uint8 pixels with both sides at least min_size, reduced at decode time for JPEG files"""
+        if self._full is not None or not self.jpeg:
+            return self.full()
+        factor, flag = reduced_flag(self.size, min_size)
+        if factor == 1:
+            return self.full()
+        img = cv2.imread(self.path, flag)
+        if img is None:
+            raise IOError('Cannot read image {}'.format(self.path))
+        return img
+
+
+def network_input(img, size=(256, 256), letterbox=False):
+    """img resized to the network input size with INTER_AREA
+       :param letterbox keeps the aspect ratio, padding with black
+       :returns uint8 image and the (left, top, width, height) box of img in it
+    """
+    if not letterbox:
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA), (0, 0) + tuple(size)
+    scale = min(size[0] / float(img.shape[1]), size[1] / float(img.shape[0]))
+    width, height = max(2, int(round(img.shape[1] * scale))), max(2, int(round(img.shape[0] * scale)))
+    left, top = (size[0] - width) // 2, (size[1] - height) // 2
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    img = cv2.copyMakeBorder(img, top, size[1] - height - top, left, size[0] - width - left,
+                             cv2.BORDER_CONSTANT, value=0)
+    return img, (left, top, width, height)
+
+
+def unletterbox_bm(bm, box, size=(256, 256)):
+    """Backward map predicted on a letterboxed input to [-1,1] positions in the image itself
+       :param bm (N,2,h,w) in [-1,1] of the letterboxed input of size (width, height)
+       :param box (left, top, width, height) of the image in the input
+    """
+    left, top, width, height = box
+    if (left, top, width, height) == (0, 0) + tuple(size):
+        return bm
+    bm = bm.clone()
+    # to pixels of the input (align_corners=True), then to [-1,1] of the box
+    bm[:, 0] = ((bm[:, 0] + 1) * ((size[0] - 1) / 2.0) - left) * (2.0 / (width - 1)) - 1
+    bm[:, 1] = ((bm[:, 1] + 1) * ((size[1] - 1) / 2.0) - top) * (2.0 / (height - 1)) - 1
+    return bm
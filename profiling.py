@@ -0,0 +1,179 @@
+'''
+Per stage timers and memory high-water marks for the inference and training pipelines
+    timer = StageTimer(cuda_sync=True)
+    with timer.stage('decode'):
+        ...
+    timer.end_item('img.png')
+    timer.save('profile.json')     # or .csv
+'''
+import os
+import csv
+import json
+import time
+import resource
+import contextlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def maxrss_mb():
+    """Peak resident set size of the process"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def cuda_peak_mb():
+    return torch.cuda.max_memory_allocated() / (1024.0 * 1024.0) if torch.cuda.is_available() else 0.0
+
+
+def percentiles(values, ps=(50, 95, 99)):
+    values = np.asarray(values, dtype=np.float64)
+    stats = OrderedDict([('n', int(values.size)), ('mean', float(values.mean())), ('max', float(values.max()))])
+    for p in ps:
+        stats['p{}'.format(p)] = float(np.percentile(values, p))
+    return stats
+
+
+class StageTimer(object):
+    """
+    Wall clock seconds of named stages, grouped per item (image, batch, ...)
+    :param enabled a disabled timer only runs the wrapped code
+    :param cuda_sync synchronizes cuda around every stage, so asynchronous kernels are
+     accounted to the stage that launched them
+    :param reset_peak resets the cuda peak memory at the start of every item
+    Stages are also labelled in torch profiler traces.
+    """
+    def __init__(self, enabled=True, cuda_sync=False, reset_peak=True):
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.reset_peak = reset_peak
+        self.items = []
+        self.current = OrderedDict()
+        self.item_start = None
+
+    def _sync(self):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.item_start is None:
+            self.start_item()
+        self._sync()
+        start = time.perf_counter()
+        with torch.autograd.profiler.record_function(name):
+            yield
+        self._sync()
+        self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """Accounts seconds measured elsewhere (e.g. waiting for a DataLoader) to a stage of the current item"""
+        if self.enabled:
+            self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def start_item(self):
+        """Starts the wall clock of an item, otherwise it starts with its first stage"""
+        if not self.enabled:
+            return
+        if self.reset_peak and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._sync()
+        self.item_start = time.perf_counter()
+
+    def end_item(self, item, **extra):
+        """Closes the record of an item
+           :param extra further json serializable fields of the record, e.g. the image size
+        """
+        if not self.enabled:
+            return
+        self._sync()
+        total = time.perf_counter() - self.item_start if self.item_start is not None else sum(self.current.values())
+        record = OrderedDict([('item', item), ('total', total), ('stages', self.current),
+                              ('maxrss_mb', maxrss_mb()), ('cuda_peak_mb', cuda_peak_mb())])
+        record.update(extra)
+        self.items.append(record)
+        self.current = OrderedDict()
+        self.item_start = None
+
+    def stage_names(self):
+        names = []
+        for record in self.items:
+            names += [name for name in record['stages'] if name not in names]
+        return names
+
+    def summary(self):
+        """p50/p95/p99 of every stage and of the item totals over all items"""
+        summary = OrderedDict()
+        if not self.items:
+            return summary
+        for name in self.stage_names():
+            summary[name] = percentiles([record['stages'].get(name, 0.0) for record in self.items])
+        summary['total'] = percentiles([record['total'] for record in self.items])
+        summary['maxrss_mb'] = max(record['maxrss_mb'] for record in self.items)
+        summary['cuda_peak_mb'] = max(record['cuda_peak_mb'] for record in self.items)
+        return summary
+
+    def means(self):
+        """Mean seconds per item of every stage"""
+        return OrderedDict((name, stats['mean']) for name, stats in self.summary().items()
+                           if isinstance(stats, dict) and name != 'total')
+
+    def report(self):
+        """Summary as a printable table in ms"""
+        summary = self.summary()
+        lines = ["{:<16s} {:>10s} {:>10s} {:>10s} {:>10s}".format('stage', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for name, stats in summary.items():
+            if isinstance(stats, dict):
+                lines.append("{:<16s} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                    name, stats['mean'] * 1e3, stats['p50'] * 1e3, stats['p95'] * 1e3, stats['p99'] * 1e3))
+        if summary:
+            lines.append("peak rss {:.0f} MB, peak cuda {:.0f} MB".format(summary['maxrss_mb'], summary['cuda_peak_mb']))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """Per item records and the summary, as csv if path ends with .csv and json otherwise"""
+        if os.path.splitext(path)[1].lower() == '.csv':
+            names = self.stage_names()
+            extra = [k for record in self.items for k in record
+                     if k not in ('item', 'total', 'stages', 'maxrss_mb', 'cuda_peak_mb')]
+            extra = list(OrderedDict.fromkeys(extra))
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['item', 'total'] + names + ['maxrss_mb', 'cuda_peak_mb'] + extra)
+                for record in self.items:
+                    writer.writerow([record['item'], record['total']] + [record['stages'].get(n, 0.0) for n in names] +
+                                    [record['maxrss_mb'], record['cuda_peak_mb']] + [record.get(k, '') for k in extra])
+                summary = self.summary()
+                for p in ('p50', 'p95', 'p99'):
+                    if summary:
+                        writer.writerow([p, summary['total'][p]] + [summary[n][p] for n in names] +
+                                        [summary['maxrss_mb'], summary['cuda_peak_mb']])
+        else:
+            with open(path, 'w') as f:
+                json.dump({'summary': self.summary(), 'items': self.items}, f, indent=2)
+
+
+def write_timing_log(log_file_name, epoch, samples_per_sec, timer, phase='Train'):
+    """Appends the samples/s and the mean seconds per step of every stage to a training log file"""
+    with open(log_file_name, 'a') as f:
+        f.write("\n{} Epoch: {} Samples/s: {:.2f} StepTime(s): {}".format(
+            phase, epoch, samples_per_sec, ' '.join('{}={:.4f}'.format(k, v) for k, v in timer.means().items())))
+
+
+# stands in for a timer when nothing is profiled
+NULL_TIMER = StageTimer(enabled=False)
+
+
+@contextlib.contextmanager
+def torch_trace(path=None, use_cuda=False):
+    """torch.autograd.profiler over the block, exported as a chrome trace to path; a no-op without path"""
+    if path is None:
+        yield None
+        return
+    with torch.autograd.profiler.profile(use_cuda=use_cuda and torch.cuda.is_available(), record_shapes=True) as prof:
+        yield prof
+    prof.export_chrome_trace(path)
+    print("Saved torch profiler trace to {}".format(path))
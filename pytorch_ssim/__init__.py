@@ -17,7 +17,9 @@ def create_window(window_size, channel):
     window = Variable(_2D_window.expand(channel, 1, window_size, window_size).contiguous())
     return window
 
-def _ssim(img1, img2, window, window_size, channel, size_average = True):
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+def _ssim(img1, img2, window, window_size, channel, size_average = True, full = False):
     mu1 = F.conv2d(img1, window, padding = window_size//2, groups = channel)
     mu2 = F.conv2d(img2, window, padding = window_size//2, groups = channel)
 
@@ -32,8 +34,12 @@ def _ssim(img1, img2, window, window_size, channel, size_average = True):
     C1 = 0.01**2
     C2 = 0.03**2
 
-    ssim_map = ((2*mu1_mu2 + C1)*(2*sigma12 + C2))/((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
+    cs_map = (2*sigma12 + C2)/(sigma1_sq + sigma2_sq + C2)
+    ssim_map = ((2*mu1_mu2 + C1)/(mu1_sq + mu2_sq + C1))*cs_map
 
+    if full:
+        # mean ssim and contrast-structure term, for ms_ssim
+        return ssim_map.mean(), cs_map.mean()
     if size_average:
         return ssim_map.mean()
     else:
@@ -74,3 +80,27 @@ def ssim(img1, img2, window_size = 11, size_average = True):
     window = window.type_as(img1)
     
     return _ssim(img1, img2, window, window_size, channel, size_average)
+
+def ms_ssim(img1, img2, window_size = 11, weights = MS_SSIM_WEIGHTS):
+    """Multi-scale SSIM (Wang et al. 2003) of images in [0,1]: contrast-structure at every scale but the
+       coarsest, ssim at the coarsest, halving the resolution between scales
+    """
+    (_, channel, _, _) = img1.size()
+    window = create_window(window_size, channel)
+
+    if img1.is_cuda:
+        window = window.cuda(img1.get_device())
+    window = window.type_as(img1)
+
+    values = []
+    for i in range(len(weights)):
+        ssim_val, cs = _ssim(img1, img2, window, window_size, channel, full = True)
+        if i == len(weights) - 1:
+            values.append(ssim_val)
+        else:
+            values.append(cs)
+            img1 = F.avg_pool2d(img1, 2)
+            img2 = F.avg_pool2d(img2, 2)
+    # a negative term at a coarse scale would make its fractional power nan
+    values = torch.stack(values).clamp(min = 0)
+    return torch.prod(values ** values.new_tensor(weights))
@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from checkpoint_manager import CheckpointManager, resolve_checkpoint, load_checkpoint, rng_state, set_rng_state
+from utils import convert_state_dict
+from weights import load_state
+
+
+def draws():
+    return random.random(), float(np.random.rand()), float(torch.rand(1))
+
+
+def training_state(model, optimizer, sched, epoch):
+    # the fields trainwc.py and trainbm.py save
+    return {'epoch': epoch,
+            'model_state': model.state_dict(),
+            'optimizer_state': optimizer.state_dict(),
+            'sched_state': sched.state_dict(),
+            'best_val_mse': np.float64(0.5),
+            'global_step': 10,
+            'LClambda': 0.2,
+            'rng_state': rng_state(),
+            'val_mse': 0.5,
+            'train_mse': 0.25}
+
+
+def test_resume_from_manager_checkpoint(tmp_path):
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4))
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    sched = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=5)
+    model(torch.rand(2, 3, 8, 8)).sum().backward()
+    optimizer.step()
+    sched.step(0.5)
+
+    manager = CheckpointManager(str(tmp_path), 'unetnc', background=False)
+    manager.save(training_state(model, optimizer, sched, 1), 1, 0.5)
+    expected = draws()
+
+    # the resume path of the trainers: resolve the logdir, load, restore the models, optimizer and rngs
+    checkpoint = load_checkpoint(resolve_checkpoint(str(tmp_path)), map_location='cpu')
+    resumed = nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4))
+    resumed.load_state_dict(convert_state_dict(checkpoint['model_state']))
+    resumed_optimizer = torch.optim.Adam(resumed.parameters(), lr=1e-3)
+    resumed_optimizer.load_state_dict(checkpoint['optimizer_state'])
+    resumed_sched = torch.optim.lr_scheduler.ReduceLROnPlateau(resumed_optimizer, mode='min')
+    resumed_sched.load_state_dict(checkpoint['sched_state'])
+    set_rng_state(checkpoint['rng_state'])
+
+    assert checkpoint['epoch'] == 1
+    assert checkpoint['best_val_mse'] == 0.5
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(tensor, resumed.state_dict()[name])
+    assert draws() == expected
+
+
+def test_infer_loads_manager_checkpoint(tmp_path):
+    model = nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4))
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    sched = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min')
+    manager = CheckpointManager(str(tmp_path), 'unetnc', background=False)
+    manager.save(training_state(model, optimizer, sched, 1), 1, 0.5)
+
+    # infer.load_models and the weights converter read the model state with weights.load_state
+    state = load_state(manager.latest_path())
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(tensor, state[name])
@@ -0,0 +1,29 @@
+import random
+
+import torch
+
+from utils import TensorboardImageLogger
+
+
+class ImageWriter(object):
+    def __init__(self):
+        self.images = []
+
+    def add_image(self, tag, image, global_step):
+        self.images.append(tag)
+
+
+def test_image_logger_leaves_process_rng():
+    writer = ImageWriter()
+    logger = TensorboardImageLogger(writer, interval=0.0)
+    random.seed(0)
+    expected = [random.random() for _ in range(3)]
+
+    random.seed(0)
+    images = torch.rand(8, 3, 32, 32)
+    logger.log_wc(1, images, images, images, 4, 'inp', 'gt', 'pred')
+    logger.log_unwarp(1, images, images, 4, 'uw_gt', 'uw_pred')
+    logger.close()
+
+    assert writer.images == ['inp', 'gt', 'pred', 'uw_gt', 'uw_pred']
+    assert [random.random() for _ in range(3)] == expected
@@ -2,6 +2,7 @@
 # models are saved in checkpoints-wc/
 
 import os
+import time
 import torch
 import argparse
 import torch.nn as nn
@@ -16,7 +17,11 @@ from tqdm import tqdm
 
 from models import get_model
 from loaders import get_loader
-from utils import show_wc_tnsboard,  get_lr
+from utils import get_lr, MetricAccumulator, TensorboardImageLogger, reset_peak_memory, peak_memory_mb
+from utils import init_distributed, is_main_process, print_main, parallelize, unwrap_model, convert_state_dict
+from utils import subset_evenly, CachedLoader
+from checkpoint_manager import CheckpointManager, resolve_checkpoint, load_checkpoint, rng_state, set_rng_state
+from profiling import StageTimer, write_timing_log
 import grad_loss
 
 
@@ -27,6 +32,11 @@ def write_log_file(log_file_name,losses, epoch, lrate, phase):
 
 def train(args):
 
+    # Setup device, one process per gpu (or cpu) with --distributed
+    device = init_distributed(args)
+    # logs, tensorboard and checkpoints are written by rank 0 only
+    args.tboard = args.tboard and is_main_process()
+
     # Setup Dataloader
     data_loader = get_loader('doc3dwc')
     data_path = args.data_path
@@ -34,13 +44,18 @@ def train(args):
     v_loader = data_loader(data_path, is_transform=True, split='val', img_size=(args.img_rows, args.img_cols))
 
     n_classes = t_loader.n_classes
-    trainloader = data.DataLoader(t_loader, batch_size=args.batch_size, num_workers=8, shuffle=True)
-    valloader = data.DataLoader(v_loader, batch_size=args.batch_size, num_workers=8)
+    v_loader = subset_evenly(v_loader, args.val_subset)
+    train_sampler = data.distributed.DistributedSampler(t_loader) if args.distributed else None
+    val_sampler = data.distributed.DistributedSampler(v_loader, shuffle=False) if args.distributed else None
+    trainloader = data.DataLoader(t_loader, batch_size=args.batch_size, num_workers=8, shuffle=train_sampler is None, sampler=train_sampler)
+    valloader = data.DataLoader(v_loader, batch_size=args.batch_size, num_workers=8, sampler=val_sampler)
+    if args.val_cache:
+        # val crops are seeded per sample (sample_rng), it is decoded and transformed once
+        valloader = CachedLoader(valloader)
 
     # Setup Model
-    model = get_model(args.arch, n_classes,in_channels=3)
-    model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
-    model.cuda()
+    model = get_model(args.arch, n_classes,in_channels=3, checkpoint=args.checkpoint)
+    model = parallelize(model, device, args.distributed, args.sync_bn)
 
     # Activation
     htan = nn.Hardtanh(0,1.0)
@@ -57,134 +72,204 @@ def train(args):
     gloss= grad_loss.Gradloss(window_size=5,padding=2)
 
     epoch_start=0
+    best_val_mse = 99999.0
+    global_step=0
+    LClambda = 0.2
     if args.resume is not None:                                         
-        if os.path.isfile(args.resume):
-            print("Loading model and optimizer from checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
-            model.load_state_dict(checkpoint['model_state'])
+        resume_path = resolve_checkpoint(args.resume)
+        if resume_path is not None:
+            print_main("Loading model and optimizer from checkpoint '{}'".format(resume_path))
+            checkpoint = load_checkpoint(resume_path, map_location=device)
+            unwrap_model(model).load_state_dict(convert_state_dict(checkpoint['model_state']))
             optimizer.load_state_dict(checkpoint['optimizer_state'])
-            print("Loaded checkpoint '{}' (epoch {})"                    
-                  .format(args.resume, checkpoint['epoch']))
+            # checkpoints of the checkpoint manager hold the rest of the training state
+            if 'sched_state' in checkpoint:
+                sched.load_state_dict(checkpoint['sched_state'])
+                best_val_mse = checkpoint['best_val_mse']
+                global_step = checkpoint['global_step']
+                LClambda = checkpoint['LClambda']
+                set_rng_state(checkpoint['rng_state'])
+            print_main("Loaded checkpoint '{}' (epoch {})"                    
+                  .format(resume_path, checkpoint['epoch']))
             epoch_start=checkpoint['epoch']
         else:
-            print("No checkpoint found at '{}'".format(args.resume)) 
+            print_main("No checkpoint found at '{}'".format(args.resume)) 
     
     #Log file:
-    if not os.path.exists(args.logdir):
-        os.makedirs(args.logdir)
     experiment_name='htan_doc3d_l1grad_bghsaugk_scratch' #activation_dataset_lossparams_augmentations_trainstart
-    log_file_name=os.path.join(args.logdir,experiment_name+'.txt')
-    if os.path.isfile(log_file_name):
-        log_file=open(log_file_name,'a')
-    else:
-        log_file=open(log_file_name,'w+')
+    if is_main_process():
+        if not os.path.exists(args.logdir):
+            os.makedirs(args.logdir)
+        log_file_name=os.path.join(args.logdir,experiment_name+'.txt')
+        if os.path.isfile(log_file_name):
+            log_file=open(log_file_name,'a')
+        else:
+            log_file=open(log_file_name,'w+')
 
-    log_file.write('\n---------------  '+experiment_name+'  ---------------\n')
-    log_file.close()
+        log_file.write('\n---------------  '+experiment_name+'  ---------------\n')
+        log_file.close()
+
+        # latest and top-k checkpoints by val mse, written in the background
+        ckpt_manager = CheckpointManager(args.logdir, '{}_{}'.format(args.arch, experiment_name), keep_best=args.keep_best)
 
     # Setup tensorboard for visualization
     if args.tboard:
         # save logs in runs/<experiment_name> 
         writer = SummaryWriter(comment=experiment_name)
-
-    best_val_mse = 99999.0
-    global_step=0
-    LClambda = 0.2
+        # image grids are built off the training thread, within a byte budget per interval
+        image_logger = TensorboardImageLogger(writer, max_bytes=int(args.tboard_img_mb * 1024 * 1024),
+                                              interval=args.tboard_img_interval)
+
+    # losses are summed on the device, they are only read back at log intervals
+    train_metrics = MetricAccumulator('loss', 'l1loss', 'gloss', 'mse')
+    running_metrics = MetricAccumulator('loss')
+    val_metrics = MetricAccumulator('loss', 'mse', 'gloss')
     for epoch in range(epoch_start,args.n_epoch):
-        avg_loss=0.0
-        avg_l1loss=0.0
-        avg_gloss=0.0
-        train_mse=0.0
+        train_metrics.reset()
+        running_metrics.reset()
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         model.train()
         if epoch == 50 and LClambda < 1.0:
             LClambda += 0.2
+        reset_peak_memory()
+        # time per step waiting for data, in h2d copies, forward, loss, backward, optimizer and logging
+        timer = StageTimer(cuda_sync=args.sync_timing, reset_peak=False)
+        n_samples=0
+        epoch_start_time=time.time()
+        interval_start=time.time()
+        # the item starts before the batch is fetched, its total includes the data wait
+        timer.start_item()
+        data_start=time.perf_counter()
         for i, (images, labels) in enumerate(trainloader):
-            images = Variable(images.cuda())
-            labels = Variable(labels.cuda())
+            timer.add('data', time.perf_counter()-data_start)
+            with timer.stage('h2d'):
+                images = Variable(images.to(device))
+                labels = Variable(labels.to(device))
+            n_samples+=images.size(0)
 
             optimizer.zero_grad()
-            outputs = model(images)
-            pred=htan(outputs)
-            g_loss=gloss(pred, labels)
-            l1loss = loss_fn(pred, labels)
-            loss=l1loss + LClambda*g_loss
-            avg_l1loss+=float(l1loss)
-            avg_gloss+=float(g_loss)
-            avg_loss+=float(loss)
-            train_mse+=float(MSE(pred, labels).item())
-
-            loss.backward()
-            optimizer.step()
+            with timer.stage('forward'):
+                outputs = model(images)
+                pred=htan(outputs)
+            with timer.stage('loss'):
+                g_loss=gloss(pred, labels)
+                l1loss = loss_fn(pred, labels)
+                loss=l1loss + LClambda*g_loss
+
+            with timer.stage('backward'):
+                loss.backward()
+            with timer.stage('optimizer'):
+                optimizer.step()
             global_step+=1
 
-            if (i+1) % 50 == 0:
-                print("Epoch[%d/%d] Batch [%d/%d] Loss: %.4f" % (epoch+1,args.n_epoch,i+1, len(trainloader), avg_loss/50.0))
-                avg_loss=0.0
-
-            if args.tboard and  (i+1) % 20 == 0:
-                show_wc_tnsboard(global_step, writer,images,labels,pred, 8,'Train Inputs', 'Train WCs', 'Train Pred. WCs')
-                writer.add_scalar('WC: L1 Loss/train', avg_l1loss/(i+1), global_step)
-                writer.add_scalar('WC: Grad Loss/train', avg_gloss/(i+1), global_step)
-                
-        train_mse=train_mse/len(trainloader)
-        avg_l1loss=avg_l1loss/len(trainloader)
-        avg_gloss=avg_gloss/len(trainloader)
-        print("Training L1:%4f" %(avg_l1loss))
-        print("Training MSE:'{}'".format(train_mse))
+            with timer.stage('logging'):
+                with torch.no_grad():
+                    train_metrics.update(loss=loss, l1loss=l1loss, gloss=g_loss, mse=MSE(pred, labels))
+                    running_metrics.update(loss=loss)
+
+                if (i+1) % 50 == 0:
+                    avg_loss=running_metrics.sum('loss')/50.0
+                    data_wait=sum(r['stages'].get('data', 0.0) for r in timer.items[-49:])+timer.current['data']
+                    interval=time.time()-interval_start
+                    print_main("Epoch[%d/%d] Batch [%d/%d] Loss: %.4f (%.3fs/step, %.0f%% data wait)" % (epoch+1,args.n_epoch,i+1, len(trainloader), avg_loss, interval/50.0, 100.0*data_wait/interval))
+                    running_metrics.reset()
+                    interval_start=time.time()
+
+                if args.tboard and  (i+1) % 20 == 0:
+                    image_logger.log_wc(global_step, images,labels,pred, 8,'Train Inputs', 'Train WCs', 'Train Pred. WCs')
+                    writer.add_scalar('WC: L1 Loss/train', train_metrics.mean('l1loss'), global_step)
+                    writer.add_scalar('WC: Grad Loss/train', train_metrics.mean('gloss'), global_step)
+            timer.end_item(i)
+            timer.start_item()
+            data_start=time.perf_counter()
+
+        # averages over all processes
+        train_metrics.all_reduce(device)
+        train_mse=train_metrics.mean('mse')
+        avg_l1loss=train_metrics.mean('l1loss')
+        avg_gloss=train_metrics.mean('gloss')
+        print_main("Training L1:%4f" %(avg_l1loss))
+        print_main("Training MSE:'{}'".format(train_mse))
+        step_time=(time.time()-epoch_start_time)/len(trainloader)
+        if args.distributed:
+            n_samples*=torch.distributed.get_world_size()
+        samples_per_sec=n_samples/(time.time()-epoch_start_time)
+        peak_mem=peak_memory_mb()
+        print_main("Training step time: {:.3f}s, {:.2f} samples/s, peak memory: {:.0f} MB".format(step_time, samples_per_sec, peak_mem))
+        print_main(timer.report())
+        if args.tboard:
+            writer.add_scalar('Perf: Step time/train', step_time, epoch+1)
+            writer.add_scalar('Perf: Samples per sec/train', samples_per_sec, epoch+1)
+            writer.add_scalar('Perf: Peak memory MB/train', peak_mem, epoch+1)
+            for stage, seconds in timer.means().items():
+                writer.add_scalar('Time: {}/train'.format(stage), seconds, epoch+1)
         train_losses=[avg_l1loss, train_mse, avg_gloss]
 
         lrate=get_lr(optimizer)
-        write_log_file(experiment_name, train_losses, epoch+1, lrate,'Train')
+        if is_main_process():
+            write_log_file(experiment_name, train_losses, epoch+1, lrate,'Train')
+            write_timing_log(log_file_name, epoch+1, samples_per_sec, timer)
         
 
-        model.eval()
-        val_loss=0.0
-        val_mse=0.0
-        val_gloss=0.0
-        for i_val, (images_val, labels_val) in tqdm(enumerate(valloader)):
-            with torch.no_grad():
-                images_val = Variable(images_val.cuda())
-                labels_val = Variable(labels_val.cuda())
-
-                outputs = model(images_val)
-                pred_val=htan(outputs)
-                g_loss=gloss(pred_val, labels_val).cpu()
-                pred_val=pred_val.cpu()
-                labels_val=labels_val.cpu()
-                loss = loss_fn(pred_val, labels_val)
-                val_loss+=float(loss)
-                val_mse+=float(MSE(pred_val, labels_val))
-                val_gloss+=float(g_loss)
-
-        if args.tboard:
-            show_wc_tnsboard(epoch+1, writer,images_val,labels_val,pred_val, 8,'Val Inputs', 'Val WCs', 'Val Pred. WCs')
-            writer.add_scalar('WC: L1 Loss/val', val_loss, epoch+1)
-            writer.add_scalar('WC: Grad Loss/val', val_gloss, epoch+1)
-
-        val_loss=val_loss/len(valloader)
-        val_mse=val_mse/len(valloader)
-        val_gloss=val_gloss/len(valloader)
-        print("val loss at epoch {}:: {}".format(epoch+1,val_loss))
-        print("val MSE: {}".format(val_mse))
-
-        val_losses=[val_loss, val_mse,val_gloss]
-        write_log_file(experiment_name, val_losses, epoch+1, lrate, 'Val')
-
-        #reduce learning rate
-        sched.step(val_mse) 
+        # validation every val_every epochs and after the last one, the scheduler and
+        # the best model selection only see validated epochs
+        val_mse = None
+        if (epoch+1) % args.val_every == 0 or (epoch+1) == args.n_epoch:
+            model.eval()
+            val_metrics.reset()
+            for i_val, (images_val, labels_val) in tqdm(enumerate(valloader), disable=not is_main_process()):
+                with torch.no_grad():
+                    images_val = Variable(images_val.to(device))
+                    labels_val = Variable(labels_val.to(device))
+
+                    outputs = model(images_val)
+                    pred_val=htan(outputs)
+                    g_loss=gloss(pred_val, labels_val)
+                    loss = loss_fn(pred_val, labels_val)
+                    val_metrics.update(loss=loss, mse=MSE(pred_val, labels_val), gloss=g_loss)
+            # every process steps the scheduler with the same val mse
+            val_metrics.all_reduce(device)
+
+            if args.tboard:
+                image_logger.log_wc(epoch+1, images_val,labels_val,pred_val, 8,'Val Inputs', 'Val WCs', 'Val Pred. WCs')
+                writer.add_scalar('WC: L1 Loss/val', val_metrics.sum('loss'), epoch+1)
+                writer.add_scalar('WC: Grad Loss/val', val_metrics.sum('gloss'), epoch+1)
+
+            val_loss=val_metrics.mean('loss')
+            val_mse=val_metrics.mean('mse')
+            val_gloss=val_metrics.mean('gloss')
+            print_main("val loss at epoch {}:: {}".format(epoch+1,val_loss))
+            print_main("val MSE: {}".format(val_mse))
+
+            val_losses=[val_loss, val_mse,val_gloss]
+            if is_main_process():
+                write_log_file(experiment_name, val_losses, epoch+1, lrate, 'Val')
+
+            #reduce learning rate
+            sched.step(val_mse) 
         
-        if val_mse < best_val_mse:
-            best_val_mse=val_mse
-            state = {'epoch': epoch+1,
-                     'model_state': model.state_dict(),
-                     'optimizer_state' : optimizer.state_dict(),}
-            torch.save(state, args.logdir+"{}_{}_{}_{}_{}_best_model.pkl".format(args.arch, epoch+1,val_mse,train_mse,experiment_name))
+            if val_mse < best_val_mse:
+                best_val_mse=val_mse
 
-        if (epoch+1) % 10 == 0:
+        if is_main_process():
             state = {'epoch': epoch+1,
-                     'model_state': model.state_dict(),
-                     'optimizer_state' : optimizer.state_dict(),}
-            torch.save(state, args.logdir+"{}_{}_{}_{}_{}_model.pkl".format(args.arch, epoch+1,val_mse,train_mse,experiment_name))
+                     'model_state': unwrap_model(model).state_dict(),
+                     'optimizer_state' : optimizer.state_dict(),
+                     'sched_state': sched.state_dict(),
+                     'best_val_mse': best_val_mse,
+                     'global_step': global_step,
+                     'LClambda': LClambda,
+                     'rng_state': rng_state(),
+                     'val_mse': val_mse,
+                     'train_mse': train_mse,}
+            ckpt_manager.save(state, epoch+1, val_mse)
+
+    if is_main_process():
+        ckpt_manager.wait()
+    if args.tboard:
+        image_logger.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Hyperparams')
@@ -203,14 +288,38 @@ if __name__ == '__main__':
     parser.add_argument('--l_rate', nargs='?', type=float, default=1e-4, 
                         help='Learning Rate')
     parser.add_argument('--resume', nargs='?', type=str, default=None,    
-                        help='Path to previous saved model to restart from')
+                        help='Path to previous saved model, or logdir of the latest checkpoint, to restart from')
+    parser.add_argument('--keep_best', nargs='?', type=int, default=3,
+                        help='# of best checkpoints by val mse to keep besides the latest one')
     parser.add_argument('--logdir', nargs='?', type=str, default='./checkpoints-wc/',    
                         help='Path to store the loss logs')
     parser.add_argument('--tboard', dest='tboard', action='store_true', 
                         help='Enable visualization(s) on tensorboard | False by default')
+    parser.add_argument('--tboard_img_mb', nargs='?', type=float, default=16.0,
+                        help='Tensorboard image budget in MB per interval')
+    parser.add_argument('--tboard_img_interval', nargs='?', type=float, default=60.0,
+                        help='Length of the tensorboard image budget interval in seconds')
     parser.add_argument('--augmentation', nargs='?', type=bool, default=False,    
                         help='whether to augment training data')
-    parser.set_defaults(tboard=False)
+    parser.add_argument('--checkpoint', nargs='*', type=int, default=[],
+                        help='Activation checkpointing: unetnc skip connection levels [1-6] or dnetccnl dense blocks [0-9] to recompute in backward')
+    parser.add_argument('--distributed', dest='distributed', action='store_true',
+                        help='DistributedDataParallel, one process per gpu or cpu, launch with torch.distributed.launch')
+    parser.add_argument('--local_rank', nargs='?', type=int, default=int(os.environ.get('LOCAL_RANK', 0)),
+                        help='Set by torch.distributed.launch')
+    parser.add_argument('--dist_backend', nargs='?', type=str, default=None,
+                        help='Process group backend, nccl on gpu and gloo on cpu by default')
+    parser.add_argument('--sync_bn', dest='sync_bn', action='store_true',
+                        help='Synchronize BatchNorm statistics over processes (gpu only) with --distributed')
+    parser.add_argument('--val_every', nargs='?', type=int, default=1,
+                        help='Validate every # epochs')
+    parser.add_argument('--val_subset', nargs='?', type=int, default=0,
+                        help='Validate on # evenly spaced val samples, 0 for all')
+    parser.add_argument('--val_cache', dest='val_cache', action='store_true',
+                        help='Keep the preprocessed val batches in memory between epochs')
+    parser.add_argument('--sync_timing', dest='sync_timing', action='store_true',
+                        help='Synchronize cuda around every timed training stage, exact breakdown at some speed cost')
+    parser.set_defaults(tboard=False, distributed=False, sync_bn=False, val_cache=False, sync_timing=False)
 
     args = parser.parse_args()
     train(args)
@@ -0,0 +1,202 @@
+'''
+Unwarping of an image with the backward map predicted by the bm network
+The 128x128 map holds, for every pixel of the flat page, its position in the input image in [-1,1]
+(x, y as in F.grid_sample with align_corners=True).
+Backends, see get_unwarper:
+    torch   F.grid_sample on the full resolution map and a float32 NCHW copy of the image
+    remap   cv2.remap on the uint8 HWC image with the full resolution map in fixed point
+    mesh    cv2.remap per tile of output rows, the map is never built at full resolution
+All of them return uint8 HWC images with the channel order of the input.
+'''
+from collections import OrderedDict
+import numpy as np
+import cv2
+import torch
+import torch.nn.functional as F
+
+from profiling import NULL_TIMER
+from utils import to_chw
+
+
+def coarse_bm(bm):
+    """(1,2,h,w) network output to the h x w x 2 float32 grid, smoothed with a 3x3 box filter"""
+    bm = bm.transpose(1, 2).transpose(2, 3).detach().cpu().numpy()[0, :, :, :]
+    bm0 = cv2.blur(bm[:, :, 0], (3, 3))
+    bm1 = cv2.blur(bm[:, :, 1], (3, 3))
+    return np.stack([bm0, bm1], axis=-1).astype(np.float32)
+
+
+def resize_weights(n_out, n_in):
+    """Source indices i0, i1 and weights of i1 of a linear resize from n_in to n_out samples,
+       with the half pixel centers and replicated border of cv2.resize
+    """
+    src = (np.arange(n_out, dtype=np.float64) + 0.5) * (float(n_in) / n_out) - 0.5
+    src = np.clip(src, 0, n_in - 1)
+    i0 = np.minimum(np.floor(src).astype(np.int64), max(n_in - 2, 0))
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    return i0, i1, (src - i0).astype(np.float32)
+
+
+def unwarp_torch(img, bm, timer=NULL_TIMER, out_size=None):
+    """Reference unwarp: the smoothed bm resized to the output size and F.grid_sample
+       :param img HxWxC uint8 image
+       :param bm (1,2,h,w) backward map
+       :param out_size (width, height) of the output, the image size by default
+       :returns HxWxC uint8
+    """
+    h,w=out_size if out_size is not None else (img.shape[1],img.shape[0])
+    with timer.stage('bm_upsample'):
+        bm=cv2.resize(coarse_bm(bm),(h,w))
+        bm=torch.from_numpy(bm[None])
+
+    with timer.stage('grid_sample'):
+        # float32 once, in 0-255 as sampling is linear
+        img = torch.from_numpy(to_chw(img, scale=1.0)[None])
+        res = F.grid_sample(input=img, grid=bm, align_corners=True)[0]
+        # rounded into the uint8 output in place
+        out = np.empty((w, h, res.shape[0]), dtype=np.uint8)
+        torch.from_numpy(out).copy_(res.add_(0.5).clamp_(0, 255).permute(1, 2, 0))
+
+    return out
+
+
+def to_pixels(grid, src_shape):
+    """[-1,1] grid positions to pixels of an image of src_shape, as grid_sample with align_corners=True"""
+    return (grid + 1) * np.array([(src_shape[1] - 1) / 2.0, (src_shape[0] - 1) / 2.0], dtype=np.float32)
+
+
+def pixel_maps(bm, out_size, src_shape):
+    """Fixed point cv2.remap maps of the smoothed bm resized to out_size (width, height),
+       in pixels of an image of src_shape
+    """
+    grid = to_pixels(cv2.resize(coarse_bm(bm), tuple(out_size)), src_shape)
+    return cv2.convertMaps(grid, None, cv2.CV_16SC2)
+
+
+def unwarp_remap(img, bm, timer=NULL_TIMER, out_size=None):
+    """Unwarps with cv2.remap directly on the uint8 HWC image, multithreaded by OpenCV (cv2.setNumThreads),
+       bilinear on the 1/32 pixel grid of the fixed point maps
+       :param img HxWxC uint8 image
+       :param bm (1,2,h,w) backward map
+       :param out_size (width, height) of the output, the image size by default
+       :returns HxWxC uint8
+    """
+    out_size = out_size if out_size is not None else (img.shape[1], img.shape[0])
+    with timer.stage('bm_upsample'):
+        map1, map2 = pixel_maps(bm, out_size, img.shape)
+    with timer.stage('remap'):
+        # zero outside the image, like the default padding of grid_sample
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+def unwarp_mesh(img, bm, timer=NULL_TIMER, out_size=None, tile_rows=256):
+    """Unwarps like unwarp_torch without the full resolution map: the coarse bm is a control grid,
+       the pixel coordinates of tile_rows output rows at a time are interpolated from it and
+       sampled with cv2.remap
+       :param img HxWxC uint8 image
+       :param bm (1,2,h,w) backward map
+       :param out_size (width, height) of the output, the image size by default
+       :returns HxWxC uint8
+    """
+    cols, rows = out_size if out_size is not None else (img.shape[1], img.shape[0])
+    with timer.stage('bm_upsample'):
+        grid = coarse_bm(bm)
+        x0, x1, wx = resize_weights(cols, grid.shape[1])
+        y0, y1, wy = resize_weights(rows, grid.shape[0])
+        # linear along x once, h x W x 2, then along y per tile
+        wx = wx[None, :, None]
+        grid = grid[:, x0] * (1 - wx) + grid[:, x1] * wx
+        # to pixels commutes with the linear interpolation
+        grid = to_pixels(grid, img.shape)
+
+    out = np.empty((rows, cols) + img.shape[2:], dtype=img.dtype)
+    with timer.stage('remap'):
+        for r0 in range(0, rows, tile_rows):
+            r1 = min(r0 + tile_rows, rows)
+            wt = wy[r0:r1, None, None]
+            tile = grid[y0[r0:r1]] * (1 - wt) + grid[y1[r0:r1]] * wt
+            # zero outside the image, like the default padding of grid_sample
+            out[r0:r1] = cv2.remap(img, tile, None, cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_CONSTANT, borderValue=0).reshape(out[r0:r1].shape)
+    return out
+
+
+def get_unwarper(name):
+    """get_unwarper
+
+    :param name: unwarp backend, torch, remap or mesh
+    """
+    return {
+        'torch': unwarp_torch,
+        'remap': unwarp_remap,
+        'mesh': unwarp_mesh,
+    }[name]
+
+
+def output_size(shape, long_side):
+    """(width, height) of an image of shape scaled to long_side pixels along its longer side, never enlarged"""
+    rows, cols = shape[:2]
+    scale = min(1.0, long_side / float(max(rows, cols))) if long_side > 0 else 1.0
+    return max(1, int(round(cols * scale))), max(1, int(round(rows * scale)))
+
+
+def page_size(bm, src_shape):
+    """Natural (width, height) of the page in pixels of a source image of src_shape,
+       the mean arc length of the rows and the columns of the smoothed bm
+    """
+    grid = to_pixels(coarse_bm(bm), src_shape)
+    width = np.linalg.norm(np.diff(grid, axis=1), axis=-1).sum(axis=1).mean()
+    height = np.linalg.norm(np.diff(grid, axis=0), axis=-1).sum(axis=0).mean()
+    return width, height
+
+
+def estimate_output_size(bm, src_shape, target_dpi=0, page_width=8.27):
+    """(width, height) that renders the page at its natural aspect ratio and the resolution it has in the photo,
+       or at target_dpi if that is lower
+       :param target_dpi output resolution for a page of page_width inches (A4 by default), 0 for the photo's
+    """
+    width, height = page_size(bm, src_shape)
+    scale = 1.0
+    if target_dpi > 0:
+        # beyond the resolution of the photo the output only gets bigger, not sharper
+        scale = min(1.0, target_dpi * page_width / width)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def source_scale(grid, out_size):
+    """Largest downscale of the source that still leaves at least one source pixel per output pixel
+       everywhere on the page
+       :param grid smoothed bm in pixels of the full resolution source
+       :param out_size (width, height) of the output
+    """
+    # source pixels per output pixel between neighbouring grid points, along the output x and y axes
+    fx = np.linalg.norm(np.diff(grid, axis=1), axis=-1) * grid.shape[1] / float(out_size[0])
+    fy = np.linalg.norm(np.diff(grid, axis=0), axis=-1) * grid.shape[0] / float(out_size[1])
+    return min(1.0, 1.0 / max(min(fx.min(), fy.min()), 1e-6))
+
+
+def unwarp_sizes(img, bm, sizes, backend='remap', timer=NULL_TIMER, tile_rows=256):
+    """Unwarps img once per distinct output size with one backward map. From the largest to the smallest
+       output, the source is downscaled with INTER_AREA (from the previous level) as far as the
+       output resolution allows, the [-1,1] map does not depend on the resolution of the image it samples.
+       :param sizes output (width, height)s
+       :param tile_rows output rows per tile of the mesh backend
+       :returns {(width, height): unwarped image}
+    """
+    unwarper = get_unwarper(backend)
+    with timer.stage('bm_upsample'):
+        grid = to_pixels(coarse_bm(bm), img.shape)
+    src = img
+    outputs = OrderedDict()
+    for size in sorted(set(tuple(size) for size in sizes), key=lambda size: size[0] * size[1], reverse=True):
+        scale = source_scale(grid, size)
+        src_size = (max(1, int(round(img.shape[1] * scale))), max(1, int(round(img.shape[0] * scale))))
+        # not worth it for a few percent
+        if src_size[0] * src_size[1] < 0.8 * src.shape[0] * src.shape[1]:
+            with timer.stage('downscale'):
+                src = cv2.resize(src, src_size, interpolation=cv2.INTER_AREA)
+        if backend == 'mesh':
+            outputs[size] = unwarp_mesh(src, bm, timer, size, tile_rows)
+        else:
+            outputs[size] = unwarper(src, bm, timer, size)
+    return outputs
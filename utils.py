@@ -3,8 +3,16 @@ Misc Utility functions
 '''
 from collections import OrderedDict
 import os
+import contextlib
+import time
+import queue
+import resource
+import threading
 import numpy as np
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 import random
 import torchvision
 
@@ -17,6 +25,18 @@ def recursive_glob(rootdir='.', suffix=''):
         for looproot, _, filenames in os.walk(rootdir)
         for filename in filenames if filename.endswith(suffix)]
 
+def to_chw(img, scale=1.0 / 255, channels=None, out=None):
+    """HxWxC image to a contiguous float32 CxHxW array, converting and scaling each channel in a single pass
+        :param channels source channel of every output channel, e.g. (2, 1, 0) for RGB -> BGR, all in order by default
+        :param out preallocated float32 CxHxW array to write to, e.g. a slice of a batch
+    """
+    channels = range(img.shape[2]) if channels is None else channels
+    if out is None:
+        out = np.empty((len(channels),) + img.shape[:2], dtype=np.float32)
+    for c, src in enumerate(channels):
+        np.multiply(img[:, :, src], scale, out=out[c], dtype=np.float32)
+    return out
+
 def poly_lr_scheduler(optimizer, init_lr, iter, lr_decay_iter=1, max_iter=30000, power=0.9,):
     """Polynomial decay of learning rate
         :param init_lr is base learning rate
@@ -54,16 +74,82 @@ def alpha_blend(input_image, segmentation_mask, alpha=0.5):
 def convert_state_dict(state_dict):
     """Converts a state dict saved from a dataParallel module to normal 
        module state_dict inplace
-       :param state_dict is the loaded DataParallel model_state
+       :param state_dict is the loaded DataParallel model_state, state dicts
+        saved without the `module.` prefix are returned unchanged
     
     """
     new_state_dict = OrderedDict()
     for k, v in state_dict.items():
-        name = k[7:] # remove `module.`
+        name = k[7:] if k.startswith('module.') else k # remove `module.`
         new_state_dict[name] = v
     return new_state_dict
 
 
+def init_distributed(args):
+    """Sets up the device and, with args.distributed, the default process group.
+       Expects the environment of torch.distributed.launch (MASTER_ADDR, MASTER_PORT,
+       RANK, WORLD_SIZE and LOCAL_RANK or --local_rank). Uses nccl on gpu and gloo
+       on cpu unless args.dist_backend is given. The trainers print their progress
+       with print_main, on rank 0 only.
+    """
+    if not args.distributed:
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
+    backend = args.dist_backend or ('nccl' if torch.cuda.is_available() else 'gloo')
+    dist.init_process_group(backend=backend, init_method='env://')
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        return torch.device('cuda', local_rank)
+    return torch.device('cpu')
+
+
+def is_main_process():
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def print_main(*args, **kwargs):
+    """print on rank 0 only, for the progress every process would repeat; errors and warnings keep print"""
+    if is_main_process():
+        print(*args, **kwargs)
+
+
+def parallelize(model, device, distributed=False, sync_bn=False):
+    """Moves a model to device and wraps it in DistributedDataParallel,
+       or DataParallel over all visible gpus when not distributed
+    """
+    if distributed:
+        if sync_bn:
+            if device.type == 'cuda':
+                model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+            else:
+                print_main("SyncBatchNorm needs gpus, keeping BatchNorm")
+        model = model.to(device)
+        return DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+    if device.type == 'cuda':
+        model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
+    return model.to(device)
+
+
+def unwrap_model(model):
+    """The module inside DataParallel/DistributedDataParallel, whose state dict has no `module.` prefix"""
+    if isinstance(model, (torch.nn.DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+@contextlib.contextmanager
+def skip_grad_sync(models, skip=True):
+    """Skips the gradient all-reduce of DistributedDataParallel models, for
+       forward/backward passes that are not followed by an optimizer step
+    """
+    with contextlib.ExitStack() as stack:
+        if skip:
+            for model in models:
+                if isinstance(model, DistributedDataParallel):
+                    stack.enter_context(model.no_sync())
+        yield
+
+
 class ImagePool():
     def __init__(self, pool_size):
         self.pool_size = pool_size
@@ -104,6 +190,102 @@ def set_requires_grad(nets, requires_grad=False):
 
 
 
+class MetricAccumulator(object):
+    """Sums scalar losses on the device they were computed on.
+       Values are only copied to the host (which waits for the device) when read
+       with sum() or mean(), i.e. at log intervals and at the end of an epoch.
+    """
+    def __init__(self, *names):
+        self.names = names
+        self.sums = {}
+        self.counts = {}
+        self.reset()
+
+    def reset(self, *names):
+        for name in names or self.names:
+            self.sums[name] = 0.0
+            self.counts[name] = 0
+
+    def update(self, **values):
+        for name, value in values.items():
+            if torch.is_tensor(value):
+                value = value.detach()
+            self.sums[name] = self.sums[name] + value
+            self.counts[name] += 1
+
+    def all_reduce(self, device):
+        """Sums values and counts over all processes of the default group"""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        totals = torch.tensor([float(self.sums[name]) for name in self.names] +
+                              [self.counts[name] for name in self.names], dtype=torch.float64, device=device)
+        dist.all_reduce(totals)
+        for i, name in enumerate(self.names):
+            self.sums[name] = totals[i].item()
+            self.counts[name] = int(totals[len(self.names) + i].item())
+
+    def sum(self, name):
+        return float(self.sums[name])
+
+    def mean(self, name):
+        return self.sum(name) / max(self.counts[name], 1)
+
+
+def subset_evenly(dataset, n):
+    """Deterministic subset of n evenly spaced samples of a dataset, all of them if n <= 0"""
+    if n <= 0 or n >= len(dataset):
+        return dataset
+    return torch.utils.data.Subset(dataset, np.linspace(0, len(dataset) - 1, n).round().astype(int).tolist())
+
+
+class CachedLoader(object):
+    """
+    Keeps the batches of the first complete pass over a DataLoader in memory and
+    replays them afterwards. Only for loaders without random augmentation or shuffling.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.batches = None
+
+    def __iter__(self):
+        if self.batches is not None:
+            return iter(self.batches)
+        return self._fill()
+
+    def _fill(self):
+        batches = []
+        for batch in self.loader:
+            batches.append(batch)
+            yield batch
+        self.batches = batches
+
+    def __len__(self):
+        return len(self.loader)
+
+
+def freeze_bn(model):
+    """Puts the batch norm layers of a model in eval mode, the running statistics
+       are used and kept fixed while the rest of the model trains
+    """
+    for m in model.modules():
+        if isinstance(m, torch.nn.modules.batchnorm._BatchNorm):
+            m.eval()
+
+
+def reset_peak_memory():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory_mb():
+    """Peak allocated device memory since the last reset_peak_memory on gpu,
+       peak resident set size of the process on cpu
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / (1024.0 * 1024.0)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
         return float(param_group['lr'])
@@ -190,18 +372,114 @@ def show_uloss_visdom(vis,uwpred,uworg,labels_win,out_win,labelopts,outopts,args
                win=labels_win,
                opts=labelopts)
 
-def show_unwarp_tnsboard(images, global_step,writer,uwpred,uworg,grid_samples,gt_tag,pred_tag):
-    idxs=torch.LongTensor(random.sample(range(images.shape[0]), min(grid_samples,images.shape[0])))
+def show_unwarp_tnsboard(images, global_step,writer,uwpred,uworg,grid_samples,gt_tag,pred_tag,rng=random):
+    idxs=torch.LongTensor(rng.sample(range(images.shape[0]), min(grid_samples,images.shape[0])))
     grid_uworg = torchvision.utils.make_grid(uworg[idxs],normalize=True, scale_each=True)
     writer.add_image(gt_tag, grid_uworg, global_step)
     grid_uwpr = torchvision.utils.make_grid(uwpred[idxs],normalize=True, scale_each=True)
     writer.add_image(pred_tag, grid_uwpr, global_step)
 
-def show_wc_tnsboard(global_step,writer,images,labels, pred, grid_samples,inp_tag, gt_tag, pred_tag):
-    idxs=torch.LongTensor(random.sample(range(images.shape[0]), min(grid_samples,images.shape[0])))
+def show_wc_tnsboard(global_step,writer,images,labels, pred, grid_samples,inp_tag, gt_tag, pred_tag,rng=random):
+    idxs=torch.LongTensor(rng.sample(range(images.shape[0]), min(grid_samples,images.shape[0])))
     grid_inp = torchvision.utils.make_grid(images[idxs],normalize=True, scale_each=True)
     writer.add_image(inp_tag, grid_inp, global_step)
     grid_lbl = torchvision.utils.make_grid(labels[idxs],normalize=True, scale_each=True)
     writer.add_image(gt_tag, grid_lbl, global_step)
     grid_pred = torchvision.utils.make_grid(pred[idxs],normalize=True, scale_each=True)
     writer.add_image(pred_tag, grid_pred, global_step)
+
+
+class TensorboardImageLogger(object):
+    """Builds tensorboard image grids on a background thread.
+       The training thread only picks the samples and hands over detached,
+       downsampled copies. Images that would exceed max_bytes within an
+       interval of `interval` seconds, or find the queue full, are dropped.
+       The samples are picked with private generators seeded with `seed`, so the
+       process random stream the training draws from is left untouched.
+    """
+    def __init__(self, writer, max_bytes=16 * 1024 * 1024, interval=60.0, max_size=128, queue_size=4, seed=0):
+        self.writer = writer
+        # one per thread: the order of the draws of each does not depend on the timing of the other
+        self.rng = random.Random(seed)
+        self.worker_rng = random.Random(seed + 1)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.max_size = max_size
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, global_step, grid_samples, tags, tensors = item
+            try:
+                tensors = [t.cpu() for t in tensors]
+                if kind == 'wc':
+                    images, labels, pred = tensors
+                    show_wc_tnsboard(global_step, self.writer, images, labels, pred, grid_samples, *tags,
+                                     rng=self.worker_rng)
+                else:
+                    uwpred, uworg = tensors
+                    show_unwarp_tnsboard(uwpred, global_step, self.writer, uwpred, uworg, grid_samples, *tags,
+                                         rng=self.worker_rng)
+            except Exception as e:
+                print("Tensorboard image logging failed: {}".format(e))
+
+    def _prepare(self, tensors, grid_samples):
+        idxs = torch.LongTensor(self.rng.sample(range(tensors[0].shape[0]), min(grid_samples, tensors[0].shape[0])))
+        copies = []
+        with torch.no_grad():
+            for t in tensors:
+                t = t.detach()[idxs.to(t.device)].float()
+                if max(t.shape[2:]) > self.max_size:
+                    t = F.interpolate(t, scale_factor=self.max_size / float(max(t.shape[2:])), mode='bilinear',
+                                      align_corners=False)
+                copies.append(t)
+        return copies
+
+    def _admit(self, tensors):
+        nbytes = sum(t.numel() * t.element_size() for t in tensors)
+        now = time.time()
+        if now - self.window_start >= self.interval:
+            self.window_start = now
+            self.window_bytes = 0
+        if self.window_bytes + nbytes > self.max_bytes:
+            self.dropped += 1
+            return False
+        self.window_bytes += nbytes
+        return True
+
+    def _submit(self, kind, global_step, grid_samples, tags, tensors):
+        # budget already used up: skip the copies altogether
+        if self.window_bytes >= self.max_bytes and time.time() - self.window_start < self.interval:
+            self.dropped += 1
+            return
+        tensors = self._prepare(tensors, grid_samples)
+        if not self._admit(tensors):
+            return
+        try:
+            self.queue.put_nowait((kind, global_step, grid_samples, tags, tensors))
+        except queue.Full:
+            self.dropped += 1
+
+    def log_wc(self, global_step, images, labels, pred, grid_samples, inp_tag, gt_tag, pred_tag):
+        """Asynchronous show_wc_tnsboard"""
+        self._submit('wc', global_step, grid_samples, (inp_tag, gt_tag, pred_tag), [images, labels, pred])
+
+    def log_unwarp(self, global_step, uwpred, uworg, grid_samples, gt_tag, pred_tag):
+        """Asynchronous show_unwarp_tnsboard"""
+        self._submit('unwarp', global_step, grid_samples, (gt_tag, pred_tag), [uwpred, uworg])
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped:
+            print("Tensorboard image logging dropped {} updates (budget {} bytes per {}s)".format(
+                self.dropped, self.max_bytes, self.interval))
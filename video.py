@@ -0,0 +1,159 @@
+'''
+Rectification of document videos and camera bursts, frame by frame
+    python video.py --wc_model_path ./eval/models/unetnc_doc3d.pkl --bm_model_path ./eval/models/dnetccnl_doc3d.pkl \
+        --video_path scan.mp4 --out_path scan_uw.mp4
+The networks only run on frames that changed by more than --change_threshold since the frame they last ran on,
+the other frames reuse its backward map and remap maps and cost one cv2.remap.
+'''
+import time
+import argparse
+import cv2
+
+from infer import load_models, predict_bm, prepare_input
+from unwarping import pixel_maps, estimate_output_size, output_size
+from profiling import StageTimer, NULL_TIMER
+
+
+def read_frames(cap):
+    """BGR frames of an opened cv2.VideoCapture until the stream ends"""
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+
+def frame_change(thumb0, thumb1):
+    """Mean absolute difference in 0-255 levels of two grayscale thumbnails"""
+    return float(cv2.absdiff(thumb0, thumb1).mean())
+
+
+class StreamRectifier(object):
+    """
+    Rectifies the frames of one stream, with the output size fixed at the first frame
+    :param change_threshold frames closer than this to the last frame the networks ran on reuse its backward map
+    :param ema weight of the previous backward map in the new one, smooths the jitter of a slowly moving camera;
+     not applied across a scene cut (change above scene_cut)
+    :param auto_size output at the page size estimated from the first backward map instead of the frame size
+    :param max_output_size longer side of the output at most, 0 for no limit
+    """
+    def __init__(self, wc_model, bm_model, change_threshold=2.0, ema=0.0, scene_cut=20.0, auto_size=False,
+                 max_output_size=0, timer=NULL_TIMER):
+        self.wc_model = wc_model
+        self.bm_model = bm_model
+        self.change_threshold = change_threshold
+        self.ema = ema
+        self.scene_cut = scene_cut
+        self.auto_size = auto_size
+        self.max_output_size = max_output_size
+        self.timer = timer
+        self.bm = None
+        self.thumb = None
+        self.maps = None
+        self.out_size = None
+        self.n_frames = 0
+        self.n_inferred = 0
+
+    def _output_size(self, shape):
+        out_size = (shape[1], shape[0])
+        if self.auto_size:
+            out_size = estimate_output_size(self.bm, shape)
+        if self.max_output_size > 0:
+            out_size = output_size(out_size[::-1], self.max_output_size)
+        return out_size
+
+    def __call__(self, frame):
+        """Rectified frame (uint8, same channel order as the input)"""
+        self.timer.start_item()
+        with self.timer.stage('resize'):
+            small = cv2.resize(frame, (256, 256), interpolation=cv2.INTER_AREA)
+            thumb = cv2.cvtColor(cv2.resize(small, (64, 64), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+            change = frame_change(thumb, self.thumb) if self.thumb is not None else float('inf')
+
+        inferred = change > self.change_threshold
+        if inferred:
+            bm = predict_bm(prepare_input(small), self.wc_model, self.bm_model, self.timer).cpu()
+            if self.ema > 0 and change <= self.scene_cut:
+                bm = self.ema * self.bm + (1 - self.ema) * bm
+            self.bm, self.thumb, self.maps = bm, thumb, None
+            self.n_inferred += 1
+
+        if self.maps is None:
+            with self.timer.stage('bm_upsample'):
+                if self.out_size is None:
+                    self.out_size = self._output_size(frame.shape)
+                self.maps = pixel_maps(self.bm, self.out_size, frame.shape)
+        with self.timer.stage('remap'):
+            map1, map2 = self.maps
+            out = cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        self.n_frames += 1
+        self.timer.end_item(self.n_frames - 1, inferred=inferred)
+        return out
+
+
+def rectify_frames(frames, rectifier):
+    """Generator of the rectified frames of a frame iterator"""
+    for frame in frames:
+        yield rectifier(frame)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Params')
+    parser.add_argument('--wc_model_path', nargs='?', type=str, default='',
+                        help='Path to the saved wc model or weights file')
+    parser.add_argument('--bm_model_path', nargs='?', type=str, default='',
+                        help='Path to the saved bm model or weights file')
+    parser.add_argument('--video_path', nargs='?', type=str, default='0',
+                        help='Input video file, or the index of a camera')
+    parser.add_argument('--out_path', nargs='?', type=str, default='./eval/uw/video.mp4',
+                        help='Path of the output video')
+    parser.add_argument('--fourcc', nargs='?', type=str, default='mp4v',
+                        help='Codec of the output video')
+    parser.add_argument('--change_threshold', nargs='?', type=float, default=2.0,
+                        help='Mean change (0-255 levels) since the last inferred frame that runs the networks again')
+    parser.add_argument('--ema', nargs='?', type=float, default=0.0,
+                        help='Weight of the previous backward map when the networks run again, 0 for none')
+    parser.add_argument('--scene_cut', nargs='?', type=float, default=20.0,
+                        help='Mean change (0-255 levels) above which the previous backward map is not blended in')
+    parser.add_argument('--auto_size', dest='auto_size', action='store_true',
+                        help='Output at the page size estimated from the first backward map instead of the frame size')
+    parser.add_argument('--max_output_size', nargs='?', type=int, default=0,
+                        help='Longer side of the output at most, 0 for no limit')
+    parser.add_argument('--profile', nargs='?', type=str, default=None, const='profile.json',
+                        help='Save the per frame and p50/p95/p99 latency of every stage to this .json or .csv')
+    parser.set_defaults(auto_size=False)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    timer = StageTimer(cuda_sync=True) if args.profile else NULL_TIMER
+    wc_model, bm_model = load_models(args)
+    cap = cv2.VideoCapture(int(args.video_path) if args.video_path.isdigit() else args.video_path)
+    if not cap.isOpened():
+        raise IOError('Cannot open video {}'.format(args.video_path))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+
+    rectifier = StreamRectifier(wc_model, bm_model, args.change_threshold, args.ema, args.scene_cut,
+                                args.auto_size, args.max_output_size, timer)
+    writer = None
+    start = time.time()
+    try:
+        for out in rectify_frames(read_frames(cap), rectifier):
+            if writer is None:
+                writer = cv2.VideoWriter(args.out_path, cv2.VideoWriter_fourcc(*args.fourcc), fps,
+                                         (out.shape[1], out.shape[0]))
+            writer.write(out)
+    finally:
+        if writer is not None:
+            writer.release()
+    elapsed = time.time() - start
+    print("{} frames in {:.1f}s ({:.1f} fps), networks ran on {}".format(
+        rectifier.n_frames, elapsed, rectifier.n_frames / max(elapsed, 1e-6), rectifier.n_inferred))
+    if args.profile:
+        print(timer.report())
+        timer.save(args.profile)
+        print("Saved profile to {}".format(args.profile))
@@ -0,0 +1,145 @@
+'''
+Slim inference weights
+A weights file holds only the model state dict, without the `module.` prefix
+and the optimizer state of the training checkpoints:
+    8 bytes     MAGIC
+    8 bytes     little endian length of the json header
+    header      {'meta': {...}, 'tensors': {name: {'dtype', 'shape', 'offset'}}}
+    data        raw tensor buffers, every one aligned to ALIGNMENT bytes
+It is memory mapped copy-on-write on load, so processes reading the same
+file share its pages until they write to them. float16 files (--half) are half
+the size but are converted to the float32 of the model on load, a private copy
+in every process: they trade the sharing for size.
+
+python weights.py --model_path ./eval/models/unetnc_doc3d.pkl --out_path ./eval/models/unetnc_doc3d.dnw --half
+'''
+import os
+import json
+import struct
+import argparse
+from functools import reduce
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils import convert_state_dict
+from checkpoint_manager import load_checkpoint
+
+
+MAGIC = b'DNWT0001'
+ALIGNMENT = 64
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_weights(state_dict, path, half=False, meta=None):
+    """Writes a state dict as a weights file
+       :param half stores floating point tensors as float16
+       :param meta is a json serializable dict stored in the header
+    """
+    arrays = []
+    for name, tensor in convert_state_dict(state_dict).items():
+        if half and tensor.is_floating_point():
+            tensor = tensor.half()
+        arrays.append((name, tensor.detach().cpu().contiguous().numpy()))
+
+    tensors = {}
+    offset = 0
+    for name, array in arrays:
+        tensors[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'meta': meta or {}, 'tensors': tensors}).encode('utf-8')
+    # data starts aligned, offsets in the header are relative to it
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    header += b' ' * (data_start - len(MAGIC) - 8 - len(header))
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, array in arrays:
+            f.seek(data_start + tensors[name]['offset'])
+            f.write(array.tobytes())
+    os.replace(path + '.tmp', path)
+
+
+def is_weights_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_weights(path):
+    """Memory maps a weights file
+       :returns (state_dict, meta), the tensors of the state dict are views of the mapped file
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a weights file".format(path))
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = len(MAGIC) + 8 + header_len
+    # copy-on-write: pages are shared between processes and never written back
+    buf = np.memmap(path, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for name, t in header['tensors'].items():
+        dtype = np.dtype(t['dtype'])
+        count = int(np.prod(t['shape']))
+        start = data_start + t['offset']
+        array = buf[start:start + count * dtype.itemsize].view(dtype).reshape(t['shape'])
+        state_dict[name] = torch.from_numpy(array)
+    return state_dict, header['meta']
+
+
+def load_state(path, key='model_state'):
+    """State dict of a weights file or of a training checkpoint, without the `module.` prefix"""
+    if is_weights_file(path):
+        return load_weights(path)[0]
+    return convert_state_dict(load_checkpoint(path, map_location='cpu')[key])
+
+
+def assign_weights(model, state_dict):
+    """Points the parameters and buffers of model to the tensors of state_dict instead of
+       copying them like load_state_dict, so memory mapped weights stay shared.
+       Tensors of another dtype than the model (e.g. float16 weights) are converted into a private copy,
+       those are not shared (cpu convolutions have no float16 kernels).
+    """
+    own = model.state_dict()
+    missing = [k for k in own if k not in state_dict]
+    unexpected = [k for k in state_dict if k not in own]
+    if missing or unexpected:
+        raise RuntimeError("Error(s) in assigning weights: missing keys {}, unexpected keys {}".format(missing, unexpected))
+    for name, tensor in state_dict.items():
+        module_name, _, attr = name.rpartition('.')
+        module = reduce(getattr, module_name.split('.'), model) if module_name else model
+        current = own[name]
+        if tensor.shape != current.shape:
+            raise RuntimeError("size mismatch for {}: {} in weights, {} in model".format(name, tuple(tensor.shape), tuple(current.shape)))
+        if tensor.dtype != current.dtype:
+            tensor = tensor.to(current.dtype)
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a training checkpoint to a slim weights file')
+    parser.add_argument('--model_path', nargs='?', type=str, default='',
+                        help='Path to the saved model')
+    parser.add_argument('--out_path', nargs='?', type=str, default='',
+                        help='Path of the weights file, e.g. ./eval/models/unetnc_doc3d.dnw')
+    parser.add_argument('--key', nargs='?', type=str, default='model_state',
+                        help='Key of the state dict in the checkpoint, e.g. wc_model_state of joint checkpoints')
+    parser.add_argument('--half', dest='half', action='store_true',
+                        help='Store the weights as float16, half the size but not shared once loaded')
+    parser.set_defaults(half=False)
+    args = parser.parse_args()
+
+    checkpoint = load_checkpoint(args.model_path, map_location='cpu')
+    meta = {'epoch': checkpoint.get('epoch'), 'source': os.path.basename(args.model_path)}
+    save_weights(checkpoint[args.key], args.out_path, half=args.half, meta=meta)
+    print("Saved {} ({:.1f} MB -> {:.1f} MB)".format(args.out_path, os.path.getsize(args.model_path) / 2**20,
+                                                   os.path.getsize(args.out_path) / 2**20))